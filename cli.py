@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+Command line interface for fetching, cleaning and exporting AIS data.
+
+    python cli.py fetch --shiptype cargo --area N_Norway --start 2021-04-01 --end 2021-04-30
+    python cli.py clean --area N_Norway --shiptype cargo --polygon-file N_Norway_polygon.csv
+    python cli.py export --input Pickle_data/N_Norway --output Export
+    python cli.py index AIS/N_Norway/cargo
+    python cli.py ports --output Data/port_catalog
+
+Only the standard library is imported at startup. The modules a command
+needs (pandas, numpy, psycopg2, ...) are imported when the command runs,
+so light commands start fast. --import-time reports the time spent on imports.
+"""
+import argparse
+import importlib
+import os
+import sys
+import time
+from types import ModuleType
+from typing import Dict, List, Union
+
+START = time.perf_counter()
+IMPORT_TIMES : Dict[str, float] = {}
+
+# Names of the data frames saved by clean and read by export
+RESULTS = ('routes', 'interpolated_routes', 'waypoints')
+
+def lazy_import(name : str) -> ModuleType:
+    """Imports a module when it is needed and records the time it took."""
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    IMPORT_TIMES.setdefault(name, time.perf_counter() - start)
+    return module
+
+def report_import_time() -> None:
+    """Prints the time spent on imports to stderr."""
+    print("Imports {0:.0f}ms of {1:.0f}ms".format(
+        sum(IMPORT_TIMES.values()) * 1000,
+        (time.perf_counter() - START) * 1000
+    ), file=sys.stderr)
+    for name, seconds in IMPORT_TIMES.items():
+        print("Import {0} {1:.0f}ms".format(name, seconds * 1000), file=sys.stderr)
+
+def fetch(args : argparse.Namespace) -> None:
+    """Fetches AIS data from the database to day files."""
+    get_ais_data = lazy_import('get_ais_data')
+    options = {
+        'start_date' : args.start,
+        'end_date' : args.end,
+        'folder_name' : args.folder,
+        'compression' : args.compression,
+        'verbose' : not args.quiet,
+    }
+    if args.backfill:
+        for shiptype in args.shiptype:
+            for geo_area in args.area:
+                get_ais_data.backfill_ship_ais(
+                    shiptype=shiptype,
+                    geo_area=geo_area,
+                    retries=args.retries,
+                    backoff_s=args.backoff,
+                    **options
+                )
+    elif len(args.shiptype) > 1:
+        if args.concurrency > 1:
+            lazy_import('asyncio').run(get_ais_data.get_ships_ais_async(
+                shiptypes=args.shiptype, geo_areas=args.area, concurrency=args.concurrency, **options
+            ))
+        else:
+            get_ais_data.get_ships_ais(shiptypes=args.shiptype, geo_areas=args.area, **options)
+    elif args.concurrency > 1:
+        lazy_import('asyncio').run(get_ais_data.get_ship_ais_async(
+            shiptype=args.shiptype[0], geo_area=args.area, concurrency=args.concurrency, **options
+        ))
+    else:
+        for geo_area in args.area:
+            get_ais_data.get_ship_ais(shiptype=args.shiptype[0], geo_area=geo_area, **options)
+
+def clean(args : argparse.Namespace) -> None:
+    """
+    Runs the clean steps on the day files and saves the results as pickle files.
+    With --cache the result of every step is cached and only the steps
+    after a changed parameter are run again. With --memory-budget the steps
+    are run on partitions of ships which fit in the budget (without cache).
+    """
+    clean_ais = lazy_import('import_ais_data').clean_ais
+    pipeline = lazy_import('modules.pipeline')
+    operating_system = lazy_import('modules.operating_system').OperatingSystem()
+    stages = pipeline.clean_stages(
+        folder_name=args.folder,
+        geoarea=args.area,
+        shiptype=args.shiptype,
+        polygon_file=args.polygon_file,
+        ports_folder=args.ports_folder,
+        ports_file=args.ports_file,
+        port_catalog=args.port_catalog,
+        file_amount=args.files,
+        sample_fraction=args.sample,
+        sample_seed=args.sample_seed,
+        max_speed_knots=args.max_speed,
+        compact_max_sog=args.compact,
+        speed_limit=args.speed_limit,
+        simplify_tolerance_m=args.simplify,
+        interval_s=args.interval,
+        threshold=args.threshold,
+        clean_interval_s=args.clean_interval,
+        speed=args.speed,
+        waypoint_amount=args.waypoints
+    )
+    # The folder is made before the steps run, so they are not lost when saving
+    output = args.output or operating_system.path('Pickle_data', args.area)
+    os.makedirs(output, exist_ok=True)
+    if args.memory_budget is not None:
+        ais_class = lazy_import('modules.partitioning').run_partitioned(
+            clean_ais(verbose=not args.quiet),
+            stages,
+            args.memory_budget,
+            spill_folder=args.spill
+        )
+    else:
+        ais_class = pipeline.Pipeline(stages, args.cache, verbose=not args.quiet).run(
+            clean_ais(verbose=not args.quiet),
+            attributes=RESULTS
+        )
+
+    ais_class.save_routes(output, 'routes.pkl')
+    ais_class.save_interpolated(output, 'interpolated_routes.pkl')
+    ais_class.save_waypoints(output, 'waypoints.pkl')
+
+def export(args : argparse.Namespace) -> None:
+    """Exports the pickle files saved by clean to csv or parquet files."""
+    pd = lazy_import('pandas')
+    operating_system = lazy_import('modules.operating_system').OperatingSystem()
+    os.makedirs(args.output, exist_ok=True)
+    for name in args.results:
+        data_frame = pd.read_pickle(operating_system.check_path(args.input, name + '.pkl'))
+        file_path = operating_system.path(args.output, '{0}.{1}'.format(name, args.format))
+        if args.format == 'parquet':
+            data_frame.to_parquet(file_path)
+        else:
+            data_frame.to_csv(file_path, sep=';', date_format='%Y-%m-%d %H:%M:%S')
+        if not args.quiet:
+            print("Exported {0} to {1}".format(name, file_path), flush=True)
+
+def index(args : argparse.Namespace) -> None:
+    """Writes the missing sidecar indexes of day files."""
+    index_folder = lazy_import('modules.file_index').index_folder
+    for folder in args.folders:
+        index_folder(folder, verbose=not args.quiet)
+
+def ports(args : argparse.Namespace) -> None:
+    """
+    Refreshes the port catalog with the port polygons of the database, or
+    makes it from a text file of port polygons.
+    """
+    if args.from_text:
+        start = time.perf_counter()
+        flat = lazy_import('modules.port_catalog').catalog_from_text(args.from_text, args.output)
+        if not args.quiet:
+            print("Saved the port catalog with {0} ports ({1:.2f}s)".format(
+                flat.polygon_amount, time.perf_counter() - start
+            ), flush=True)
+    else:
+        lazy_import('get_ports_polygon').refresh_port_catalog(
+            args.output,
+            verbose=not args.quiet,
+            locode_column=args.locode_column,
+            where=args.where
+        )
+
+def build_parser() -> argparse.ArgumentParser:
+    """Creates the argument parser with a sub command per step."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--quiet', action='store_true', help="do not print progress")
+    parser.add_argument('--import-time', action='store_true', help="report the time spent on imports")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fetch_parser = commands.add_parser('fetch', help="fetch AIS data from the database")
+    fetch_parser.add_argument('--shiptype', nargs='+', default=['cargo'])
+    fetch_parser.add_argument('--area', nargs='+', required=True)
+    fetch_parser.add_argument('--start', required=True, help="first day (YYYY-MM-DD)")
+    fetch_parser.add_argument('--end', required=True, help="last day (YYYY-MM-DD)")
+    fetch_parser.add_argument('--folder', default='AIS')
+    fetch_parser.add_argument('--compression', choices=['gzip', 'zstd'])
+    fetch_parser.add_argument('--concurrency', type=int, default=1)
+    fetch_parser.add_argument('--backfill', action='store_true',
+                              help="skip completed days and retry failed days")
+    fetch_parser.add_argument('--retries', type=int, default=5)
+    fetch_parser.add_argument('--backoff', type=float, default=30, help="first retry delay in seconds")
+    fetch_parser.set_defaults(func=fetch)
+
+    clean_parser = commands.add_parser('clean', help="create and clean routes from day files")
+    clean_parser.add_argument('--area', required=True)
+    clean_parser.add_argument('--shiptype', default='cargo')
+    clean_parser.add_argument('--folder', default='AIS')
+    clean_parser.add_argument('--files', type=int, default=-1, help="number of day files (-1 is all)")
+    clean_parser.add_argument('--sample', type=float, help="fraction of the ships to clean, e.g. 0.01 (all by default)")
+    clean_parser.add_argument('--sample-seed', type=int, default=0, help="seed of the ship sample")
+    clean_parser.add_argument('--ports-folder', default='Data')
+    clean_parser.add_argument('--ports-file', default='Gatehouse_locode.csv')
+    clean_parser.add_argument('--port-catalog', help="port catalog folder (instead of the ports file)")
+    clean_parser.add_argument('--polygon-file', required=True, help="area polygon in the area folder")
+    clean_parser.add_argument('--max-speed', type=float,
+                              help="remove invalid positions and jumps faster than this (knots)")
+    clean_parser.add_argument('--compact', type=float, metavar='MAX_SOG',
+                              help="compact runs of positions at most this speed (knots)")
+    clean_parser.add_argument('--speed-limit', type=float, default=3)
+    clean_parser.add_argument('--simplify', type=float, help="simplification tolerance in metres")
+    clean_parser.add_argument('--interval', type=int, default=10*60, help="interpolation interval in seconds")
+    clean_parser.add_argument('--threshold', type=float, default=10)
+    clean_parser.add_argument('--clean-interval', type=int, default=24*60*60)
+    clean_parser.add_argument('--speed', type=float, default=0.5)
+    clean_parser.add_argument('--waypoints', type=int, default=100)
+    clean_parser.add_argument('--output', help="folder of the pickle files (Pickle_data/<area>)")
+    clean_parser.add_argument('--cache', help="folder for the cached results of every step")
+    clean_parser.add_argument('--memory-budget', help="memory for the AIS data, e.g. 8G (partitions the ships if needed)")
+    clean_parser.add_argument('--spill', help="folder for the partitions (the temporary folder by default)")
+    clean_parser.set_defaults(func=clean)
+
+    export_parser = commands.add_parser('export', help="export the results of clean")
+    export_parser.add_argument('--input', required=True, help="folder of the pickle files")
+    export_parser.add_argument('--output', required=True)
+    export_parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    export_parser.add_argument('--results', nargs='+', choices=RESULTS, default=list(RESULTS))
+    export_parser.set_defaults(func=export)
+
+    index_parser = commands.add_parser('index', help="index day files")
+    index_parser.add_argument('folders', nargs='+')
+    index_parser.set_defaults(func=index)
+
+    ports_parser = commands.add_parser('ports', help="refresh the port catalog")
+    ports_parser.add_argument('--output', default='Data/port_catalog', help="folder of the port catalog")
+    ports_parser.add_argument('--from-text', help="text file of port polygons (e.g. Data/Gatehouse_locode.csv)")
+    ports_parser.add_argument('--locode-column', default='locode', help="column of the locode in the shapes table")
+    ports_parser.add_argument('--where', help="sql condition selecting the port shapes (default: shapes with a locode)")
+    ports_parser.set_defaults(func=ports)
+    return parser
+
+def main(argv : Union[List[str], None] = None) -> None:
+    """Runs the command given by argv."""
+    args = build_parser().parse_args(argv)
+    try:
+        args.func(args)
+    finally:
+        if args.import_time:
+            report_import_time()
+
+if __name__ == "__main__":
+    main()
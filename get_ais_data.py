@@ -3,13 +3,26 @@
 Module for getting ais fata from the Gatehouse database
 """
 #Import
+import asyncio
+import csv
+import os
+import random
+import time
 import database_details
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime, date
-from typing import Union, Generator
-import pandas as pd                                     # type: ignore
-from modules.errors import WrongArguments, PathError
+from typing import Union, Generator, Tuple, List, Dict, Callable, TextIO, TYPE_CHECKING
+from modules.errors import WrongArguments, PathError, ConnectionDBError, RateLimitExceededError, TransientDBError
 from modules.database import Database
+from modules.async_database import async_database
 from modules.operating_system import OperatingSystem
+from modules.file_index import write_index, index_path
+from modules.manifest import Manifest, MANIFEST_NAME, atomic_replace
+from modules.compression import COMPRESSIONS, day_file_name, open_text
+
+# pandas is only needed by the caller of pandas_to_csv, the fetchers write csv without it
+if TYPE_CHECKING:
+    import pandas as pd                                 # type: ignore
 
 # database_details should contain the following information:
 # login_info = {
@@ -30,19 +43,62 @@ def daterange(
     for i in range(int((end_date - start_date).days + 1)):
         yield start_date + timedelta(i)
 
-def get_ship_ais(
-    shiptype : Union[str, int] = 'cargo',
-    start_date : str = '2019-04-01',
-    end_date : str = '2019-04-02',
-    geo_area : str = 'N_Norway',
-    folder_name : str = 'AIS',
-    verbose : bool = True
-    ) -> None:
-    '''
-    Function to fetch ship data from the database
-    '''
+# Ship types
+SHIP_TYPE_LOOKUP = {
+    'cargo' : 70,
+    'tanker' : 80,
+    'other type' : 90,
+    'passenger' : 60,
+    'fishing' : 30,
+    'towing' : 31,
+    'tailing': 36,
+    'pleasure craft': 37,
+    'tug' : 52,
+    'law enforcement': 55,
+    'search and rescue vessel' : 51,
+    'high speed craft' : 40,
+    'hsc' : 40,
+    'military ops' : 35,
+    'military' : 35
+}
 
-    # Converting string to datetime
+# Sql query for getting the data from the database
+AIS_SQL = """\
+    with cte as \
+    (\
+    select mmsi , pgt_pointsm(track) as p from track.tbl_daily where day = '{date}' \
+    and mmsi in (select mmsi from dbserver.mat_statvoy where shiptype = '{ship_type}' \
+    and track && (select polygon from dbserver.tbl_shapes where name = '{geo_area}'))\
+    ) select mmsi , (p).stamp , st_x((p).pos::geometry), st_y((p).pos::geometry), (p).sog, (p).cog from cte where (p).bits = 1\
+    """
+
+AIS_COLUMNS = [
+    'mmsi',
+    'datatime',
+    'lon',
+    'lat',
+    'sog',
+    'cog'
+]
+
+# Sql query for getting the data of many ship types and areas in a single scan
+# of a day, every row is tagged with its ship type and area
+BATCH_AIS_SQL = """\
+    with areas as (select name, polygon from dbserver.tbl_shapes where name in ({geo_areas})), \
+    ships as (select distinct mmsi, shiptype from dbserver.mat_statvoy where shiptype in ({ship_types})), \
+    cte as \
+    (\
+    select d.mmsi , s.shiptype , a.name as area , pgt_pointsm(d.track) as p from track.tbl_daily d \
+    join ships s on s.mmsi = d.mmsi join areas a on d.track && a.polygon where d.day = '{date}' \
+    ) select mmsi , shiptype , area , (p).stamp , st_x((p).pos::geometry), st_y((p).pos::geometry), (p).sog, (p).cog from cte where (p).bits = 1\
+    """
+
+def sql_list(values : List) -> str:
+    """Formats values as a list of sql strings."""
+    return ', '.join("'{0}'".format(str(value).replace("'", "''")) for value in values)
+
+def parse_dates(start_date : str, end_date : str) -> Tuple[date, date]:
+    """Converts the start and end date from strings (YYYY-MM-DD) to dates."""
     try:
         start_date_count = datetime.strptime(start_date, '%Y-%m-%d').date()
         end_date_count = datetime.strptime(end_date, '%Y-%m-%d').date()
@@ -54,57 +110,94 @@ def get_ship_ais(
                 end_date
                 )
         ) from exc
+    return start_date_count, end_date_count
 
-    if verbose:
-        print("{0} Days are queried.".format((end_date_count - start_date_count).days + 1))
-
-    # Ship types
-    ship_type_lookup = {
-        'cargo' : 70,
-        'tanker' : 80,
-        'other type' : 90,
-        'passenger' : 60,
-        'fishing' : 30,
-        'towing' : 31,
-        'tailing': 36,
-        'pleasure craft': 37,
-        'tug' : 52,
-        'law enforcement': 55,
-        'search and rescue vessel' : 51,
-        'high speed craft' : 40,
-        'hsc' : 40,
-        'military ops' : 35,
-        'military' : 35
-    }
-    
+def ship_type_code(shiptype : Union[str, int]) -> int:
+    """Converts a shiptype to the number used in the database."""
     # Converting to shiptype (str -> int)
     if isinstance(shiptype, str):
         try:
-            shiptype = ship_type_lookup[shiptype]
+            shiptype = SHIP_TYPE_LOOKUP[shiptype]
         except KeyError as exc:
             raise WrongArguments(
                 "shiptype was {0}, but should be one of the following types {1}".format(
                     shiptype,
-                    list(ship_type_lookup)
+                    list(SHIP_TYPE_LOOKUP)
                 )
             ) from exc
-    
+
     # Special case of towing ship type (idk why)
     if shiptype == 32:
         shiptype = 31
+    return shiptype
 
-    # Sql query for getting the data from the database
-    plain_sql = """\
-        with cte as \
-        (\
-        select mmsi , pgt_pointsm(track) as p from track.tbl_daily where day = '{date}' \
-        and mmsi in (select mmsi from dbserver.mat_statvoy where shiptype = '{ship_type}' \
-        and track && (select polygon from dbserver.tbl_shapes where name = '{geo_area}'))\
-        ) select mmsi , (p).stamp , st_x((p).pos::geometry), st_y((p).pos::geometry), (p).sog, (p).cog from cte where (p).bits = 1\
-        """
-
-    # For saving files later
-    operating_system = OperatingSystem()
+def ship_type_name(shiptype : int) -> str:
+    """Name of the folder for a shiptype number."""
+    return {v: k for k, v in SHIP_TYPE_LOOKUP.items()}[shiptype]
+
+def save_day(
+    result : list,
+    folder_name : str,
+    geo_area : str,
+    shiptype : int,
+    current_date : date,
+    compression : Union[str, None] = None
+    ) -> str:
+    """
+    Saves the result of a day to AIS/geo_area/ship_type/date.csv
+    (date.csv.gz or date.csv.zst if compression is given).
+    Returns the path of the saved file.
+    """
+    # Sorted by mmsi (stable, so every ship keeps the order of the database)
+    return rows_to_csv(
+        file_path=OperatingSystem().path(folder_name, geo_area, ship_type_name(shiptype)),
+        file_name=current_date.strftime('%Y-%m-%d'),
+        rows=sorted(result, key=lambda row: row[0]),
+        compression=compression
+    )
+
+def save_batch_day(
+    result : list,
+    folder_name : str,
+    geo_areas : List[str],
+    shiptypes : List[int],
+    current_date : date,
+    compression : Union[str, None] = None
+    ) -> None:
+    """
+    Fans the tagged rows of a batched query out to the files
+    AIS/geo_area/ship_type/date.csv of every ship type and area.
+    """
+    groups : Dict[Tuple[int, str], list] = {
+        (shiptype, geo_area) : [] for shiptype in shiptypes for geo_area in geo_areas
+    }
+    for row in result:
+        groups[(int(row[1]), row[2])].append((row[0],) + tuple(row[3:]))
+    for (shiptype, geo_area), rows in groups.items():
+        save_day(rows, folder_name, geo_area, shiptype, current_date, compression)
+
+def get_ship_ais(
+    shiptype : Union[str, int] = 'cargo',
+    start_date : str = '2019-04-01',
+    end_date : str = '2019-04-02',
+    geo_area : str = 'N_Norway',
+    folder_name : str = 'AIS',
+    compression : Union[str, None] = None,
+    verbose : bool = True
+    ) -> None:
+    '''
+    Function to fetch ship data from the database
+    compression can be 'gzip' or 'zstd' to save compressed day files.
+    '''
+
+    # Converting string to datetime
+    start_date_count, end_date_count = parse_dates(start_date, end_date)
+
+    if verbose:
+        print("{0} Days are queried.".format((end_date_count - start_date_count).days + 1))
+
+    # Converting to shiptype (str -> int)
+    shiptype = ship_type_code(shiptype)
 
     try:
         # Connect to database
@@ -123,7 +216,7 @@ def get_ship_ais(
 
             # Getting results
             result = database.execute_sql(
-                plain_sql.format(
+                AIS_SQL.format(
                     date = current_date,
                     ship_type = shiptype,
                     geo_area = geo_area
@@ -132,39 +225,361 @@ def get_ship_ais(
 
             # Check answer
             if result is not None:
-                df_results = pd.DataFrame(
-                    result,
-                    columns = [
-                        'mmsi',
-                        'datatime',
-                        'lon',
-                        'lat',
-                        'sog',
-                        'cog'
-                    ]
-                )
                 # Saves the csv file to AIS/geo_area/ship_type/date
-                ship_string = {v: k for k, v in ship_type_lookup.items()}[shiptype]
-                pandas_to_csv(
-                    file_path=operating_system.path(folder_name, geo_area, ship_string),
-                    file_name=current_date.strftime('%Y-%m-%d'),
-                    data_frame=df_results
+                save_day(result, folder_name, geo_area, shiptype, current_date, compression)
+
+    # Disconnect
+    finally:
+        database.disconnect()
+
+def backfill_ship_ais(
+    shiptype : Union[str, int] = 'cargo',
+    start_date : str = '2019-04-01',
+    end_date : str = '2019-04-02',
+    geo_area : str = 'N_Norway',
+    folder_name : str = 'AIS',
+    compression : Union[str, None] = None,
+    retries : int = 5,
+    backoff_s : float = 30,
+    max_backoff_s : float = 900,
+    verify_checksums : bool = False,
+    database = None,
+    verbose : bool = True
+    ) -> None:
+    '''
+    Resumable version of get_ship_ais for long backfills.
+    Completed days are recorded in AIS/geo_area/ship_type/manifest.json with
+    the size and checksum of their file and are skipped when the backfill is
+    run again (the checksum is only recomputed if verify_checksums is True).
+    A day that fails with TransientDBError or RateLimitExceededError is
+    retried after backoff_s, 2*backoff_s, ... seconds (at most max_backoff_s)
+    with a new connection. Days that still fail after retries are skipped and
+    reported at the end, so running the backfill again only fetches those.
+    Other errors (e.g. a ConnectionDBError of an SQL error) are not retried
+    and stop the backfill.
+    database can be any object with connect, disconnect and execute_sql,
+    by default a connection from database_details is used.
+    '''
+    # Converting string to datetime
+    start_date_count, end_date_count = parse_dates(start_date, end_date)
+
+    # Converting to shiptype (str -> int)
+    shiptype = ship_type_code(shiptype)
+
+    operating_system = OperatingSystem()
+    ship_folder = operating_system.path(folder_name, geo_area, ship_type_name(shiptype))
+    if not operating_system.check_file(ship_folder):
+        raise PathError(ship_folder)
+    manifest = Manifest(operating_system.path(ship_folder, MANIFEST_NAME))
+
+    # Only the days missing from the manifest (or changed on disk) are fetched
+    days = [
+        current_date for current_date in daterange(start_date_count, end_date_count)
+        if not manifest.is_complete(current_date.strftime('%Y-%m-%d'), verify_checksums)
+    ]
+    if verbose:
+        print("{0} Days are queried, {1} Days are already complete.".format(
+            len(days),
+            (end_date_count - start_date_count).days + 1 - len(days)
+        ))
+
+    if database is None:
+        database = Database(
+            **database_details.login_info
+        )
+    failed = []
+    try:
+        for current_date in days:
+            if verbose:
+                print(f"Fetching results from {current_date}")
+
+            for attempt in range(retries + 1):
+                try:
+                    # Reconnects if the last query closed the connection
+                    database.connect()
+                    result = database.execute_sql(
+                        AIS_SQL.format(
+                            date = current_date,
+                            ship_type = shiptype,
+                            geo_area = geo_area
+                        )
+                    )
+                    break
+                except (TransientDBError, RateLimitExceededError) as exc:
+                    database.disconnect()
+                    if attempt == retries:
+                        result = None
+                        failed.append(current_date)
+                        if verbose:
+                            print(f"Giving up on {current_date}: {exc}", flush=True)
+                        break
+                    # Exponential backoff with jitter
+                    wait = min(backoff_s * 2**attempt, max_backoff_s)
+                    wait += random.uniform(0, wait / 10)
+                    if verbose:
+                        print("{0} failed ({1}), retrying in {2:.0f}s".format(
+                            current_date, exc, wait
+                        ), flush=True)
+                    time.sleep(wait)
+
+            # Check answer
+            if result is not None:
+                manifest.record(
+                    current_date.strftime('%Y-%m-%d'),
+                    save_day(result, folder_name, geo_area, shiptype, current_date, compression)
                 )
 
     # Disconnect
     finally:
         database.disconnect()
 
+    if failed:
+        raise ConnectionDBError(
+            "Failed to fetch {0} Days: {1}".format(len(failed), ', '.join(map(str, failed)))
+        )
+
+async def get_ship_ais_async(
+    shiptype : Union[str, int] = 'cargo',
+    start_date : str = '2019-04-01',
+    end_date : str = '2019-04-02',
+    geo_area : Union[str, List[str]] = 'N_Norway',
+    folder_name : str = 'AIS',
+    compression : Union[str, None] = None,
+    concurrency : int = 4,
+    database = None,
+    verbose : bool = True
+    ) -> None:
+    '''
+    Function to fetch ship data from the database with concurrent queries.
+    The queries for every day and geo_area run concurrently (at most
+    concurrency at a time) and the results are written to disk by a writer
+    thread while the next queries run (see run_queries_async).
+    '''
+    # Converting string to datetime
+    start_date_count, end_date_count = parse_dates(start_date, end_date)
+    geo_areas = [geo_area] if isinstance(geo_area, str) else list(geo_area)
+
+    if verbose:
+        print("{0} Days are queried for {1} areas.".format(
+            (end_date_count - start_date_count).days + 1,
+            len(geo_areas)
+        ))
+
+    # Converting to shiptype (str -> int)
+    shiptype = ship_type_code(shiptype)
+
+    jobs = [
+        (
+            f"{current_date} in {current_area}",
+            AIS_SQL.format(
+                date = current_date,
+                ship_type = shiptype,
+                geo_area = current_area
+            ),
+            save_day,
+            (folder_name, current_area, shiptype, current_date, compression)
+        )
+        for current_date in daterange(start_date_count, end_date_count)
+        for current_area in geo_areas
+    ]
+    await run_queries_async(jobs, concurrency, database, verbose)
+
+def get_ships_ais(
+    shiptypes : List[Union[str, int]],
+    start_date : str = '2019-04-01',
+    end_date : str = '2019-04-02',
+    geo_areas : Union[List[str], None] = None,
+    folder_name : str = 'AIS',
+    compression : Union[str, None] = None,
+    verbose : bool = True
+    ) -> None:
+    '''
+    Function to fetch the data of many ship types and areas from the database
+    with a single query per day. The rows are saved to the file of their
+    ship type and area (compressed if compression is given), as get_ship_ais
+    would have done.
+    '''
+    # Converting string to datetime
+    start_date_count, end_date_count = parse_dates(start_date, end_date)
+    geo_areas = ['N_Norway'] if geo_areas is None else list(geo_areas)
+
+    if verbose:
+        print("{0} Days are queried.".format((end_date_count - start_date_count).days + 1))
+
+    # Converting to shiptype (str -> int)
+    shiptypes = sorted({ship_type_code(shiptype) for shiptype in shiptypes})
+
+    try:
+        # Connect to database
+        database = Database(
+            **database_details.login_info
+        )
+        database.connect()
+
+        # Getting results from the dates
+        for current_date in daterange(start_date_count, end_date_count):
+            if verbose:
+                print(f"Fetching results from {current_date}")
+
+            # Getting results
+            result = database.execute_sql(
+                BATCH_AIS_SQL.format(
+                    date = current_date,
+                    ship_types = sql_list(shiptypes),
+                    geo_areas = sql_list(geo_areas)
+                )
+            )
+
+            # Check answer
+            if result is not None:
+                save_batch_day(result, folder_name, geo_areas, shiptypes, current_date, compression)
+
+    # Disconnect
+    finally:
+        database.disconnect()
+
+async def get_ships_ais_async(
+    shiptypes : List[Union[str, int]],
+    start_date : str = '2019-04-01',
+    end_date : str = '2019-04-02',
+    geo_areas : Union[List[str], None] = None,
+    folder_name : str = 'AIS',
+    compression : Union[str, None] = None,
+    concurrency : int = 4,
+    database = None,
+    verbose : bool = True
+    ) -> None:
+    '''
+    Same as get_ships_ais, but the days are queried concurrently
+    (see get_ship_ais_async).
+    '''
+    # Converting string to datetime
+    start_date_count, end_date_count = parse_dates(start_date, end_date)
+    geo_areas = ['N_Norway'] if geo_areas is None else list(geo_areas)
+
+    if verbose:
+        print("{0} Days are queried.".format((end_date_count - start_date_count).days + 1))
+
+    # Converting to shiptype (str -> int)
+    shiptypes = sorted({ship_type_code(shiptype) for shiptype in shiptypes})
+
+    jobs = [
+        (
+            f"{current_date}",
+            BATCH_AIS_SQL.format(
+                date = current_date,
+                ship_types = sql_list(shiptypes),
+                geo_areas = sql_list(geo_areas)
+            ),
+            save_batch_day,
+            (folder_name, geo_areas, shiptypes, current_date, compression)
+        )
+        for current_date in daterange(start_date_count, end_date_count)
+    ]
+    await run_queries_async(jobs, concurrency, database, verbose)
+
+async def run_queries_async(
+    jobs : List[Tuple[str, str, Callable, tuple]],
+    concurrency : int = 4,
+    database = None,
+    verbose : bool = True
+    ) -> None:
+    '''
+    Runs the queries of jobs concurrently (at most concurrency at a time).
+    Every job is (description, sql, save function, save arguments) and the
+    result is saved with save(result, *arguments) by a writer thread while
+    the next queries run.
+    database can be any object with the coroutines connect, disconnect and
+    execute_sql, by default a connection from database_details is used.
+    '''
+    if database is None:
+        database = async_database(**database_details.login_info, pool_size=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    writer = ThreadPoolExecutor(max_workers=1)
+    loop = asyncio.get_running_loop()
+
+    async def run_job(description : str, sql : str, save : Callable, arguments : tuple) -> None:
+        """Runs a single query and hands the result to the writer."""
+        async with semaphore:
+            if verbose:
+                print(f"Fetching results from {description}")
+            result = await database.execute_sql(sql)
+        # Check answer
+        if result is not None:
+            await loop.run_in_executor(writer, save, result, *arguments)
+
+    try:
+        # Connect to database
+        await database.connect()
+        await asyncio.gather(*(run_job(*job) for job in jobs))
+
+    # Disconnect
+    finally:
+        await database.disconnect()
+        writer.shutdown(wait=True)
+
+def _csv_field(value) -> object:
+    """Formats a value from the database as pandas.to_csv would."""
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+def rows_to_csv(
+    file_path : str,
+    file_name : str,
+    rows : List[tuple],
+    create_index : bool = True,
+    compression : Union[str, None] = None
+    ) -> str:
+    """
+    Save rows from the database to csv file and return the path of the file.
+    The file is the same as pandas_to_csv would save, without importing pandas.
+    """
+    def write(csv_file : TextIO) -> None:
+        writer = csv.writer(csv_file, delimiter=';', lineterminator='\n')
+        writer.writerows([_csv_field(value) for value in row] for row in rows)
+
+    return _save_day_file(file_path, file_name, write, create_index, compression)
+
 def pandas_to_csv(
     file_path : str,
     file_name : str,
-    data_frame: pd.DataFrame
-    ) -> None:
-    """ Save data_frame to csv file."""
+    data_frame: 'pd.DataFrame',
+    create_index : bool = True,
+    compression : Union[str, None] = None
+    ) -> str:
+    """
+    Save data_frame to csv file and return the path of the file.
+    compression can be 'gzip' (.csv.gz) or 'zstd' (.csv.zst), the file is
+    then compressed while it is written.
+    If create_index is True a sidecar index is written next to the file.
+    """
+    def write(csv_file : TextIO) -> None:
+        data_frame.to_csv(
+            csv_file,
+            date_format='%Y-%m-%d %H:%M:%S',
+            sep=';',
+            header=False,
+            index=False
+        )
+
+    return _save_day_file(file_path, file_name, write, create_index, compression)
+
+def _save_day_file(
+    file_path : str,
+    file_name : str,
+    write : Callable[[TextIO], None],
+    create_index : bool,
+    compression : Union[str, None]
+    ) -> str:
+    """Saves a day file with write(file) and returns the path of the file."""
     # Make file_name into a csv file and get the path to the file
-    file_name = file_name if file_name.endswith(
+    day = file_name[:-len('.csv')] if file_name.endswith(
             '.csv'
-    ) else file_name + '.csv'
+    ) else file_name
+    file_name = day_file_name(day, compression)
 
     operating_system = OperatingSystem()
 
@@ -172,17 +587,27 @@ def pandas_to_csv(
     if not operating_system.check_file(file_path):
         raise PathError(file_path)
 
-    # Save data frame
-    data_frame.to_csv(
-        operating_system.path(
-            file_path,
-            file_name
-        ),
-        date_format='%Y-%m-%d %H:%M:%S',
-        sep=';',
-        header=False,
-        index=False
-    )
+    # Save the file to a temporary file and move it in place when it is
+    # complete, so a crash never leaves a partial day file behind
+    temporary_path = operating_system.path(file_path, file_name + '.tmp')
+    with open_text(temporary_path, 'wt', compression) as csv_file:
+        write(csv_file)
+    atomic_replace(temporary_path, operating_system.path(file_path, file_name))
+
+    # Remove the day if it was saved before with another compression
+    for other in COMPRESSIONS:
+        if other == compression:
+            continue
+        other_path = operating_system.path(file_path, day_file_name(day, other))
+        for path in (other_path, index_path(other_path)):
+            if operating_system.check_file(path):
+                os.remove(path)
+
+    # Save index with the byte offsets, time range and bounding box of each ship
+    if create_index:
+        write_index(operating_system.path(file_path, file_name))
+    return operating_system.path(file_path, file_name)
+
 if __name__ == "__main__":
     # Setup variables
     FOLDER_NAME = "AIS"
@@ -2,8 +2,14 @@
 """
 This file is for getting port polygons from the database
 """
+import asyncio
+import csv
+import time
+from typing import Dict, Union
 from modules.database import Database
-import pandas as pd                     # type: ignore
+from modules.async_database import async_database
+from modules.port_catalog import save_catalog
+from modules.wkb import decode_polygons
 import sys
 import database_details
 
@@ -16,11 +22,29 @@ import database_details
 #     'password' : "**********",
 # }
 
+# Sql query for getting the port polygons from the database
+POLYGON_SQL = """\
+    SELECT substring(left(St_astext(polygon),-2),10) FROM dbserver.tbl_shapes where name = '{geo_area}'
+    """
+
+# Sql query for getting the port polygons and their locodes from the database as WKB,
+# where selects the port shapes since the table also holds the area polygons
+POLYGONS_WKB_SQL = """\
+    SELECT name, {locode_column}, ST_AsBinary(polygon) FROM dbserver.tbl_shapes \
+    WHERE polygon IS NOT NULL AND ({where}) ORDER BY name
+    """
+
+# Column of the locode of a port shape, the area polygons have no locode
+PORT_LOCODE_COLUMN = 'locode'
+
+def polygon_to_csv(result : list, file_path : str) -> None:
+    """Saves the polygon from the database to a csv file with lat;long rows."""
+    # The database gives "long lat" pairs
+    points = [[float(y) for y in x.split(' ')] for x in result[0][0].split(',')]
+    with open(file_path, 'w', newline='') as csv_file:
+        csv.writer(csv_file, delimiter=';').writerows([point[1], point[0]] for point in points)
+
 def save_polygons(geo_area : str, file_path : str):
-    # Sql query for getting the port polygons from the database
-    plain_sql = """\
-        SELECT substring(left(St_astext(polygon),-2),10) FROM dbserver.tbl_shapes where name = '{geo_area}'
-        """
     result = None
     try:
         # Setup Database class with the valid information
@@ -33,7 +57,7 @@ def save_polygons(geo_area : str, file_path : str):
 
         # Getting results
         result = database.execute_sql(
-            plain_sql.format(
+            POLYGON_SQL.format(
                 geo_area = geo_area
             )
         )
@@ -47,13 +71,85 @@ def save_polygons(geo_area : str, file_path : str):
 
     # Save the data to a csv file
     if result is not None:
-        result = pd.DataFrame([[float(y) for y in x.split(' ')] for x in result[0][0].split(',')])[[1,0]]
-        result.to_csv(
-            file_path,
-            sep=';',
-            header=False,
-            index=False
-        )
+        polygon_to_csv(result, file_path)
+
+async def save_polygons_async(
+    file_paths : Dict[str, str],
+    concurrency : int = 4,
+    database = None
+    ) -> None:
+    """
+    Saves the polygons of many geo areas with concurrent queries.
+    file_paths maps every geo area to the file path of its polygon.
+    database can be any object with the coroutines connect, disconnect and
+    execute_sql, by default a connection from database_details is used.
+    """
+    if database is None:
+        database = async_database(**database_details.login_info, pool_size=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def save_polygon(geo_area : str, file_path : str) -> None:
+        """Fetches and saves a single polygon."""
+        async with semaphore:
+            result = await database.execute_sql(POLYGON_SQL.format(geo_area = geo_area))
+        if result:
+            await loop.run_in_executor(None, polygon_to_csv, result, file_path)
+
+    try:
+        # Connecting to the database
+        await database.connect()
+        await asyncio.gather(*(
+            save_polygon(geo_area, file_path) for geo_area, file_path in file_paths.items()
+        ))
+    finally:
+        # Disconnect
+        await database.disconnect()
+
+def refresh_port_catalog(
+    folder_name : str,
+    database = None,
+    verbose : bool = True,
+    locode_column : str = PORT_LOCODE_COLUMN,
+    where : Union[str, None] = None
+    ) -> int:
+    """
+    Fetches the port polygons of dbserver.tbl_shapes as WKB with a single
+    query and saves them as a port catalog in folder_name (see
+    modules/port_catalog.py). The locode of a port is read from locode_column.
+    where is the sql condition selecting the port shapes, by default the
+    shapes with a locode, so the area polygons of the table are left out.
+    database can be any object with connect, disconnect and execute_sql,
+    by default a connection from database_details is used.
+    Returns the number of polygons.
+    """
+    if where is None:
+        where = "{0} IS NOT NULL AND {0} <> ''".format(locode_column)
+    if database is None:
+        database = Database(**database_details.login_info)
+    start = time.time()
+    try:
+        database.connect()
+        result = database.execute_sql(POLYGONS_WKB_SQL.format(
+            locode_column = locode_column,
+            where = where
+        )) or []
+    finally:
+        database.disconnect()
+    if verbose:
+        print("Fetched {0} polygons ({1:.2f}s)".format(len(result), time.time() - start), flush=True)
+
+    start = time.time()
+    names = [row[0] for row in result]
+    locodes = [row[1] for row in result]
+    vertices, ring_offsets, ring_polygon, ring_hole = decode_polygons([row[2] for row in result])
+    # The database gives (long, lat) vertices
+    save_catalog(folder_name, names, locodes, vertices[:, ::-1], ring_offsets, ring_polygon, ring_hole)
+    if verbose:
+        print("Saved the port catalog with {0} rings ({1:.2f}s)".format(
+            len(ring_polygon), time.time() - start
+        ), flush=True)
+    return len(names)
 
 
 if __name__ == "__main__":
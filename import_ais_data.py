@@ -2,16 +2,30 @@
 """
 Module for importing AIS data and cleaning the data.
 """
-import csv
 import time
-from typing import Union
+from functools import partial
+from typing import Dict, Iterable, List, Union
 import numpy as np                                                              # type: ignore
 import pandas as pd                                                             # type: ignore
 from haversine import haversine_vector                                          # type: ignore
 from modules.operating_system import OperatingSystem
-from modules.points_in_polygons.points_in_polygons import mask_from_polygons
 from modules.centroid import find_centroid
-from modules.errors import NotdefinedError
+from modules.errors import EngineMismatchError, NotdefinedError
+from modules.trip_catalog import TripCatalog
+from modules.spatial_index import SpatialIndex
+from modules.simplify import simplify_mask
+from modules.port_lookup import PortLookup
+from modules.port_catalog import load_catalog
+from modules.file_index import BoundingBox, TimeLike, read_index, read_spans, select_spans
+from modules.compression import DAY_FILE_EXTENSIONS, compression_of, read_bytes
+from modules.trip_filter import TripFilter
+from modules.validation import REASONS, quality_reasons
+from modules.compaction import stationary_runs
+from modules.fast_parse import day_file_frame, rows_frame
+from modules.sampling import check_fraction
+from modules.prefetch import read_ahead
+from modules.engines import ENGINES, check_engine, compare_trips, reference_port_index
+from modules.resample import resample_trips, waypoint_bins
 
 # TO DO:
 # Use dask instead of pandas
@@ -20,23 +34,34 @@ from modules.errors import NotdefinedError
 
 class clean_ais():
     """
-    Model for import AIS data and sorting it
+    Model for import AIS data and sorting it.
+    engine is 'optimized' (cached port lookup and numpy resampling) or
+    'reference' (the original pandas and matplotlib code).
     """
     def __init__(
         self,
-        verbose : bool = True
+        verbose : bool = True,
+        engine : str = 'optimized'
     ) -> None:
         # Setting default values
         self.ports : Union[pd.DataFrame, None] = None
+        self.port_lookup : Union[PortLookup, None] = None
         self.routes : Union[pd.DataFrame, None] = None
         self.interpolated_routes : Union[pd.DataFrame, None] = None
         self.polygon : Union[pd.DataFrame, None] = None
         self.ais_data : Union[pd.DataFrame, None] = None
         self.waypoints : Union[pd.DataFrame, None] = None
         self.waypoint_amount : Union[int, None] = None
+        self.catalog : Union[TripCatalog, None] = None
+        self.spatial_index : Union[SpatialIndex, None] = None
+        self.simplification_ratio : Union[float, None] = None
+        self.dropped_trips : Union[pd.DataFrame, None] = None
+        self.quality_report : Union[dict, None] = None
+        self.compaction_ratio : Union[float, None] = None
         
         # verbose
         self.verbose = verbose
+        self.engine = check_engine(engine)
         
         # Operationg system for files
         self.os = OperatingSystem()
@@ -137,6 +162,21 @@ from pickle files ({1:.2f}s)'.format(variable_name, time.time()-start), flush=Tr
             )
         )
         self.ports = self.ports.reset_index(drop=True)
+        self.port_lookup = PortLookup(self.ports['polygon'].values)
+
+    def import_port_catalog(self, folder_name : str) -> None:
+        """
+        Import the ports from a compiled port catalog (see
+        modules/port_catalog.py), whose polygons can have holes and parts.
+        """
+        start = time.time()
+        self.ports, flat = load_catalog(folder_name)
+        self.port_lookup = PortLookup(flat=flat)
+        if self.verbose:
+            print("Imported {0} ports from the port catalog ({1:.2f}s)".format(
+                len(self.ports), time.time()-start
+            ), flush=True)
+
     def import_polygon(
         self,
         geoarea : str,
@@ -166,10 +206,31 @@ from pickle files ({1:.2f}s)'.format(variable_name, time.time()-start), flush=Tr
         folder_name : str,
         geoarea : str,
         shiptype : str,
-        file_amount : int = -1
+        file_amount : int = -1,
+        mmsi : Union[Iterable[Union[str, int]], None] = None,
+        bbox : Union[BoundingBox, None] = None,
+        start_time : TimeLike = None,
+        end_time : TimeLike = None,
+        workers : int = 4,
+        files : Union[Iterable[str], None] = None,
+        sample_fraction : Union[float, None] = None,
+        sample_seed : int = 0,
+        prefetch : int = 8,
+        io_workers : int = 2
     ) -> None:
         """
-        Function for import AIS data from csv files
+        Function for import AIS data from csv files.
+        The data can be limited to a list of mmsi, a bounding box
+        (lat_min, long_min, lat_max, long_max) and a time window.
+        Day files with a sidecar index are then only read where they can match.
+        Day files can be plain or compressed (.csv, .csv.gz and .csv.zst).
+        io_workers threads read and decompress up to prefetch day files
+        ahead while workers threads parse the files read before them.
+        files are the names of the day files to import (all by default).
+        With sample_fraction only a fraction of the ships is imported, with
+        all their positions on all days. The ships are chosen by a hash of
+        the mmsi and sample_seed while the files are parsed, so the sample is
+        the same on every run and other rows are never converted.
         """
         # Check if the directory exists
         folder_path = self.os.check_path(
@@ -177,13 +238,31 @@ from pickle files ({1:.2f}s)'.format(variable_name, time.time()-start), flush=Tr
             geoarea,
             shiptype
         )
+        check_fraction(sample_fraction)
+        mmsi = None if mmsi is None else {str(ship) for ship in mmsi}
+        selective = mmsi is not None or bbox is not None or start_time is not None or end_time is not None
 
         start = time.time()
-        # Save pandas dataframes in list
+        # Save the dataframes of the day files in list
         ship_data = []
-        files = self.os.get_files(folder_path)
-        files = files if file_amount == -1 else files[:file_amount]
-        for idx, file in enumerate(files):
+        if files is None:
+            files = self.os.get_files(folder_path, extensions=DAY_FILE_EXTENSIONS)
+        files = list(files) if file_amount == -1 else list(files)[:file_amount]
+        file_paths = [self.os.check_path(folder_path, file) for file in files]
+        query = (mmsi, bbox, start_time, end_time) if selective else None
+        # The files are read ahead while the files before them are parsed
+        contents = read_ahead(
+            file_paths,
+            partial(self.__read_day_file, query=query),
+            depth=max(prefetch, 1),
+            workers=max(io_workers, 1)
+        )
+        for idx, day_data in enumerate(read_ahead(
+            contents,
+            partial(self.__parse_day_file, sample_fraction=sample_fraction, sample_seed=sample_seed),
+            depth=max(workers, 1),
+            workers=max(workers, 1)
+        )):
             if self.verbose:
                 print(
                     "\rProgress = {0:.2f}%".format(
@@ -192,35 +271,172 @@ from pickle files ({1:.2f}s)'.format(variable_name, time.time()-start), flush=Tr
                     end= '',
                     flush=True
                 )
-
-            # Import data using csv.reader for higher performance then pd.read_csv
-            with open(self.os.check_path(folder_path, file)) as csvfile:
-                ship_data += list(csv.reader(csvfile, delimiter=';'))
+            ship_data.append(day_data)
         if self.verbose:
             print("\rProgress = 100.00% ({0:.2f}s)\n\
 Converting to dataframe".format(time.time() - start), flush=True)
 
-        # Create dataframe from list
-        self.ais_data = pd.DataFrame(
-            ship_data,
-            columns=[
-                    "mmsi",
-                    "time",
-                    "long",
-                    "lat",
-                    "sog",
-                    "cog"
-            ],
-        ).set_index('mmsi')
+        # Create dataframe from list (the day files are already converted)
+        self.ais_data = pd.concat(ship_data) if ship_data else rows_frame([])
 
-        # Change types from string to float/datetime
-        col = ["lat", "long", "sog", "cog"]
-        self.ais_data[col] = self.ais_data[col].apply(pd.to_numeric, errors='coerce')
-        self.ais_data["time"] = pd.to_datetime(self.ais_data["time"], format='%Y-%m-%d %H:%M:%S')
+        # Exact filter of the rows (the index only selects whole spans)
+        if selective:
+            self.ais_data = self.ais_data[
+                self.__query_mask(self.ais_data, mmsi, bbox, start_time, end_time)
+            ]
         if self.verbose:
             print("Converting to dataframe ({0:.2f}s)".format(time.time() - start), flush=True)
         self.ais_data = self.ais_data.sort_index()
 
+    @staticmethod
+    def __read_day_file(file_path : str, query : Union[tuple, None]) -> Union[bytes, None]:
+        """
+        Reads the bytes of a day file, decompressed.
+        If query is (mmsi, bbox, start_time, end_time) and the file has an
+        index only the parts of the file which can match the query are read
+        (None if no part can match).
+        """
+        if query is not None:
+            index = read_index(file_path)
+            if index is not None:
+                spans = select_spans(index, *query)
+                if not spans:
+                    return None
+                return read_spans(file_path, spans)
+
+        # Compressed files are decompressed with a single call
+        if compression_of(file_path) is not None:
+            return read_bytes(file_path)
+
+        with open(file_path, 'rb') as csvfile:
+            return csvfile.read()
+
+    @staticmethod
+    def __parse_day_file(
+        content : Union[bytes, None],
+        sample_fraction : Union[float, None] = None,
+        sample_seed : int = 0
+    ) -> pd.DataFrame:
+        """
+        Parses the bytes of a day file as a dataframe, only the rows of the
+        sampled ships with sample_fraction.
+        The bytes are parsed with numpy for higher performance then pd.read_csv.
+        """
+        if content is None:
+            return rows_frame([])
+        return day_file_frame(content, sample_fraction, sample_seed)
+
+    @staticmethod
+    def __query_mask(
+        ais_data : pd.DataFrame,
+        mmsi : Union[set, None],
+        bbox : Union[BoundingBox, None],
+        start_time : TimeLike,
+        end_time : TimeLike
+    ) -> np.ndarray:
+        """
+        Mask of the rows matching the mmsi, bounding box and time window.
+        """
+        mask = np.ones(len(ais_data), dtype=bool)
+        if mmsi is not None:
+            mask &= ais_data.index.isin(mmsi)
+        if bbox is not None:
+            mask &= (
+                (ais_data['lat'] >= bbox[0]) & (ais_data['lat'] <= bbox[2])
+                & (ais_data['long'] >= bbox[1]) & (ais_data['long'] <= bbox[3])
+            ).values
+        if start_time is not None:
+            mask &= (ais_data['time'] >= pd.Timestamp(start_time)).values
+        if end_time is not None:
+            mask &= (ais_data['time'] <= pd.Timestamp(end_time)).values
+        return mask
+
+    def validate_ais(
+        self,
+        max_speed_knots : float = 50,
+        drop : bool = True
+    ) -> None:
+        """
+        Checks the imported positions and removes invalid positions (out of
+        range or missing coordinates and times), duplicate times of a ship
+        and single positions which would need a speed over max_speed_knots.
+        If drop is False the positions are kept with the reason in the column
+        'quality' ('' for valid positions).
+        The number of positions of every reason is saved in quality_report.
+        """
+        # Check if the data has been imported
+        if self.ais_data is None:
+            raise NotdefinedError("ais_data")
+
+        start = time.time()
+        reasons = quality_reasons(
+            pd.factorize(self.ais_data.index)[0],
+            self.ais_data['time'].values.astype('datetime64[ns]').astype(np.int64),
+            self.ais_data['lat'].values.astype(float),
+            self.ais_data['long'].values.astype(float),
+            max_speed_knots
+        )
+        valid = reasons == ''
+        self.quality_report = {'rows' : len(reasons)}
+        for reason in REASONS:
+            self.quality_report[reason] = int((reasons == reason).sum())
+        self.quality_report['valid'] = int(valid.sum())
+
+        if drop:
+            self.ais_data = self.ais_data[valid]
+        else:
+            self.ais_data = self.ais_data.assign(quality=reasons)
+        if self.verbose:
+            print("Validated positions, {0} ({1:.2f}s)".format(
+                ', '.join('{0} {1}'.format(reason, count) for reason, count in self.quality_report.items()),
+                time.time() - start
+            ), flush=True)
+
+    def compact_stationary(
+        self,
+        max_sog : float = 0.5,
+        cell_m : float = 50
+    ) -> None:
+        """
+        Replaces runs of positions of a ship at a speed of at most max_sog
+        within the same cell of cell_m metres inside the same port with the
+        first and last position of the run. The column 'count' is the number
+        of positions every position stands for. Positions outside ports and
+        the arrival and departure positions of port visits are kept, so
+        create_routes finds the same port visits and trips with fewer positions.
+        The ratio of positions before and after is saved in compaction_ratio.
+        """
+        # Check if the data has been imported
+        if self.ais_data is None:
+            raise NotdefinedError("ais_data")
+        if self.ports is None:
+            raise NotdefinedError("ports")
+
+        start = time.time()
+        ships = self.ais_data.sort_values(by = ['mmsi', 'time'], kind='mergesort')
+        if self.port_lookup is None:
+            self.port_lookup = PortLookup(self.ports['polygon'].values)
+        lat = ships['lat'].values.astype(float)
+        long = ships['long'].values.astype(float)
+        keep, count = stationary_runs(
+            pd.factorize(ships.index)[0],
+            lat,
+            long,
+            ships['sog'].values.astype(float),
+            self.__port_index(self.port_lookup, lat, long),
+            max_sog,
+            cell_m
+        )
+        if 'count' in ships.columns:
+            # Compacted before, the counts add up
+            count = np.add.reduceat(ships['count'].values, np.flatnonzero(keep))
+        self.ais_data = ships[keep].assign(count=count)
+        self.compaction_ratio = len(keep) / max(int(keep.sum()), 1)
+        if self.verbose:
+            print("Compacted stationary positions from {0} to {1} ({2:.2f}s)".format(
+                len(keep), int(keep.sum()), time.time() - start
+            ), flush=True)
+
     def create_routes(
         self,
         speed_limit : float = 3
@@ -242,48 +458,34 @@ Converting to dataframe".format(time.time() - start), flush=True)
         )
         lat = ships['lat'].values
         long = ships['long'].values
-        polygon_tuple = list(self.ports['polygon'].apply(lambda x: [list(zip(x.T[0,:],x.T[1,:]))]))
-        polygon_in = [[False]*len(y) for y in polygon_tuple]
-        args = [lat, long, polygon_tuple , polygon_in]
+        if self.port_lookup is None:
+            self.port_lookup = PortLookup(self.ports['polygon'].values)
         if self.verbose:
             print("Variables for inside polygon function is made ({0:.2f}s)".format(time.time() - start), flush=True)
 
         # Find ships inside polygons
+        # (if a position is inside more than one polygon the first one is used)
         start = time.time()
-        masks = mask_from_polygons(*args, include_holes=False)
-        if self.verbose:
+        port_index = self.__port_index(self.port_lookup, lat, long)
+        if self.verbose and self.engine == 'optimized':
+            print("Inside polygon, cache hit rate {0:.1%}, edge tests {1:.1%} ({2:.2f}s)".format(
+                self.port_lookup.hit_rate, self.port_lookup.edge_test_rate, time.time() - start
+            ), flush=True)
+        elif self.verbose:
             print("Inside polygon ({0:.2f}s)".format(time.time() - start), flush=True)
 
 
         # Get ships in- and out-side polygon with data
         start = time.time()
-        # Convert to dataframe
-        masks = pd.DataFrame(masks, columns = ["index", "polygon_index"])
-        exploded_masks = masks.explode('index')
-        # If there is duplicates (polygons inside polygons, remove first duplicates)
-        exploded_masks = exploded_masks.drop_duplicates('index')
-
-        # Get data about the exploded masks (indexes)
         ships = ships.reset_index().copy()
-        constraint = ships.index.isin(exploded_masks['index'])
-        locode_in_polygon = exploded_masks.merge(
-            self.ports,
-            left_on='polygon_index',
-            right_index=True
-        ).drop(
-            [
-                'polygon_index'
-            ],
-            axis=1
-        )
-        
-        # Ships inside port
-        in_port = ships[constraint]
-        in_port = in_port.merge(
-            locode_in_polygon,
-            left_index=True,
-            right_on='index'
-        ).set_index(in_port.index)
+        constraint = port_index >= 0
+
+        # Ships inside port with data about the port
+        in_port = ships[constraint].copy()
+        in_port['index'] = in_port.index
+        port_info = self.ports.iloc[port_index[constraint]]
+        for column in self.ports.columns:
+            in_port[column] = port_info[column].values
 
         # Outside port
         out_port = ships[~constraint].copy()
@@ -360,13 +562,17 @@ Converting to dataframe".format(time.time() - start), flush=True)
         ).grouper.group_info[0]
 
         # Remove routes where there is less then 10 points
-        point_count = routes['id'].value_counts()
-        route_port = routes[routes['id'].isin(point_count[point_count >= 10].index)]
-        routes = routes.drop('index', axis=1).copy()
+        trip_filter = TripFilter(routes['id'].values)
+        trip_filter.drop('min_points', trip_filter.count(routes) < 10)
 
         # Remove the first and last trip each ship has sailed
-        remove_idx = route_port.groupby('mmsi')['id'].agg(['first','last']).values.flatten()
-        route_port = route_port[~route_port['id'].isin(remove_idx)]
+        trip_mmsi = np.empty(len(trip_filter.ids), dtype=object)
+        trip_mmsi[trip_filter.codes(routes)] = routes['mmsi'].values
+        kept = pd.Series(np.flatnonzero(trip_filter.keep))
+        first_last = kept.groupby(trip_mmsi[kept.values]).agg(['first','last']).values.flatten()
+        trip_filter.drop('first_or_last', np.isin(np.arange(len(trip_filter.ids)), first_last))
+        route_port = trip_filter.apply(routes)
+        self.dropped_trips = trip_filter.report()
 
         # Get from port and to port
         from_to = route_port.groupby('id')['index'].agg(['first','last'])
@@ -387,10 +593,62 @@ Converting to dataframe".format(time.time() - start), flush=True)
             left_on='id',
             right_index=True
         ).drop('index', axis=1)
+        # Without trips the merge names the index after the id column
+        route_port.index.name = None
         if self.verbose:
             print("Done setting up routes ({0:.2f}s)".format(time.time() - start), flush=True)
         self.routes = route_port.copy()
 
+    def __port_index(self, port_lookup : PortLookup, lat : np.ndarray, long : np.ndarray) -> np.ndarray:
+        """
+        Index of the polygon of port_lookup every position is inside of
+        (-1 outside every polygon) with the engine.
+        """
+        if self.engine == 'reference':
+            return reference_port_index(lat, long, port_lookup.polygons)
+        return port_lookup.lookup(lat, long)
+
+    def simplify_routes(
+        self,
+        tolerance_m : float = 50,
+        method : str = 'sed'
+    ) -> None:
+        """
+        Removes route points which can be recreated within tolerance_m metres
+        from the points around them.
+        method 'dp' is Douglas-Peucker on the track and 'sed' is the time aware
+        variant which measures the error at the time of the removed point.
+        """
+        # Check if the data has been made
+        if self.routes is None:
+            raise NotdefinedError("routes")
+
+        start = time.time()
+        routes = self.routes.sort_values(['id', 'time'], kind='stable')
+        ids = routes['id'].values
+        trip_starts = np.flatnonzero(np.append(True, ids[1:] != ids[:-1])) if len(ids) else np.array([], dtype=int)
+        keep = simplify_mask(
+            routes['lat'].values.astype(float),
+            routes['long'].values.astype(float),
+            routes['time'].values.astype('datetime64[ns]').astype(np.int64) / 10**9,
+            trip_starts,
+            tolerance_m,
+            method
+        )
+        self.routes = routes[keep].sort_index()
+
+        # Compression ratio of the routes
+        self.simplification_ratio = len(keep) / max(int(keep.sum()), 1)
+        if self.verbose:
+            print("Simplified routes from {0} to {1} points, ratio {2:.2f} ({3:.2f}s)".format(
+                len(keep),
+                int(keep.sum()),
+                self.simplification_ratio,
+                time.time() - start
+                ),
+                flush=True
+            )
+
     def remove_routes_outside_polygon(
         self,
     ) -> None:
@@ -403,27 +661,7 @@ Converting to dataframe".format(time.time() - start), flush=True)
         if self.routes is None:
             raise NotdefinedError("routes")
 
-        # Setup variables
-        lat = self.routes['lat'].values
-        long = self.routes['long'].values
-        polygon = self.polygon.values
-        polygon_tuple = [[list(zip(polygon.T[0,:], polygon.T[1,:]))]]
-        polygon_in = [[False]*len(y) for y in polygon_tuple]
-        args = [lat, long, polygon_tuple , polygon_in]
-
-        # Find ships inside polygons
-        start = time.time()
-        masks = mask_from_polygons(*args, include_holes=False)
-        if self.verbose:
-            print("Within function for country ({0:.2f}s)".format(time.time() - start), flush=True)
-
-        # Removes ids outside of polygon
-        remove_id = self.routes[
-            ~self.routes.reset_index()['id'].index.isin(masks[0][0])
-        ]['id'].unique()
-
-        # Overwrite self.routes
-        self.routes = self.routes[~self.routes['id'].isin(remove_id)].copy()
+        self.filter_trips(inside_polygon=True)
 
     def __interpolate(
         self,
@@ -450,19 +688,31 @@ Converting to dataframe".format(time.time() - start), flush=True)
         
         # Interpolating
         start = time.time()
-        interpolated = dataframe[
-            ['mmsi', 'time', 'lat', 'long', 'sog', 'cog', 'id']
-        ].set_index(
-            'time'
-        ).groupby(
-            ['id','mmsi']
-        ).resample(
-            resamling_interval
-        ).mean().interpolate(
-            'linear'
-        ).drop(
-            'id', axis=1
-        ).reset_index()
+        if self.engine == 'optimized':
+            interpolated = self.__resample(interval_s, dataframe)
+            if self.verbose:
+                print("Interpolated data ({0:.2f}s)".format(time.time() - start), flush=True)
+            return interpolated.merge(
+                id_locode,
+                left_on='id',
+                right_on='id'
+            )
+        if 'count' in dataframe.columns:
+            interpolated = self.__weighted_resample(resamling_interval, dataframe)
+        else:
+            interpolated = dataframe[
+                ['mmsi', 'time', 'lat', 'long', 'sog', 'cog', 'id']
+            ].set_index(
+                'time'
+            ).groupby(
+                ['id','mmsi']
+            ).resample(
+                resamling_interval
+            ).mean().interpolate(
+                'linear'
+            ).drop(
+                'id', axis=1
+            ).reset_index()
 
         if self.verbose:
             print("Interpolated data ({0:.2f}s)".format(time.time() - start), flush=True)
@@ -472,6 +722,57 @@ Converting to dataframe".format(time.time() - start), flush=True)
             right_on='id'
         )
         
+    @staticmethod
+    def __weighted_resample(resamling_interval : str, dataframe : pd.DataFrame) -> pd.DataFrame:
+        """
+        groupby(['id','mmsi']).resample().mean().interpolate('linear') of
+        compacted positions, with the means weighted by the column 'count'.
+        """
+        columns = ['lat', 'long', 'sog', 'cog']
+        weights = dataframe[columns].notna().mul(dataframe['count'], axis=0)
+        sums = pd.concat(
+            [
+                dataframe[['id', 'mmsi', 'time']],
+                dataframe[columns].mul(weights).add_suffix('_sum'),
+                weights.add_suffix('_weight')
+            ],
+            axis=1
+        ).set_index(
+            'time'
+        ).groupby(
+            ['id','mmsi']
+        )[[column + '_sum' for column in columns] + [column + '_weight' for column in columns]].resample(
+            resamling_interval
+        ).sum()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums.iloc[:, :len(columns)].values / sums.iloc[:, len(columns):].values
+        return pd.DataFrame(means, index=sums.index, columns=columns).interpolate('linear').reset_index()
+
+    @staticmethod
+    def __resample(interval_s : int, dataframe : pd.DataFrame) -> pd.DataFrame:
+        """
+        Resamples every trip with numpy, the same as
+        groupby(['id','mmsi']).resample(interval_s).mean().interpolate('linear')
+        with the means of compacted positions weighted by their count.
+        """
+        columns = ['lat', 'long', 'sog', 'cog']
+        trips = dataframe.groupby(['id', 'mmsi'])
+        keys = trips.size().index
+        bin_trip, bin_time, values = resample_trips(
+            trips.ngroup().values,
+            dataframe['time'].values,
+            dataframe[columns].values.astype(float),
+            interval_s,
+            dataframe['count'].values.astype(float) if 'count' in dataframe.columns else None
+        )
+        interpolated = pd.DataFrame({
+            'id' : keys.get_level_values('id')[bin_trip],
+            'mmsi' : keys.get_level_values('mmsi')[bin_trip],
+            'time' : bin_time
+        })
+        interpolated[columns] = values
+        return interpolated
+
     def interpolate_routes(
         self,
         interval_s: int,
@@ -496,48 +797,79 @@ Converting to dataframe".format(time.time() - start), flush=True)
         if self.interpolated_routes is None:
             raise NotdefinedError("interpolated_routes")
         
-        # Interpolate with a given interval
-        ais_inter_day = self.__interpolate(interval_s, self.interpolated_routes)
-        
-        # Shiftes the four columns
-        ais_inter_day_diff = ais_inter_day[
-            ['lat','long','time','id']
-        ].groupby('id').shift(1).add_prefix('next_')
-        
-        # Merges dataframes
-        ais_inter_day_diff = pd.merge(
-            ais_inter_day,
-            ais_inter_day_diff,
-            left_index=True,
-            right_index=True
-        ).dropna()
-        
-        # Calculates the distance between the current point and
-        # the next point
-        ais_inter_day_diff['distance'] = ais_inter_day_diff.apply(
-            lambda row: haversine_vector(
-                (row['lat'], row['long']),
-                (row['next_lat'], row['next_long'])
-            )[0],
-            axis = 1
-        )
         # Remove trips which have points inside the threshold
-        remove_id = ais_inter_day_diff[ais_inter_day_diff['distance'] < threshold]['id'].unique()
-        
-        # Overrid dataframes
-        self.routes = self.routes[~self.routes['id'].isin(remove_id)].copy()
-        self.interpolated_routes = self.interpolated_routes[
-            ~self.interpolated_routes['id'].isin(remove_id)
-        ].copy()
-        
-        # Remove trips which have points which is less the speed amount
-        remove_id = self.interpolated_routes[self.interpolated_routes['sog'] <= speed]['id'].unique()
-        
+        # and trips which have points which is less the speed amount
+        self.filter_trips(
+            min_displacement_km=threshold,
+            displacement_interval_s=interval_s,
+            min_sog=speed
+        )
+
+    def filter_trips(
+        self,
+        min_points : Union[int, None] = None,
+        inside_polygon : bool = False,
+        min_displacement_km : Union[float, None] = None,
+        displacement_interval_s : int = 24*60*60,
+        min_sog : Union[float, None] = None,
+        min_duration_s : Union[float, None] = None
+    ) -> None:
+        """
+        Removes trips from routes and interpolated_routes, with every
+        predicate evaluated in a single pass:
+            min_points: trips with fewer route points.
+            inside_polygon: trips with a route point outside the polygon.
+            min_displacement_km: trips which moved less between the mean
+                positions of two consecutive displacement_interval_s intervals
+                of the interpolated routes.
+            min_sog: trips with an interpolated sog at or below min_sog.
+            min_duration_s: trips which are shorter.
+        The dropped trips are added to dropped_trips with the reason.
+        """
+        # Check if the data has been made
+        if self.routes is None:
+            raise NotdefinedError("routes")
+        if inside_polygon and self.polygon is None:
+            raise NotdefinedError("polygon")
+        if (min_displacement_km is not None or min_sog is not None) and self.interpolated_routes is None:
+            raise NotdefinedError("interpolated_routes")
+
+        start = time.time()
+        routes = self.routes
+        interpolated = self.interpolated_routes
+        trip_filter = TripFilter(
+            routes['id'].values if interpolated is None
+            else np.concatenate([routes['id'].values, interpolated['id'].values])
+        )
+        if min_points is not None:
+            trip_filter.drop('min_points', trip_filter.count(routes) < min_points)
+        if inside_polygon:
+            inside = self.__port_index(
+                PortLookup([self.polygon.values]),
+                routes['lat'].values,
+                routes['long'].values
+            ) >= 0
+            trip_filter.drop('outside_polygon', trip_filter.any(routes, ~inside))
+        if min_displacement_km is not None:
+            trip_filter.drop(
+                'min_displacement',
+                trip_filter.min_displacement(interpolated, displacement_interval_s) < min_displacement_km
+            )
+        if min_sog is not None:
+            trip_filter.drop('min_sog', trip_filter.any(interpolated, (interpolated['sog'] <= min_sog).values))
+        if min_duration_s is not None:
+            trip_filter.drop('min_duration', trip_filter.duration_s(routes) < min_duration_s)
+
         # Overrid dataframes
-        self.routes = self.routes[~self.routes['id'].isin(remove_id)].copy()
-        self.interpolated_routes = self.interpolated_routes[
-            ~self.interpolated_routes['id'].isin(remove_id)
-        ].copy()
+        self.routes = trip_filter.apply(routes)
+        self.interpolated_routes = trip_filter.apply(interpolated)
+        self.dropped_trips = pd.concat([self.dropped_trips, trip_filter.report()], ignore_index=True)
+        if self.verbose:
+            print("Kept {0} of {1} trips ({2:.2f}s)".format(
+                trip_filter.keep.sum(),
+                len(trip_filter.ids),
+                time.time() - start
+            ), flush=True)
 
     def create_waypoints(self, waypoint_amount : int):
         """
@@ -573,13 +905,15 @@ Converting to dataframe".format(time.time() - start), flush=True)
         port_route_copy = port_route_copy.merge(delta_time[['id','length']], left_on='id', right_on='id')
         remove_id = port_route_copy['id'].unique()
         port_route_copy = port_route_copy[port_route_copy['length'] >= 30].reset_index()
-        smallest_time = port_route_copy['length'].min()
-        new_inter = self.__interpolate(int(smallest_time*60/self.waypoint_amount), port_route_copy)
         
         # Remove duplicate interpolations
         interpolated_local = self.interpolated_routes[~self.interpolated_routes['id'].isin(remove_id)]
         # Concatenate with interpolated dataframe
-        interpolated_local = pd.concat( [new_inter, interpolated_local] )
+        # (a small sample of ships can have no trip of 30 minutes to interpolate again)
+        if not port_route_copy.empty:
+            smallest_time = port_route_copy['length'].min()
+            new_inter = self.__interpolate(int(smallest_time*60/self.waypoint_amount), port_route_copy)
+            interpolated_local = pd.concat( [new_inter, interpolated_local] )
         
         # Create waypoints
         start = time.time()
@@ -587,6 +921,109 @@ Converting to dataframe".format(time.time() - start), flush=True)
         if self.verbose:
             print("Created waypoints ({0:.2f}s)".format(time.time() - start), flush=True)
 
+    def create_catalog(self) -> None:
+        """
+        Creates an indexed catalog of the trips in routes, interpolated routes
+        and waypoints, for looking up trips by port pair, mmsi and time.
+        """
+        # Check if the data has been made
+        if self.routes is None:
+            raise NotdefinedError("routes")
+        start = time.time()
+        self.catalog = TripCatalog(
+            routes = self.routes,
+            interpolated_routes = self.interpolated_routes,
+            waypoints = self.waypoints
+        )
+        if self.verbose:
+            print("Created trip catalog ({0:.2f}s)".format(time.time() - start), flush=True)
+
+    def create_spatial_index(self, cell_size : float = 0.1) -> None:
+        """
+        Creates a grid index over the interpolated positions with cells of
+        cell_size degrees, for area and nearest trip queries.
+        """
+        # Check if the data has been made
+        if self.interpolated_routes is None:
+            raise NotdefinedError("interpolated_routes")
+        start = time.time()
+        self.spatial_index = SpatialIndex(self.interpolated_routes, cell_size)
+        if self.verbose:
+            print("Created spatial index ({0:.2f}s)".format(time.time() - start), flush=True)
+
+    def verify_engines(
+        self,
+        mmsi : Union[Iterable[Union[str, int]], None] = None,
+        sample_size : int = 20,
+        speed_limit : float = 3,
+        interval_s : int = 10*60,
+        waypoint_amount : int = 100,
+        tolerance_deg : float = 1e-6,
+        seed : int = 0
+    ) -> pd.DataFrame:
+        """
+        Runs create_routes, interpolate_routes and create_waypoints with every
+        engine on the positions of the ships in mmsi (sample_size random ships
+        by default) and checks that the engines find the same trips with the
+        same ports and positions within tolerance_deg degrees.
+        Returns the time of every step (rows) with every engine (columns).
+        Raises EngineMismatchError if the results differ.
+        """
+        # Check if the data has been imported
+        if self.ais_data is None:
+            raise NotdefinedError("ais_data")
+        if self.ports is None:
+            raise NotdefinedError("ports")
+        if self.port_lookup is None:
+            self.port_lookup = PortLookup(self.ports['polygon'].values)
+
+        if mmsi is None:
+            ships = self.ais_data.index.unique()
+            mmsi = np.random.default_rng(seed).choice(ships, size=min(sample_size, len(ships)), replace=False)
+        sample = self.ais_data[self.ais_data.index.isin({str(ship) for ship in mmsi})]
+        steps = [
+            ('create_routes', {'speed_limit' : speed_limit}),
+            ('interpolate_routes', {'interval_s' : interval_s}),
+            ('create_waypoints', {'waypoint_amount' : waypoint_amount})
+        ]
+        timings : Dict[str, Dict[str, float]] = {}
+        results : Dict[str, clean_ais] = {}
+        for engine in ENGINES:
+            ais_class = clean_ais(verbose=False, engine=engine)
+            ais_class.ais_data = sample
+            ais_class.ports = self.ports
+            # A new lookup, so the cache of earlier lookups does not count
+            ais_class.port_lookup = PortLookup(flat=self.port_lookup.polygons)
+            timings[engine] = {}
+            for step, arguments in steps:
+                # Without trips there is nothing to interpolate
+                if step != 'create_routes' and ais_class.routes.empty:
+                    break
+                start = time.time()
+                getattr(ais_class, step)(**arguments)
+                timings[engine][step] = time.time() - start
+            results[engine] = ais_class
+
+        report = pd.DataFrame(timings).reindex([step for step, _ in steps])
+        report['speedup'] = report['reference'] / report['optimized']
+        mismatches : List[str] = []
+        for name in ('routes', 'interpolated_routes', 'waypoints'):
+            mismatches += compare_trips(
+                name,
+                getattr(results['reference'], name),
+                getattr(results['optimized'], name),
+                tolerance_deg
+            )
+        if self.verbose:
+            print("Verified engines on {0} ships and {1} trips:\n{2}".format(
+                sample.index.nunique(),
+                0 if results['reference'].routes is None else results['reference'].routes['id'].nunique(),
+                report.round(3).to_string()
+            ), flush=True)
+        if mismatches:
+            raise EngineMismatchError(mismatches)
+        return report
+
     def __waypoints(
         self,
         route : pd.DataFrame,
@@ -597,6 +1034,13 @@ Converting to dataframe".format(time.time() - start), flush=True)
         port_info = route.drop(['time','lat','long','sog','cog'], axis = 1)
         port_info = port_info.drop_duplicates()
 
+        if self.engine == 'optimized':
+            return self.__waypoint_means(route, points).merge(
+                port_info,
+                left_on='id',
+                right_on='id'
+            )
+
         # Make a copy of the route dataframe to work on
         z = route[['id','time','lat','long','sog','cog']].copy()
 
@@ -630,3 +1074,24 @@ Converting to dataframe".format(time.time() - start), flush=True)
                 'time_group' : 'time'
             }
         )
+
+    @staticmethod
+    def __waypoint_means(route : pd.DataFrame, points : int) -> pd.DataFrame:
+        """
+        Means of the positions of every trip in points intervals with numpy,
+        the same as the pandas version of __waypoints.
+        """
+        columns = ['lat', 'long', 'sog', 'cog']
+        ids, trip = np.unique(route['id'].values, return_inverse=True)
+        bin_trip, bin_start, values = waypoint_bins(
+            trip,
+            route['time'].values,
+            route[columns].values.astype(float),
+            points
+        )
+        waypoints = pd.DataFrame({
+            'id' : ids[bin_trip],
+            'time' : pd.to_datetime(bin_start, unit='s')
+        })
+        waypoints[columns] = values
+        return waypoints
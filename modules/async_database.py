@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Module for asynchronous connections with a PostgreSQL Database.
+
+AsyncDatabase uses the asyncpg driver with a pool of connections.
+ThreadedDatabase gives the same interface on top of a pool of the
+synchronous Database class, for when asyncpg is not installed.
+Any object with the coroutines connect, disconnect and execute_sql
+(e.g. an in-process fake) can be used by the asynchronous fetchers.
+"""
+import asyncio
+from typing import List, Union
+from modules.database import Database
+from modules.errors import ConnectionDBError, TransientDBError
+
+try:
+    import asyncpg                                  # type: ignore
+except ImportError:
+    asyncpg = None
+
+# SQLSTATE classes of errors which can succeed when tried again: connection
+# exceptions and operator intervention (e.g. the server shuts down)
+TRANSIENT_SQLSTATES = ('08', '57')
+# SQLSTATE class of insufficient resources (e.g. too many connections)
+RATE_LIMIT_SQLSTATE = '53'
+
+def _database_error(exc : Exception, message : str) -> ConnectionDBError:
+    """
+    The error to raise for exc: TransientDBError if the database is out of
+    resources or for network and connection errors and ConnectionDBError
+    otherwise (e.g. SQL syntax errors).
+    """
+    sqlstate = str(getattr(exc, 'sqlstate', None) or '')
+    if sqlstate.startswith(RATE_LIMIT_SQLSTATE):
+        return TransientDBError("The database is out of resources")
+    if sqlstate[:2] in TRANSIENT_SQLSTATES:
+        return TransientDBError(message)
+    if isinstance(exc, (OSError, asyncio.TimeoutError, asyncpg.InterfaceError)):
+        return TransientDBError(message)
+    return ConnectionDBError(message)
+
+class AsyncDatabase():
+    """
+    Asynchronous PostgreSQL Database class using asyncpg.
+    """
+    #pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        host : str,
+        database_name : str,
+        port : str,
+        username : str,
+        password : str,
+        pool_size : int = 4
+        ):
+        if asyncpg is None:
+            raise ImportError("AsyncDatabase needs asyncpg, use ThreadedDatabase without it")
+        self.host = host
+        self.database_name = database_name
+        self.port = port
+        self.username = username
+        self.password = password
+        self.pool_size = pool_size
+        self._pool = None
+
+    async def connect(self):
+        """ Connect to a Postgres database."""
+        if self._pool is None:
+            try:
+                self._pool = await asyncpg.create_pool(
+                    host=self.host,
+                    database=self.database_name,
+                    port=self.port,
+                    user=self.username,
+                    password=self.password,
+                    min_size=1,
+                    max_size=self.pool_size
+                )
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+                await self.disconnect()
+                raise _database_error(exc, "Failed to connect with the Postgres database") from exc
+
+    async def disconnect(self):
+        """ Disconnect to a Postgres database."""
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def execute_sql(self, sql : str) -> Union[List[tuple], None]:
+        """
+        Executes sql on the Postgres database.
+        Errors are raised as ConnectionDBError, errors which can succeed
+        when tried again as its subclass TransientDBError.
+        """
+        if self._pool is None:
+            return None
+        try:
+            records = await self._pool.fetch(sql)
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+            raise _database_error(exc, "Failed to execute sql") from exc
+        return [tuple(record) for record in records]
+
+class ThreadedDatabase():
+    """
+    Asynchronous interface over a pool of synchronous Database connections.
+    Every query runs in a thread, so pool_size queries can run at once.
+    """
+    #pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        host : str,
+        database_name : str,
+        port : str,
+        username : str,
+        password : str,
+        pool_size : int = 4
+        ):
+        self.login_info = {
+            'host' : host,
+            'database_name' : database_name,
+            'port' : port,
+            'username' : username,
+            'password' : password
+        }
+        self.pool_size = pool_size
+        self._connections : List[Database] = []
+        self._free : Union[asyncio.Queue, None] = None
+
+    async def connect(self):
+        """ Connect to a Postgres database with pool_size connections."""
+        if self._free is None:
+            loop = asyncio.get_running_loop()
+            self._free = asyncio.Queue()
+            for _ in range(self.pool_size):
+                database = Database(**self.login_info)
+                self._connections.append(database)
+                await loop.run_in_executor(None, database.connect)
+                self._free.put_nowait(database)
+
+    async def disconnect(self):
+        """ Disconnect to a Postgres database."""
+        for database in self._connections:
+            database.disconnect()
+        self._connections = []
+        self._free = None
+
+    async def execute_sql(self, sql : str) -> Union[List[tuple], None]:
+        """ Executes sql on the Postgres database."""
+        if self._free is None:
+            return None
+        database = await self._free.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self.__execute, database, sql)
+        finally:
+            self._free.put_nowait(database)
+
+    @staticmethod
+    def __execute(database : Database, sql : str) -> Union[List[tuple], None]:
+        """ Executes sql and reconnects first if a failed query closed the connection."""
+        database.connect()
+        return database.execute_sql(sql)
+
+def async_database(
+    host : str,
+    database_name : str,
+    port : str,
+    username : str,
+    password : str,
+    pool_size : int = 4
+    ) -> Union[AsyncDatabase, ThreadedDatabase]:
+    """AsyncDatabase if asyncpg is installed, else ThreadedDatabase."""
+    database_class = AsyncDatabase if asyncpg is not None else ThreadedDatabase
+    return database_class(host, database_name, port, username, password, pool_size)
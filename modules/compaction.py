@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Run-length compaction of stationary positions.
+
+A run is consecutive positions of a ship with a speed of at most max_sog
+in the same square cell inside the same port. Only the first and last
+position of a run are kept, so the first and last time and position of
+every port visit stay the same. Positions outside ports are never
+compacted, as they are the points of the trips. The first position of a
+run counts the positions it replaces.
+"""
+from typing import Tuple
+import numpy as np                                                              # type: ignore
+
+# Length of a degree of latitude in metres
+DEGREE_M = 111320
+
+def stationary_runs(
+    ships : np.ndarray,
+    lat : np.ndarray,
+    long : np.ndarray,
+    sog : np.ndarray,
+    port : np.ndarray,
+    max_sog : float = 0.5,
+    cell_m : float = 50
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the mask of the positions to keep and the number of positions
+    every kept position stands for.
+    The positions must be sorted by ship and time, port is the port index
+    of every position (-1 outside ports, where positions are kept).
+    """
+    size = len(ships)
+    if size == 0:
+        return np.ones(0, dtype=bool), np.ones(0, dtype=np.int64)
+    cell_deg = cell_m / DEGREE_M
+    with np.errstate(invalid='ignore'):
+        row = np.floor(lat / cell_deg)
+        column = np.floor(long / cell_deg)
+        stationary = sog <= max_sog
+    # Missing positions never join a run
+    stationary &= np.isfinite(row) & np.isfinite(column)
+
+    same = (
+        (ships[1:] == ships[:-1]) & (port[1:] == port[:-1]) & (port[1:] >= 0)
+        & (row[1:] == row[:-1]) & (column[1:] == column[:-1])
+        & stationary[1:] & stationary[:-1]
+    )
+    run_start = np.flatnonzero(np.r_[True, ~same])
+    run_end = np.r_[run_start[1:], size] - 1
+
+    keep = np.zeros(size, dtype=bool)
+    keep[run_start] = True
+    keep[run_end] = True
+    count = np.ones(size, dtype=np.int64)
+    # The first position counts itself and the removed positions
+    count[run_start] = np.maximum(run_end - run_start, 1)
+    return keep, count[keep]
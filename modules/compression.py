@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Compressed day files.
+
+Day files can be saved as plain csv (.csv), gzip (.csv.gz) or
+zstandard (.csv.zst). The functions here open any of them by their
+extension, so readers do not have to care how a day was saved.
+zstandard is optional and only needed for .csv.zst files.
+"""
+import gzip
+import io
+from typing import BinaryIO, TextIO, Union
+from modules.errors import WrongArguments
+
+try:
+    import zstandard                                # type: ignore
+except ImportError:
+    zstandard = None
+
+# Extension added after .csv for every compression
+COMPRESSIONS = {
+    None : '',
+    'gzip' : '.gz',
+    'zstd' : '.zst',
+}
+DAY_FILE_EXTENSIONS = tuple('.csv' + suffix for suffix in COMPRESSIONS.values())
+
+def compression_of(file_path : str) -> Union[str, None]:
+    """Returns the compression of a file from its extension."""
+    for compression, suffix in COMPRESSIONS.items():
+        if suffix and file_path.endswith(suffix):
+            return compression
+    return None
+
+def day_file_name(day : str, compression : Union[str, None] = None) -> str:
+    """Returns the file name of a day file (YYYY-MM-DD.csv[.gz|.zst])."""
+    if compression not in COMPRESSIONS:
+        raise WrongArguments(
+            "compression was {0}, but should be one of the following {1}".format(
+                compression,
+                list(COMPRESSIONS)
+            )
+        )
+    return day + '.csv' + COMPRESSIONS[compression]
+
+def _zstandard():
+    """Returns the zstandard module or raises if it is not installed."""
+    if zstandard is None:
+        raise ImportError("zstandard is needed for .csv.zst files (pip install zstandard)")
+    return zstandard
+
+def open_binary(file_path : str, mode : str = 'rb', compression : Union[str, None] = None) -> BinaryIO:
+    """
+    Opens a file for streaming binary reads ('rb') or writes ('wb').
+    The compression is found from the extension of file_path if it is not given.
+    """
+    compression = compression if compression is not None else compression_of(file_path)
+    if compression == 'gzip':
+        return gzip.open(file_path, mode, compresslevel=6)
+    if compression == 'zstd':
+        if mode == 'wb':
+            return _zstandard().ZstdCompressor(level=3, threads=-1).stream_writer(
+                open(file_path, 'wb'), closefd=True
+            )
+        # Buffered so the lines of the file can be iterated
+        return io.BufferedReader(
+            _zstandard().ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+        )
+    return open(file_path, mode)
+
+def open_text(file_path : str, mode : str = 'rt', compression : Union[str, None] = None) -> TextIO:
+    """Opens a file for streaming text reads ('rt') or writes ('wt')."""
+    return io.TextIOWrapper(
+        open_binary(file_path, mode.replace('t', '') + 'b', compression),
+        newline=''
+    )
+
+def read_bytes(file_path : str) -> bytes:
+    """
+    Reads and decompresses a whole file.
+    The file is decompressed with a single call, which releases the GIL,
+    so files can be decompressed in parallel by threads.
+    """
+    compression = compression_of(file_path)
+    with open(file_path, 'rb') as day_file:
+        content = day_file.read()
+    if compression == 'gzip':
+        return gzip.decompress(content)
+    if compression == 'zstd':
+        return _zstandard().ZstdDecompressor().decompressobj().decompress(content)
+    return content
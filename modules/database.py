@@ -2,10 +2,30 @@
 """
 Module for connection with a PostgreSQL Database .
 """
-from typing import Union
+from typing import List, Union
 import psycopg2                                     # type: ignore
-import pandas as pd                                 # type: ignore
-from modules.errors import ConnectionDBError
+from modules.errors import ConnectionDBError, TransientDBError
+
+# SQLSTATE class of insufficient resources (e.g. too many connections)
+RATE_LIMIT_SQLSTATE = '53'
+# Errors of the connection which can succeed when tried again
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+def _is_rate_limited(exc : Exception) -> bool:
+    """Checks if the database refused the request because it is out of resources."""
+    return str(getattr(exc, 'pgcode', None) or '').startswith(RATE_LIMIT_SQLSTATE)
+
+def _database_error(exc : Exception, message : str) -> ConnectionDBError:
+    """
+    The error to raise for exc: TransientDBError if the database is out of
+    resources or for TRANSIENT_ERRORS and ConnectionDBError otherwise
+    (e.g. SQL syntax errors).
+    """
+    if _is_rate_limited(exc):
+        return TransientDBError("The database is out of resources")
+    if isinstance(exc, TRANSIENT_ERRORS):
+        return TransientDBError(message)
+    return ConnectionDBError(message)
 
 class Database():
     """
@@ -39,23 +59,29 @@ class Database():
                     user=self.username,
                     password=self.password
                 )
-            except psycopg2.DatabaseError as exc:
+            except psycopg2.Error as exc:
                 self.disconnect()
-                raise ConnectionDBError() from exc
+                raise _database_error(exc, "Failed to connect with the Postgres database") from exc
 
     def disconnect(self):
         """ Disconnect to a Postgres database."""
         if self._conn is not None:
             self._conn.close()
+            self._conn = None
 
     def __cursor_counter(self) -> str:
         """ Counts cursors so they do not overlap."""
         self._counter += 1
         return str(self._counter)
 
-    def execute_sql(self, sql : str) -> Union[pd.DataFrame, None]:
-        """ Executes sql on the Postgres database."""
+    def execute_sql(self, sql : str) -> Union[List[tuple], None]:
+        """
+        Executes sql on the Postgres database.
+        Errors are raised as ConnectionDBError, errors which can succeed
+        when tried again as its subclass TransientDBError.
+        """
         data = None
+        cur = None
         if self._conn is not None:
             try:
                 cur = self._conn.cursor(self.__cursor_counter())
@@ -63,13 +89,13 @@ class Database():
                 data = cur.fetchall()
                 cur.close()
             #pylint disable=broad-except
-            except (Exception, psycopg2.DatabaseError) as exc:
-                if not cur.closed:
+            except Exception as exc:
+                if cur is not None and not cur.closed:
                     cur.close()
                 self.disconnect()
-                raise ConnectionDBError("Failed to execute sql") from exc
+                raise _database_error(exc, "Failed to execute sql") from exc
         return data
 
     def closed(self):
         """Check if the connection is closed."""
-        return self._conn.closed
+        return self._conn is None or self._conn.closed
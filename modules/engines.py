@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Engines of clean_ais.
+
+The reference engine is the original pandas and matplotlib code: ports
+are found with mask_from_polygons and routes are resampled with
+groupby().resample(). The optimized engine uses the cached port lookup
+with the compiled polygon kernel and resamples with numpy (see
+modules/resample.py).
+
+compare_trips checks the results of two engines trip by trip, so a new
+engine can be verified against the reference on a sample of ships before
+it is used.
+"""
+from typing import List, Union
+import numpy as np                                                              # type: ignore
+import pandas as pd                                                             # type: ignore
+from modules.errors import WrongArguments
+from modules.points_in_polygons.points_in_polygons import mask_from_polygons
+from modules.polygon_kernel import FlatPolygons
+
+ENGINES = ('reference', 'optimized')
+# Columns with the positions of routes, interpolated routes and waypoints
+POSITION_COLUMNS = ('lat', 'long')
+# Columns with the ports of a trip
+PORT_COLUMNS = ('from_locode', 'to_locode')
+
+def check_engine(engine : str) -> str:
+    """Raises WrongArguments if engine is not one of ENGINES."""
+    if engine not in ENGINES:
+        raise WrongArguments("Unknown engine {0}, use one of {1}".format(engine, ', '.join(ENGINES)))
+    return engine
+
+def reference_port_index(lat : np.ndarray, long : np.ndarray, flat : FlatPolygons) -> np.ndarray:
+    """
+    Index of the polygon every position is inside of (-1 outside every
+    polygon) with mask_from_polygons. Holes are not inside the polygon and
+    if a position is inside more than one polygon the first one is used.
+    """
+    ring_start = np.searchsorted(flat.ring_polygon, np.arange(flat.polygon_amount + 1))
+    polygons = []
+    polygons_in = []
+    for k in range(flat.polygon_amount):
+        rings = range(ring_start[k], ring_start[k + 1])
+        polygons.append([np.asarray(flat.vertices[flat.ring_offsets[r]:flat.ring_offsets[r + 1]]) for r in rings])
+        polygons_in.append([bool(flat.ring_hole[r]) for r in rings])
+    masks = mask_from_polygons(np.asarray(lat), np.asarray(long), polygons, polygons_in, include_holes=False)
+    port_index = np.full(len(lat), -1, dtype=np.int64)
+    # Later polygons are overwritten by earlier ones
+    for indexes, k in reversed(masks):
+        port_index[indexes] = k
+    return port_index
+
+def compare_trips(
+    name : str,
+    reference : Union[pd.DataFrame, None],
+    optimized : Union[pd.DataFrame, None],
+    tolerance_deg : float = 1e-6
+) -> List[str]:
+    """
+    Compares the trips of two engines: the trip ids, the ports of every
+    trip, the number and times of the positions and the positions within
+    tolerance_deg degrees. Returns a description of every difference.
+    """
+    if reference is None or optimized is None:
+        return [] if reference is None and optimized is None else ["{0}: only made by one engine".format(name)]
+    mismatches = []
+    reference_ids = set(reference['id'].unique())
+    optimized_ids = set(optimized['id'].unique())
+    if reference_ids != optimized_ids:
+        return ["{0}: trips only in reference {1}, only in optimized {2}".format(
+            name, sorted(reference_ids - optimized_ids)[:10], sorted(optimized_ids - reference_ids)[:10]
+        )]
+    # Without trips (e.g. a sample of ships which did not sail between ports)
+    if not reference_ids:
+        return mismatches
+
+    for column in PORT_COLUMNS:
+        if column in reference and column in optimized:
+            ports = pd.concat(
+                [reference.groupby('id')[column].first(), optimized.groupby('id')[column].first()],
+                axis=1, keys=['reference', 'optimized']
+            )
+            different = ports.index[ports['reference'] != ports['optimized']]
+            if len(different):
+                mismatches.append("{0}: {1} differs for trips {2}".format(name, column, list(different[:10])))
+
+    reference = reference.sort_values(['id', 'time'], kind='mergesort')
+    optimized = optimized.sort_values(['id', 'time'], kind='mergesort')
+    if len(reference) != len(optimized):
+        mismatches.append("{0}: {1} positions in reference, {2} in optimized".format(
+            name, len(reference), len(optimized)
+        ))
+        return mismatches
+    if not np.array_equal(reference['time'].values, optimized['time'].values):
+        mismatches.append("{0}: the times of the positions differ".format(name))
+    for column in POSITION_COLUMNS:
+        difference = np.abs(reference[column].values - optimized[column].values)
+        outside = (difference > tolerance_deg) | (np.isnan(reference[column].values) != np.isnan(optimized[column].values))
+        if outside.any():
+            mismatches.append("{0}: {1} positions differ more than {2} degrees in {3} (up to {4:.3g})".format(
+                name, int(outside.sum()), tolerance_deg, column, np.nanmax(difference)
+            ))
+    return mismatches
@@ -94,9 +94,22 @@ class ConnectionDBError(Error):
         self.message = message
         super().__init__(self.message)
 
+class TransientDBError(ConnectionDBError):
+    """When a request to a Postgres database fails but can succeed when tried again."""
+    def __init__(self, message: str = "The Postgres database is temporarily unavailable"):
+        self.message = message
+        super().__init__(self.message)
+
 class NotdefinedError(Error):
     """When a variable is not defined or is None and should not be."""
     def __init__(self, variable : str):
         self.message = "{0} does not exist or is None and shouldnt be.".format(variable)
         super().__init__(self.message)
-        
\ No newline at end of file
+        
+
+class EngineMismatchError(Error):
+    """When the engines of clean_ais give different results."""
+    def __init__(self, mismatches : list):
+        self.mismatches = mismatches
+        self.message = "The engines gave different results:\n{0}".format('\n'.join(mismatches))
+        super().__init__(self.message)
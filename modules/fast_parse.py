@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""
+Vectorized parsing of AIS day files.
+
+A day file has one fixed format (mmsi;YYYY-MM-DD HH:MM:SS;long;lat;sog;cog),
+so the fields are found with numpy in the bytes of the whole file and put
+in a zero padded byte matrix per column. Timestamps and decimals are then
+converted with byte arithmetic on the matrix columns, without a Python
+string per field. Decimals are converted like pd.to_numeric (the first 17
+digits are accumulated and divided by a power of ten), so the values are
+identical to the pandas conversion. Fields which do not have the fixed
+format are converted by pandas.
+
+Run as a script to compare the speed with csv.reader and pandas:
+python modules/fast_parse.py AIS/Oestersoe/cargo/2021-04-03.csv
+"""
+import csv
+import io
+from typing import List, Tuple, Union
+import numpy as np                                                              # type: ignore
+import pandas as pd                                                             # type: ignore
+from modules.sampling import in_sample
+
+COLUMNS = ("mmsi", "time", "long", "lat", "sog", "cog")
+DECIMAL_COLUMNS = ["lat", "long", "sog", "cog"]
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Digits accumulated by pandas (precise_xstrtod), the rest only scale the value
+MAX_DIGITS = 17
+# Wider fields are left to pandas
+MAX_WIDTH = 64
+# Powers of ten as the literals used by pandas
+POWERS_OF_TEN = np.array([float('1e{0}'.format(k)) for k in range(MAX_WIDTH + 1)])
+# Byte position of the digits and separators of YYYY-MM-DD HH:MM:SS
+TIME_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+TIME_SEPARATORS = {4 : b'-', 7 : b'-', 10 : b' ', 13 : b':', 16 : b':'}
+
+def split_fields(
+    content : bytes,
+    fields : int = len(COLUMNS),
+    delimiter : bytes = b';'
+) -> Union[Tuple[np.ndarray, np.ndarray, np.ndarray], None]:
+    """
+    Finds the fields of all lines of content.
+    Returns the bytes and the (lines, fields) start and end of every field,
+    or None if a line does not have fields fields or a field is quoted.
+    Empty lines are skipped and line ends can be \\n or \\r\\n.
+    """
+    if b'"' in content:
+        return None
+    buffer = np.frombuffer(content, dtype=np.uint8)
+    line_end = np.flatnonzero(buffer == ord('\n'))
+    if len(buffer) and buffer[-1] != ord('\n'):
+        line_end = np.r_[line_end, len(buffer)]
+    line_start = np.r_[0, line_end[:-1] + 1] if len(line_end) else line_end
+    # Without the \r of \r\n
+    carriage = np.zeros(len(line_end), dtype=bool)
+    carriage[line_end > line_start] = buffer[line_end[line_end > line_start] - 1] == ord('\r')
+    line_end = line_end - carriage
+    not_empty = line_end > line_start
+    line_start, line_end = line_start[not_empty], line_end[not_empty]
+
+    separator = np.flatnonzero(buffer == ord(delimiter))
+    if len(separator) != len(line_start) * (fields - 1):
+        return None
+    separator = separator.reshape(-1, fields - 1)
+    # Every line must have its own separators
+    if len(separator) and (
+        np.any(separator[:, 0] < line_start) or np.any(separator[:, -1] >= line_end)
+    ):
+        return None
+    starts = np.column_stack([line_start, separator + 1])
+    ends = np.column_stack([separator, line_end])
+    return buffer, starts, ends
+
+def byte_matrix(buffer : np.ndarray, starts : np.ndarray, ends : np.ndarray) -> np.ndarray:
+    """Fields from start to end as rows of bytes padded with zeros."""
+    lengths = ends - starts
+    width = int(lengths.max()) if len(lengths) else 0
+    if width == 0:
+        return np.zeros((len(starts), 0), dtype=np.uint8)
+    # Every field is copied as one slice of the buffer
+    if int(starts.max()) + width > len(buffer):
+        buffer = np.concatenate([buffer, np.zeros(width, dtype=np.uint8)])
+    matrix = np.lib.stride_tricks.sliding_window_view(buffer, width)[starts]
+    matrix *= np.arange(width) < lengths[:, None]
+    return matrix
+
+def _running_sum(rows : np.ndarray) -> np.ndarray:
+    """Running sum over the rows of a boolean matrix (faster than np.cumsum for few rows)."""
+    total = rows.astype(np.int8)
+    for row in range(1, len(total)):
+        total[row] += total[row - 1]
+    return total
+
+def _as_strings(matrix : np.ndarray) -> np.ndarray:
+    """Fields of a byte matrix as str."""
+    if matrix.shape[1] == 0:
+        return np.full(len(matrix), '', dtype=object)
+    return np.ascontiguousarray(matrix).view('S{0}'.format(matrix.shape[1])).ravel().astype(str)
+
+def parse_strings(matrix : np.ndarray) -> np.ndarray:
+    """
+    Fields of a byte matrix as str objects. Repeated fields (like the mmsi
+    of a ship) share one str.
+    """
+    if matrix.shape[1] == 0:
+        return np.full(len(matrix), '', dtype=object)
+    values, inverse = np.unique(
+        np.ascontiguousarray(matrix).view('S{0}'.format(matrix.shape[1])).ravel(),
+        return_inverse=True
+    )
+    return values.astype(str).astype(object)[inverse]
+
+def sample_rows(matrix : np.ndarray, fraction : float, seed : int = 0) -> np.ndarray:
+    """
+    Mask of the rows whose mmsi (byte matrix) is in the sample, chosen from
+    the bytes before any conversion.
+    """
+    if matrix.shape[1] == 0:
+        return np.repeat(in_sample([b''], fraction, seed), len(matrix))
+    ships, inverse = np.unique(
+        np.ascontiguousarray(matrix).view('S{0}'.format(matrix.shape[1])).ravel(),
+        return_inverse=True
+    )
+    return in_sample(ships, fraction, seed)[inverse]
+
+def parse_decimals(matrix : np.ndarray) -> np.ndarray:
+    """
+    Decimals ([+-]digits[.digits]) of a byte matrix as floats, the same
+    values as pd.to_numeric. Other fields are converted by pd.to_numeric
+    (NaN if they are not numbers).
+    """
+    size, width = matrix.shape
+    number = np.zeros(size)
+    valid = np.zeros(size, dtype=bool)
+    if 0 < width <= MAX_WIDTH:
+        # One row per byte position, so every step works on contiguous rows
+        columns = np.ascontiguousarray(matrix.T)
+        digit = (columns >= ord('0')) & (columns <= ord('9'))
+        dot = columns == ord('.')
+        used = columns != 0
+        negative = columns[0] == ord('-')
+        sign = negative | (columns[0] == ord('+'))
+        rank = _running_sum(digit)
+        decimal_part = _running_sum(dot)
+        valid = (
+            np.all(digit[1:] | dot[1:] | ~used[1:], axis=0)
+            & (digit[0] | dot[0] | sign)
+            & (decimal_part[-1] <= 1)
+            & (rank[-1] > 0)
+            # Zeros only as padding after the field
+            & np.all(used[:-1] | ~used[1:], axis=0)
+        )
+
+        counted = digit & (rank <= MAX_DIGITS)
+        # Uncounted integer digits scale up, counted decimals scale down
+        exponent = (
+            (digit & ~counted & (decimal_part == 0)).sum(axis=0)
+            - (counted & (decimal_part > 0)).sum(axis=0)
+        )
+        for position in range(width):
+            # number * 10 + digit for counted digits, number * 1 + 0 for the rest
+            number *= 1 + 9 * counted[position]
+            number += (columns[position] - ord('0')) * counted[position]
+        number = np.where(
+            exponent > 0,
+            number * POWERS_OF_TEN[np.maximum(exponent, 0)],
+            number / POWERS_OF_TEN[np.maximum(-exponent, 0)]
+        )
+        number[negative] *= -1
+
+    if not valid.all():
+        invalid = np.flatnonzero(~valid)
+        number[invalid] = pd.to_numeric(
+            pd.Series(_as_strings(matrix[invalid]), dtype=object), errors='coerce'
+        ).to_numpy(dtype=float)
+    return number
+
+def parse_timestamps(matrix : np.ndarray) -> Union[np.ndarray, None]:
+    """
+    Timestamps (YYYY-MM-DD HH:MM:SS) of a byte matrix as int64 seconds
+    since 1970-01-01, or None if a field is not a valid timestamp.
+    """
+    size, width = matrix.shape
+    if width != 19:
+        return None if size else np.zeros(0, dtype=np.int64)
+    digits = matrix[:, TIME_DIGITS].astype(np.int64) - ord('0')
+    if np.any((digits < 0) | (digits > 9)):
+        return None
+    for position, separator in TIME_SEPARATORS.items():
+        if np.any(matrix[:, position] != ord(separator)):
+            return None
+    value = digits[:, 0::2] * 10 + digits[:, 1::2]
+    year = value[:, 0] * 100 + value[:, 1]
+    month, day, hour, minute, second = value[:, 2:].T
+
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+    if np.any((month < 1) | (month > 12)):
+        return None
+    if np.any((day < 1) | (day > month_days[month - 1] + (leap & (month == 2)))):
+        return None
+    if np.any((hour > 23) | (minute > 59) | (second > 59)):
+        return None
+
+    # Days since 1970-01-01 of the proleptic Gregorian calendar
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+    return days * 86400 + hour * 3600 + minute * 60 + second
+
+def rows_frame(rows : List[List[str]]) -> pd.DataFrame:
+    """
+    AIS rows as a dataframe indexed by mmsi, converted with pandas.
+    """
+    ais_data = pd.DataFrame(rows, columns=list(COLUMNS)).set_index('mmsi')
+    # Change types from string to float/datetime
+    ais_data[DECIMAL_COLUMNS] = ais_data[DECIMAL_COLUMNS].apply(pd.to_numeric, errors='coerce')
+    ais_data["time"] = pd.to_datetime(ais_data["time"], format=TIME_FORMAT)
+    return ais_data
+
+def day_file_frame(
+    content : bytes,
+    sample_fraction : Union[float, None] = None,
+    sample_seed : int = 0
+) -> pd.DataFrame:
+    """
+    The rows of a day file as a dataframe indexed by mmsi.
+    With sample_fraction only the rows of the ships in the sample (see
+    modules/sampling.py) are converted.
+    Files which are not in the fixed format are read by csv.reader and
+    converted with pandas.
+    """
+    fields = split_fields(content)
+    if fields is None:
+        rows = list(csv.reader(io.StringIO(content.decode()), delimiter=';'))
+        if sample_fraction is not None:
+            ships, inverse = np.unique([row[0] if row else '' for row in rows], return_inverse=True)
+            keep = in_sample(ships, sample_fraction, sample_seed)[inverse]
+            rows = [row for row, kept in zip(rows, keep) if kept]
+        return rows_frame(rows)
+    buffer, starts, ends = fields
+    if sample_fraction is not None:
+        keep = sample_rows(byte_matrix(buffer, starts[:, 0], ends[:, 0]), sample_fraction, sample_seed)
+        starts, ends = starts[keep], ends[keep]
+    matrices = [byte_matrix(buffer, starts[:, k], ends[:, k]) for k in range(len(COLUMNS))]
+    seconds = parse_timestamps(matrices[1])
+    if seconds is None:
+        # pandas raises the error of the first invalid timestamp
+        time_column = pd.to_datetime(
+            pd.Series(_as_strings(matrices[1]), dtype=object), format=TIME_FORMAT
+        ).to_numpy()
+    else:
+        time_column = seconds.astype('datetime64[s]').astype('datetime64[ns]')
+    ais_data = pd.DataFrame(
+        {
+            "time" : time_column,
+            "long" : parse_decimals(matrices[2]),
+            "lat" : parse_decimals(matrices[3]),
+            "sog" : parse_decimals(matrices[4]),
+            "cog" : parse_decimals(matrices[5])
+        },
+        index=pd.Index(parse_strings(matrices[0]), name="mmsi")
+    )
+    return ais_data
+
+if __name__ == "__main__":
+    import sys
+    import time
+    content = b''.join(open(file_path, 'rb').read() for file_path in sys.argv[1:])
+
+    start = time.time()
+    rows = list(csv.reader(io.StringIO(content.decode()), delimiter=';'))
+    read = time.time() - start
+    expected = rows_frame(rows)
+    pandas_time = time.time() - start
+    start = time.time()
+    result = day_file_frame(content)
+    numpy_time = time.time() - start
+
+    print("Rows: {0}".format(len(result)))
+    print("csv.reader + pandas: {0:.3f}s ({1:.3f}s reading)".format(pandas_time, read))
+    print("Byte parser: {0:.3f}s ({1:.1f}x)".format(numpy_time, pandas_time / max(numpy_time, 1e-9)))
+    print("Identical: {0}".format(result.equals(expected[result.columns])))
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Sidecar indexes for AIS day files.
+
+Every day file written by get_ais_data has the layout
+mmsi;time;long;lat;sog;cog and gets an index file next to it
+(<day file>.idx). The index holds the byte spans of every mmsi in the
+day file together with the time range and the lat/long bounding box of
+the span, so import_ais can read only the rows it needs.
+For compressed day files the byte spans refer to the decompressed text.
+"""
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple, Union
+from modules.errors import PathError
+from modules.operating_system import OperatingSystem
+from modules.compression import DAY_FILE_EXTENSIONS, compression_of, open_binary, read_bytes
+
+INDEX_SUFFIX = '.idx'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Bounding boxes are given as (lat_min, long_min, lat_max, long_max)
+BoundingBox = Tuple[float, float, float, float]
+TimeLike = Union[str, datetime, None]
+
+def index_path(file_path : str) -> str:
+    """Returns the path of the sidecar index for a day file."""
+    return file_path + INDEX_SUFFIX
+
+def _new_span(start : int, mmsi : str) -> dict:
+    """Creates an empty span starting at byte start."""
+    return {
+        'mmsi' : mmsi,
+        'start' : start,
+        'end' : start,
+        'rows' : 0,
+        'time' : [None, None],
+        'bbox' : [None, None, None, None],
+    }
+
+def _update_range(span : dict, timestamp : str, lat : float, long : float) -> None:
+    """Extends the time range and bounding box of span with a row."""
+    if timestamp:
+        if span['time'][0] is None or timestamp < span['time'][0]:
+            span['time'][0] = timestamp
+        if span['time'][1] is None or timestamp > span['time'][1]:
+            span['time'][1] = timestamp
+    # NaN compares False so missing coordinates never extend the box
+    if lat == lat and long == long:
+        bbox = span['bbox']
+        if bbox[0] is None:
+            span['bbox'] = [lat, long, lat, long]
+        else:
+            bbox[0] = min(bbox[0], lat)
+            bbox[1] = min(bbox[1], long)
+            bbox[2] = max(bbox[2], lat)
+            bbox[3] = max(bbox[3], long)
+
+def _to_float(value : bytes) -> float:
+    """Converts a csv field to float (NaN if it is empty or invalid)."""
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+def build_index(file_path : str) -> dict:
+    """
+    Scans a day file and returns its index.
+    Consecutive rows of the same mmsi form one span, so a file sorted by
+    mmsi has exactly one span per ship.
+    """
+    spans : List[dict] = []
+    span = None
+    summary = _new_span(0, '')
+    offset = 0
+    with open_binary(file_path) as day_file:
+        for line in day_file:
+            fields = line.rstrip(b'\r\n').split(b';')
+            if len(fields) >= 4:
+                mmsi = fields[0].decode()
+                if span is None or span['mmsi'] != mmsi:
+                    span = _new_span(offset, mmsi)
+                    spans.append(span)
+                timestamp = fields[1].decode()
+                lat = _to_float(fields[3])
+                long = _to_float(fields[2])
+                _update_range(span, timestamp, lat, long)
+                _update_range(summary, timestamp, lat, long)
+                span['rows'] += 1
+                span['end'] = offset + len(line)
+            offset += len(line)
+
+    ships : Dict[str, List[list]] = {}
+    for span in spans:
+        ships.setdefault(span['mmsi'], []).append(
+            [span['start'], span['end'], span['rows'], span['time'], span['bbox']]
+        )
+    # The size on disk is used to check that the index matches the file
+    return {
+        'size' : os.path.getsize(file_path),
+        'rows' : sum(span['rows'] for span in spans),
+        'time' : summary['time'],
+        'bbox' : summary['bbox'],
+        'ships' : ships,
+    }
+
+def write_index(file_path : str) -> dict:
+    """
+    Builds the index of a day file and saves it next to the file.
+    The index is written to a temporary file first and then renamed,
+    so a reader never sees a half written index.
+    """
+    index = build_index(file_path)
+    temporary_path = index_path(file_path) + '.tmp'
+    with open(temporary_path, 'w') as index_file:
+        json.dump(index, index_file, separators=(',', ':'))
+    os.replace(temporary_path, index_path(file_path))
+    return index
+
+def read_index(file_path : str) -> Union[dict, None]:
+    """
+    Reads the index of a day file.
+    Returns None if there is no index or if it does not match the file.
+    """
+    path = index_path(file_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as index_file:
+        index = json.load(index_file)
+    if index.get('size') != os.path.getsize(file_path):
+        return None
+    return index
+
+def index_folder(folder_path : str, verbose : bool = True) -> None:
+    """Writes an index for every day file in a folder which is missing one."""
+    operating_system = OperatingSystem()
+    if not operating_system.check_file(folder_path):
+        raise PathError(folder_path)
+    for file in operating_system.get_files(folder_path, extensions=DAY_FILE_EXTENSIONS):
+        file_path = operating_system.path(folder_path, file)
+        if read_index(file_path) is None:
+            write_index(file_path)
+            if verbose:
+                print("Indexed {0}".format(file), flush=True)
+
+def format_time(value : TimeLike) -> Union[str, None]:
+    """Converts a time to the format used in the day files."""
+    if value is None or isinstance(value, str):
+        return value
+    return value.strftime(TIME_FORMAT)
+
+def _overlaps(
+    time_range : list,
+    bbox : list,
+    window : Tuple[Union[str, None], Union[str, None]],
+    query_bbox : Union[BoundingBox, None]
+) -> bool:
+    """Checks if a time range and bounding box overlap the query."""
+    start_time, end_time = window
+    if time_range[0] is None:
+        return False
+    if start_time is not None and time_range[1] < start_time:
+        return False
+    if end_time is not None and time_range[0] > end_time:
+        return False
+    if query_bbox is not None:
+        if bbox[0] is None:
+            return False
+        if (bbox[0] > query_bbox[2] or bbox[2] < query_bbox[0]
+                or bbox[1] > query_bbox[3] or bbox[3] < query_bbox[1]):
+            return False
+    return True
+
+def select_spans(
+    index : dict,
+    mmsi : Union[Iterable[str], None] = None,
+    bbox : Union[BoundingBox, None] = None,
+    start_time : TimeLike = None,
+    end_time : TimeLike = None
+) -> List[Tuple[int, int]]:
+    """
+    Returns the sorted byte spans of the rows which can match the query.
+    The spans are a superset of the matching rows, the exact row filter
+    is done after parsing.
+    """
+    window = (format_time(start_time), format_time(end_time))
+    if not _overlaps(index['time'], index['bbox'], window, bbox):
+        return []
+    ships = index['ships'] if mmsi is None else {
+        ship : index['ships'][ship] for ship in mmsi if ship in index['ships']
+    }
+    spans = sorted(
+        (start, end)
+        for ship_spans in ships.values()
+        for start, end, _, time_range, span_bbox in ship_spans
+        if _overlaps(time_range, span_bbox, window, bbox)
+    )
+    # Merge adjacent spans so they are read with a single call
+    merged : List[Tuple[int, int]] = []
+    for start, end in spans:
+        if merged and merged[-1][1] == start:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+def read_spans(file_path : str, spans : List[Tuple[int, int]]) -> bytes:
+    """Reads the byte spans of a day file, decompressed."""
+    # Compressed files can not be seeked, so they are decompressed first
+    if compression_of(file_path) is not None:
+        content = memoryview(read_bytes(file_path))
+        return b''.join(content[start:end] for start, end in spans)
+    chunks = []
+    with open(file_path, 'rb') as day_file:
+        for start, end in spans:
+            day_file.seek(start)
+            chunks.append(day_file.read(end - start))
+    return b''.join(chunks)
+
+if __name__ == "__main__":
+    import sys
+    for folder in sys.argv[1:]:
+        index_folder(folder)
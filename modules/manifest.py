@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Manifest of the completed days of a backfill.
+
+The manifest is a json file next to the day files with the size and
+sha256 checksum of every completed day file. It is rewritten atomically
+after every day, so a crashed backfill can be resumed from it.
+"""
+import hashlib
+import json
+import os
+from datetime import datetime
+from typing import Dict
+
+MANIFEST_NAME = 'manifest.json'
+
+def file_checksum(file_path : str) -> str:
+    """sha256 checksum of a file."""
+    checksum = hashlib.sha256()
+    with open(file_path, 'rb') as checked_file:
+        for block in iter(lambda: checked_file.read(1 << 20), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def atomic_replace(temporary_path : str, file_path : str) -> None:
+    """Moves a completely written temporary file to file_path."""
+    with open(temporary_path, 'rb') as written_file:
+        os.fsync(written_file.fileno())
+    os.replace(temporary_path, file_path)
+
+class Manifest():
+    """
+    Completed days of a backfill with the size and checksum of their files.
+    """
+    def __init__(self, file_path : str) -> None:
+        self.file_path = file_path
+        self.days : Dict[str, dict] = {}
+        if os.path.exists(file_path):
+            with open(file_path) as manifest_file:
+                self.days = json.load(manifest_file)
+
+    def is_complete(self, day : str, verify_checksum : bool = False) -> bool:
+        """
+        Checks if a day is completed and its file is unchanged.
+        The size of the file is always checked and the checksum if verify_checksum is True.
+        """
+        entry = self.days.get(day)
+        if entry is None:
+            return False
+        file_path = os.path.join(os.path.dirname(self.file_path), entry['file'])
+        if not os.path.exists(file_path):
+            return False
+        if os.path.getsize(file_path) != entry['size']:
+            return False
+        return not verify_checksum or file_checksum(file_path) == entry['sha256']
+
+    def record(self, day : str, file_path : str) -> None:
+        """Records a day as completed and saves the manifest."""
+        self.days[day] = {
+            'file' : os.path.basename(file_path),
+            'size' : os.path.getsize(file_path),
+            'sha256' : file_checksum(file_path),
+            'completed' : datetime.now().isoformat(timespec='seconds'),
+        }
+        self.save()
+
+    def save(self) -> None:
+        """Saves the manifest through a temporary file."""
+        temporary_path = self.file_path + '.tmp'
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump(self.days, manifest_file, indent=1, sort_keys=True)
+        atomic_replace(temporary_path, self.file_path)
@@ -7,7 +7,7 @@ correctly formated paths for that operationg system.
 # Imports
 from sys import platform
 import os
-from typing import Union, TypeVar, List
+from typing import Union, TypeVar, List, Tuple
 from modules.errors import PathError
 
 # Custom types for type hinting
@@ -43,9 +43,20 @@ class OperatingSystem():
         return current_path
 
     # pylint: disable = R0201
-    def get_files(self, folder_path: str) -> List[str]:
-        """ Finds every file at folder path."""
-        return [f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f))]
+    def get_files(
+        self,
+        folder_path: str,
+        extensions : Union[Tuple[str, ...], None] = None
+    ) -> List[str]:
+        """
+        Finds every file at folder path.
+        If extensions is given only files ending with one of them are returned.
+        """
+        return [
+            f for f in os.listdir(folder_path)
+            if os.path.isfile(os.path.join(folder_path, f))
+            and (extensions is None or f.endswith(extensions))
+        ]
 
 if __name__ == "__main__":
     ops = OperatingSystem()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+Memory budget for the clean pipeline.
+
+The memory a run needs is estimated from the number of AIS rows (from
+the size of the day files) and the peak bytes per row of every stage. If
+it does not fit in the budget the day files are imported in chunks of
+days and the rows are split into partitions of mmsi ranges, which are
+spilled to disk. The stages after the import only use the positions of
+one ship at a time, so every partition is cleaned on its own. The results
+are put together with the same trip ids and row numbers as a run without
+partitions, and the stages which use all trips (create_waypoints) are
+run on the merged trips, which are much smaller than the AIS data.
+"""
+import math
+import os
+import shutil
+import tempfile
+from typing import Any, Dict, List, Sequence, Union
+import numpy as np                                                              # type: ignore
+import pandas as pd                                                             # type: ignore
+from modules.compression import DAY_FILE_EXTENSIONS, read_bytes
+from modules.errors import WrongArguments
+from modules.fast_parse import day_file_frame
+from modules.pipeline import ArtifactCache, Stage
+
+# Peak bytes per imported AIS row of every stage, measured with tracemalloc
+# on cargo ships in the Baltic sea with a margin of 2x
+ROW_BYTES = {
+    'import_ais' : 400,
+    'validate_ais' : 400,
+    'compact_stationary' : 400,
+    'create_routes' : 1200,
+    'simplify_routes' : 200,
+    'remove_routes_outside_polygon' : 200,
+    'interpolate_routes' : 200,
+    'clean_data' : 200,
+    'create_waypoints' : 400
+}
+# Stages which do not use the AIS data, run once for all partitions
+SHARED_STAGES = ('import_ports', 'import_port_catalog', 'import_polygon')
+# Stages which use all trips, run on the merged partitions
+MERGED_STAGES = ('create_waypoints',)
+# Ratios of rows before and after a stage with the stage and the attribute they count
+RATIOS = {
+    'compaction_ratio' : ('compact_stationary', 'ais_data'),
+    'simplification_ratio' : ('simplify_routes', 'routes')
+}
+SIZE_UNITS = {'K' : 2**10, 'M' : 2**20, 'G' : 2**30, 'T' : 2**40}
+
+def memory_bytes(size : Union[int, float, str]) -> int:
+    """Bytes of a size like 8G, 512M or 1073741824."""
+    if isinstance(size, str):
+        text = size.strip().upper().rstrip('B')
+        if text and text[-1] in SIZE_UNITS:
+            return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+        try:
+            return int(float(text))
+        except ValueError:
+            raise WrongArguments("Unknown memory size {0}, use e.g. 8G or 512M".format(size))
+    return int(size)
+
+def estimate_rows(
+    file_paths : Sequence[str],
+    sample_fraction : Union[float, None] = None,
+    sample_seed : int = 0
+) -> int:
+    """
+    Estimates the number of rows of day files from their sizes and the rows
+    per byte of the first day file which is not empty (of the sampled ships
+    with sample_fraction).
+    """
+    sizes = [os.path.getsize(file_path) for file_path in file_paths]
+    for file_path, size in zip(file_paths, sizes):
+        if size:
+            return int(math.ceil(sum(sizes) * len(day_file_frame(read_bytes(file_path), sample_fraction, sample_seed)) / size))
+    return 0
+
+def mmsi_boundaries(counts : pd.Series, partitions : int) -> np.ndarray:
+    """
+    First mmsi of every partition after the first, so the partitions have
+    about the same number of rows. counts is the number of rows of every mmsi.
+    """
+    counts = counts.sort_index()
+    if partitions <= 1 or len(counts) == 0:
+        return np.array([], dtype=object)
+    share = counts.values.cumsum() / counts.values.sum()
+    first = np.minimum(np.searchsorted(share, np.arange(1, partitions) / partitions) + 1, len(counts) - 1)
+    return np.unique(counts.index.values[first])
+
+def partition_of(mmsi : np.ndarray, boundaries : np.ndarray) -> np.ndarray:
+    """Partition of every mmsi."""
+    ships, inverse = np.unique(np.asarray(mmsi, dtype=str), return_inverse=True)
+    return np.searchsorted(boundaries.astype(str), ships, side='right')[inverse]
+
+def run_partitioned(
+    ais_class : Any,
+    stages : List[Stage],
+    memory_budget : Union[int, float, str],
+    spill_folder : Union[str, None] = None
+) -> Any:
+    """
+    Runs the stages of clean_stages on ais_class within memory_budget bytes.
+    If the AIS data does not fit the day files are imported in chunks and
+    split in partitions of mmsi ranges, which are spilled to a temporary
+    folder in spill_folder (the system temporary folder by default) and
+    cleaned one at a time. ais_data is not kept when partitioned.
+    """
+    budget = memory_bytes(memory_budget)
+    if not stages or stages[0].method != 'import_ais':
+        raise WrongArguments("The first stage must be import_ais")
+    params = dict(stages[0].params)
+    file_amount = params.pop('file_amount', -1)
+    for stage in stages[1:]:
+        if stage.method in SHARED_STAGES:
+            getattr(ais_class, stage.method)(**stage.params)
+    ship_stages = [stage for stage in stages[1:] if stage.method not in SHARED_STAGES + MERGED_STAGES]
+    merged_stages = [stage for stage in stages[1:] if stage.method in MERGED_STAGES]
+
+    folder_path = ais_class.os.check_path(params['folder_name'], params['geoarea'], params['shiptype'])
+    files = ais_class.os.get_files(folder_path, extensions=DAY_FILE_EXTENSIONS)
+    files = files if file_amount == -1 else files[:file_amount]
+    rows = estimate_rows(
+        [os.path.join(folder_path, file) for file in files],
+        params.get('sample_fraction'),
+        params.get('sample_seed', 0)
+    )
+    row_bytes = max(ROW_BYTES.get(stage.method, max(ROW_BYTES.values())) for stage in stages[:1] + ship_stages)
+    partitions = max(1, int(math.ceil(rows * row_bytes / budget)))
+    files_per_chunk = max(1, int(budget / ROW_BYTES['import_ais'] / max(rows / max(len(files), 1), 1)))
+    if ais_class.verbose:
+        print("About {0} rows, {1} partitions of {2:.0f} MB and day files imported {3} at a time".format(
+            rows, partitions, rows * row_bytes / partitions / 2**20, min(files_per_chunk, len(files))
+        ), flush=True)
+
+    # Everything fits, the stages are run on all data
+    if partitions == 1:
+        ais_class.import_ais(files=files, **params)
+        for stage in ship_stages + merged_stages:
+            getattr(ais_class, stage.method)(**stage.params)
+        return ais_class
+
+    if spill_folder is not None and not os.path.exists(spill_folder):
+        os.makedirs(spill_folder)
+    spill = ArtifactCache(tempfile.mkdtemp(prefix='ais_partitions_', dir=spill_folder))
+    try:
+        # Import the day files in chunks, spill them and count the rows of every ship
+        counts = pd.Series(dtype=np.int64)
+        chunks = [files[i:i + files_per_chunk] for i in range(0, len(files), files_per_chunk)]
+        for chunk_number, chunk in enumerate(chunks):
+            ais_class.import_ais(files=chunk, **params)
+            counts = counts.add(ais_class.ais_data.index.value_counts(), fill_value=0)
+            spill.save('chunk', str(chunk_number), ais_class.ais_data)
+            ais_class.ais_data = None
+
+        # Split the chunks in partitions of mmsi ranges with the same number of rows
+        boundaries = mmsi_boundaries(counts, partitions)
+        for chunk_number in range(len(chunks)):
+            ais_data = spill.load('chunk', str(chunk_number))
+            partition = partition_of(ais_data.index.values, boundaries)
+            for number in range(len(boundaries) + 1):
+                spill.save('partition{0}'.format(number), 'chunk{0}'.format(chunk_number), ais_data[partition == number])
+            os.remove(spill.path('chunk', str(chunk_number)))
+        return _clean_partitions(ais_class, ship_stages, merged_stages, spill, len(boundaries) + 1, len(chunks))
+    finally:
+        shutil.rmtree(spill.folder_name, ignore_errors=True)
+
+def _clean_partitions(
+    ais_class : Any,
+    ship_stages : List[Stage],
+    merged_stages : List[Stage],
+    spill : ArtifactCache,
+    partitions : int,
+    chunks : int
+) -> Any:
+    """
+    Runs the ship stages on every spilled partition, merges the results
+    into ais_class and runs the merged stages.
+    """
+    results : Dict[str, List[pd.DataFrame]] = {'routes' : [], 'interpolated_routes' : [], 'dropped_trips' : []}
+    quality_report : Dict[str, int] = {}
+    ratio_rows = {ratio : [0, 0] for ratio in RATIOS}
+    # Trip ids and row numbers of the partitions before
+    offsets = {'id' : 0, 'routes' : 0, 'interpolated_routes' : 0}
+    for number in range(partitions):
+        part = type(ais_class)(verbose=False, engine=ais_class.engine)
+        for attribute in ('ports', 'port_lookup', 'polygon'):
+            setattr(part, attribute, getattr(ais_class, attribute))
+        part.ais_data = pd.concat([
+            spill.load('partition{0}'.format(number), 'chunk{0}'.format(chunk)) for chunk in range(chunks)
+        ])
+        if part.ais_data.empty:
+            continue
+        size = {'routes' : 0, 'interpolated_routes' : 0}
+        trips = 0
+        # Stage of every dropped trip, to sort them like a single run
+        dropped_stage : List[int] = []
+        for stage_number, stage in enumerate(ship_stages):
+            # Without trips the stages after create_routes have nothing to do
+            if part.routes is not None and part.routes.empty:
+                break
+            before = {
+                attribute : len(getattr(part, attribute)) for attribute in ('ais_data', 'routes')
+                if getattr(part, attribute) is not None
+            }
+            getattr(part, stage.method)(**stage.params)
+            if stage.method == 'create_routes':
+                # Row numbers of routes are positions in the AIS data of the partition
+                size['routes'] = before['ais_data']
+                trips = int(max(part.routes['id'].max() if len(part.routes) else -1,
+                                part.dropped_trips['id'].max() if len(part.dropped_trips) else -1)) + 1
+            if stage.method == 'interpolate_routes':
+                size['interpolated_routes'] = len(part.interpolated_routes)
+            for ratio, (method, attribute) in RATIOS.items():
+                if stage.method == method:
+                    ratio_rows[ratio][0] += before[attribute]
+                    ratio_rows[ratio][1] += len(getattr(part, attribute))
+            if part.dropped_trips is not None:
+                dropped_stage += [stage_number] * (len(part.dropped_trips) - len(dropped_stage))
+        if part.quality_report is not None:
+            for reason, count in part.quality_report.items():
+                quality_report[reason] = quality_report.get(reason, 0) + count
+
+        for name in ('routes', 'interpolated_routes'):
+            frame = getattr(part, name)
+            if frame is not None:
+                frame = frame.assign(id=frame['id'] + offsets['id'])
+                frame.index = frame.index + offsets[name]
+                results[name].append(frame)
+                offsets[name] += size[name]
+        if part.dropped_trips is not None:
+            results['dropped_trips'].append(part.dropped_trips.assign(
+                id=part.dropped_trips['id'] + offsets['id'],
+                stage=dropped_stage
+            ))
+        offsets['id'] += trips
+
+    ais_class.ais_data = None
+    ais_class.routes = pd.concat(results['routes']) if results['routes'] else None
+    ais_class.interpolated_routes = pd.concat(results['interpolated_routes']) if results['interpolated_routes'] else None
+    if results['dropped_trips']:
+        ais_class.dropped_trips = pd.concat(results['dropped_trips']).sort_values(
+            ['stage', 'id'], kind='mergesort'
+        ).drop('stage', axis=1).reset_index(drop=True)
+    ais_class.quality_report = quality_report or None
+    for ratio, (before_rows, after_rows) in ratio_rows.items():
+        if after_rows:
+            setattr(ais_class, ratio, before_rows / after_rows)
+    for stage in merged_stages:
+        getattr(ais_class, stage.method)(**stage.params)
+    return ais_class
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+"""
+Declarative pipeline of clean_ais stages with cached results.
+
+A stage is a clean_ais method with its parameters, the attributes it
+reads (inputs) and the attributes it sets (outputs). The key of a stage
+is a hash of its method, parameters, source files and the keys of the
+stages which made its inputs (and the engine of clean_ais for stages with
+inputs), so it changes when anything upstream changes. The outputs of a stage are saved in the cache folder as one
+pickle file per attribute named by the key, and a stage whose outputs
+are all in the cache is not run again. Changing waypoint_amount
+therefore only reruns create_waypoints.
+
+sweep runs the pipeline for a grid of parameters, where the stages
+shared by several configurations are only run once.
+"""
+import hashlib
+import itertools
+import json
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, List, NamedTuple, Tuple, Union
+from modules.errors import NotdefinedError, PathError
+
+class Stage(NamedTuple):
+    """A clean_ais method with its parameters, inputs and outputs."""
+    name : str
+    method : str
+    params : Dict[str, Any]
+    inputs : Tuple[str, ...] = ()
+    outputs : Tuple[str, ...] = ()
+    # Files or folders read by the stage, their sizes and modification
+    # times are part of the key
+    sources : Tuple[str, ...] = ()
+
+def _source_fingerprint(path : str) -> list:
+    """Names, sizes and modification times of a file or the files of a folder."""
+    if not os.path.exists(path):
+        raise PathError(path)
+    if os.path.isfile(path):
+        return [os.path.basename(path), os.path.getsize(path), os.path.getmtime(path)]
+    return sorted(
+        [file, os.path.getsize(os.path.join(path, file)), os.path.getmtime(os.path.join(path, file))]
+        for file in os.listdir(path)
+        if os.path.isfile(os.path.join(path, file))
+    )
+
+def stage_key(stage : Stage, input_keys : List[str], engine : Union[str, None] = None) -> str:
+    """
+    Hash of everything the outputs of a stage depend on.
+    The engine is part of the key of stages with inputs, so the results of
+    the engines are never taken for each other.
+    """
+    parts = [
+        stage.method,
+        stage.params,
+        list(stage.outputs),
+        [_source_fingerprint(source) for source in stage.sources],
+        input_keys,
+    ]
+    if stage.inputs and engine is not None:
+        parts.append(engine)
+    description = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+def plan(stages : List[Stage], engine : Union[str, None] = None) -> List[Tuple[Stage, str, Dict[str, str]]]:
+    """
+    Returns (stage, key, input keys) for every stage, where input keys maps
+    every input attribute to the key of the stage which made it.
+    engine is the engine of the clean_ais object the stages run on.
+    """
+    producers : Dict[str, str] = {}
+    steps = []
+    for stage in stages:
+        missing = [attribute for attribute in stage.inputs if attribute not in producers]
+        if missing:
+            raise NotdefinedError(', '.join(missing))
+        input_keys = {attribute : producers[attribute] for attribute in stage.inputs}
+        key = stage_key(stage, [input_keys[attribute] for attribute in stage.inputs], engine)
+        steps.append((stage, key, input_keys))
+        for attribute in stage.outputs:
+            producers[attribute] = key
+    return steps
+
+def clean_stages(
+    folder_name : str,
+    geoarea : str,
+    shiptype : str,
+    polygon_file : str,
+    ports_folder : str = 'Data',
+    ports_file : str = 'Gatehouse_locode.csv',
+    port_catalog : Union[str, None] = None,
+    file_amount : int = -1,
+    sample_fraction : Union[float, None] = None,
+    sample_seed : int = 0,
+    max_speed_knots : Union[float, None] = None,
+    compact_max_sog : Union[float, None] = None,
+    speed_limit : float = 3,
+    simplify_tolerance_m : Union[float, None] = None,
+    interval_s : int = 10*60,
+    threshold : float = 10,
+    clean_interval_s : int = 24*60*60,
+    speed : float = 0.5,
+    waypoint_amount : int = 100
+) -> List[Stage]:
+    """
+    The stages of the clean flow of clean_example.py.
+    If max_speed_knots is given the positions are validated after the import
+    and if compact_max_sog is given stationary positions are compacted.
+    The ports are imported from the port catalog folder if it is given.
+    With sample_fraction only a deterministic sample of the ships is imported.
+    """
+    import_params : Dict[str, Any] = {
+        'folder_name' : folder_name, 'geoarea' : geoarea, 'shiptype' : shiptype, 'file_amount' : file_amount
+    }
+    if sample_fraction is not None:
+        import_params.update(sample_fraction=sample_fraction, sample_seed=sample_seed)
+    stages = [
+        Stage(
+            'import_ais', 'import_ais',
+            import_params,
+            outputs=('ais_data',),
+            sources=(os.path.join(folder_name, geoarea, shiptype),)
+        ),
+    ]
+    if max_speed_knots is not None:
+        stages.append(Stage(
+            'validate_ais', 'validate_ais',
+            {'max_speed_knots' : max_speed_knots},
+            inputs=('ais_data',),
+            outputs=('ais_data', 'quality_report')
+        ))
+    if port_catalog is not None:
+        stages.append(Stage(
+            'import_port_catalog', 'import_port_catalog',
+            {'folder_name' : port_catalog},
+            outputs=('ports', 'port_lookup'),
+            sources=(port_catalog,)
+        ))
+    else:
+        stages.append(Stage(
+            'import_ports', 'import_ports',
+            {'folder_name' : ports_folder, 'file_name' : ports_file},
+            outputs=('ports', 'port_lookup'),
+            sources=(os.path.join(ports_folder, ports_file),)
+        ))
+    if compact_max_sog is not None:
+        stages.append(Stage(
+            'compact_stationary', 'compact_stationary',
+            {'max_sog' : compact_max_sog},
+            inputs=('ais_data', 'ports', 'port_lookup'),
+            outputs=('ais_data', 'compaction_ratio')
+        ))
+    stages += [
+        Stage(
+            'import_polygon', 'import_polygon',
+            {'geoarea' : geoarea, 'folder_name' : folder_name, 'file_name' : polygon_file},
+            outputs=('polygon',),
+            sources=(os.path.join(folder_name, geoarea, polygon_file),)
+        ),
+        Stage(
+            'create_routes', 'create_routes',
+            {'speed_limit' : speed_limit},
+            inputs=('ais_data', 'ports', 'port_lookup'),
+            outputs=('routes', 'dropped_trips')
+        ),
+    ]
+    if simplify_tolerance_m is not None:
+        stages.append(Stage(
+            'simplify_routes', 'simplify_routes',
+            {'tolerance_m' : simplify_tolerance_m},
+            inputs=('routes',),
+            outputs=('routes', 'simplification_ratio')
+        ))
+    stages += [
+        Stage(
+            'remove_routes_outside_polygon', 'remove_routes_outside_polygon',
+            {},
+            inputs=('routes', 'polygon', 'dropped_trips'),
+            outputs=('routes', 'dropped_trips')
+        ),
+        Stage(
+            'interpolate_routes', 'interpolate_routes',
+            {'interval_s' : interval_s},
+            inputs=('routes',),
+            outputs=('interpolated_routes',)
+        ),
+        Stage(
+            'clean_data', 'clean_data',
+            {'threshold' : threshold, 'interval_s' : clean_interval_s, 'speed' : speed},
+            inputs=('routes', 'interpolated_routes', 'dropped_trips'),
+            outputs=('routes', 'interpolated_routes', 'dropped_trips')
+        ),
+        Stage(
+            'create_waypoints', 'create_waypoints',
+            {'waypoint_amount' : waypoint_amount},
+            inputs=('routes', 'interpolated_routes'),
+            outputs=('waypoints', 'waypoint_amount')
+        ),
+    ]
+    return stages
+
+class ArtifactCache():
+    """
+    Folder with a pickle file per stage output, named by the stage key.
+    Without a folder nothing is cached.
+    """
+    def __init__(self, folder_name : Union[str, None]) -> None:
+        self.folder_name = folder_name
+        if folder_name is not None and not os.path.exists(folder_name):
+            os.makedirs(folder_name)
+
+    def path(self, key : str, attribute : str) -> str:
+        """Path of the pickle file of an output."""
+        return os.path.join(self.folder_name, '{0}-{1}.pkl'.format(key[:32], attribute))
+
+    def has(self, key : str, attributes : Tuple[str, ...]) -> bool:
+        """Checks if all outputs of a stage are cached."""
+        return self.folder_name is not None and all(
+            os.path.exists(self.path(key, attribute)) for attribute in attributes
+        )
+
+    def load(self, key : str, attribute : str) -> Any:
+        """Loads a cached output."""
+        with open(self.path(key, attribute), 'rb') as pickle_file:
+            return pickle.load(pickle_file)
+
+    def save(self, key : str, attribute : str, value : Any) -> None:
+        """Saves an output through a temporary file."""
+        if self.folder_name is None:
+            return
+        temporary_path = self.path(key, attribute) + '.tmp'
+        with open(temporary_path, 'wb') as pickle_file:
+            pickle.dump(value, pickle_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, self.path(key, attribute))
+
+class Pipeline():
+    """
+    Runs stages on a clean_ais object and caches their outputs.
+    """
+    def __init__(
+        self,
+        stages : List[Stage],
+        cache_folder : Union[str, None] = 'Pipeline_cache',
+        verbose : bool = True
+    ) -> None:
+        self.stages = stages
+        self.cache = ArtifactCache(cache_folder)
+        self.verbose = verbose
+        # Names of the stages which were run and which were taken from the cache
+        self.ran : List[str] = []
+        self.cached : List[str] = []
+
+    def run(self, ais_class : Any, attributes : Union[Iterable[str], None] = None) -> Any:
+        """
+        Runs the stages whose outputs are not cached and returns ais_class
+        with the final value of attributes (every output by default).
+        Cached outputs are only loaded when a stage or the result needs them.
+        """
+        steps = plan(self.stages, getattr(ais_class, 'engine', None))
+        self.ran, self.cached = [], []
+        # Key of the stage whose output is in ais_class for every attribute
+        loaded : Dict[str, str] = {}
+        final : Dict[str, str] = {}
+        for stage, key, input_keys in steps:
+            for attribute in stage.outputs:
+                final[attribute] = key
+            if self.cache.has(key, stage.outputs):
+                self.cached.append(stage.name)
+                if self.verbose:
+                    print("Stage {0} is cached".format(stage.name), flush=True)
+                continue
+
+            # Load the inputs made by cached stages
+            for attribute, input_key in input_keys.items():
+                if loaded.get(attribute) != input_key:
+                    setattr(ais_class, attribute, self.cache.load(input_key, attribute))
+                    loaded[attribute] = input_key
+
+            start = time.time()
+            getattr(ais_class, stage.method)(**stage.params)
+            for attribute in stage.outputs:
+                self.cache.save(key, attribute, getattr(ais_class, attribute))
+                loaded[attribute] = key
+            self.ran.append(stage.name)
+            if self.verbose:
+                print("Stage {0} ({1:.2f}s)".format(stage.name, time.time() - start), flush=True)
+
+        # Load the final value of the attributes which are not loaded
+        for attribute in final if attributes is None else attributes:
+            key = final[attribute]
+            if loaded.get(attribute) != key:
+                setattr(ais_class, attribute, self.cache.load(key, attribute))
+        return ais_class
+
+def _new_ais_class(ais_class_type : type, engine : Union[str, None]) -> Any:
+    """A quiet ais_class_type object with engine (the default engine if None)."""
+    if engine is None:
+        return ais_class_type(verbose=False)
+    return ais_class_type(verbose=False, engine=engine)
+
+def _run_stage(
+    ais_class_type : type,
+    stage : Stage,
+    key : str,
+    input_keys : Dict[str, str],
+    cache_folder : str,
+    engine : Union[str, None] = None
+) -> float:
+    """
+    Runs a single stage on a new object with its inputs loaded from the
+    cache and saves its outputs to the cache. Returns the run time.
+    """
+    cache = ArtifactCache(cache_folder)
+    ais_class = _new_ais_class(ais_class_type, engine)
+    for attribute, input_key in input_keys.items():
+        setattr(ais_class, attribute, cache.load(input_key, attribute))
+    start = time.time()
+    getattr(ais_class, stage.method)(**stage.params)
+    for attribute in stage.outputs:
+        cache.save(key, attribute, getattr(ais_class, attribute))
+    return time.time() - start
+
+def sweep(
+    ais_class_type : type,
+    base_params : Dict[str, Any],
+    grid : Dict[str, List[Any]],
+    cache_folder : str = 'Pipeline_cache',
+    processes : Union[int, None] = None,
+    attributes : Iterable[str] = ('routes', 'interpolated_routes', 'waypoints'),
+    verbose : bool = True,
+    engine : Union[str, None] = None
+) -> List[Tuple[Dict[str, Any], Any]]:
+    """
+    Runs clean_stages for every combination of the parameters in grid
+    (e.g. {'interval_s' : [300, 600], 'waypoint_amount' : [50, 100]}) on top
+    of base_params. Stages with the same key in several configurations
+    (import, port matching, routes, ...) are run once, and the stages of a
+    level of the pipeline are run in parallel by processes processes.
+    The stages run with engine ('optimized' or 'reference'), by default the
+    default engine of ais_class_type.
+    Returns (configuration, ais_class_type object with attributes) for
+    every configuration.
+    """
+    names = list(grid)
+    configurations = [
+        dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))
+    ]
+    engine = getattr(_new_ais_class(ais_class_type, engine), 'engine', None)
+    plans = [plan(clean_stages(**{**base_params, **configuration}), engine) for configuration in configurations]
+
+    # Unique stages by key and their level in the pipeline
+    nodes : Dict[str, Tuple[Stage, Dict[str, str]]] = {}
+    levels : Dict[str, int] = {}
+    for steps in plans:
+        for stage, key, input_keys in steps:
+            if key not in nodes:
+                nodes[key] = (stage, input_keys)
+                levels[key] = 1 + max((levels[input_key] for input_key in input_keys.values()), default=-1)
+    if verbose:
+        print("{0} configurations share {1} of {2} stages".format(
+            len(configurations),
+            sum(len(steps) for steps in plans) - len(nodes),
+            sum(len(steps) for steps in plans)
+        ), flush=True)
+
+    cache = ArtifactCache(cache_folder)
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for level in range(max(levels.values(), default=-1) + 1):
+            keys = [
+                key for key, node_level in levels.items()
+                if node_level == level and not cache.has(key, nodes[key][0].outputs)
+            ]
+            runs = [
+                executor.submit(_run_stage, ais_class_type, nodes[key][0], key, nodes[key][1], cache_folder, engine)
+                for key in keys
+            ]
+            for key, run in zip(keys, runs):
+                seconds = run.result()
+                if verbose:
+                    print("Stage {0} {1} ({2:.2f}s)".format(nodes[key][0].name, key[:8], seconds), flush=True)
+    if verbose:
+        print("Sweep ({0:.2f}s)".format(time.time() - start), flush=True)
+
+    # Load the results of every configuration
+    results = []
+    for configuration, steps in zip(configurations, plans):
+        final = {attribute : key for _, key, _ in steps for attribute in nodes[key][0].outputs}
+        ais_class = _new_ais_class(ais_class_type, engine)
+        for attribute in attributes:
+            setattr(ais_class, attribute, cache.load(final[attribute], attribute))
+        results.append((configuration, ais_class))
+    return results
@@ -1,6 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatch
 import matplotlib.path as mplPath
 
 
@@ -239,6 +237,9 @@ def count_objects_inside(polygons, xarr, yarr, polygons_in=None, include_holes=T
 # Start of code
 # =============================================================================
 if __name__ == '__main__':
+    # Plotting is only needed for the demo, so it is not imported with the module
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as mpatch
     xmin, xmax, ymin, ymax, total = -2, 8.5, -2, 8.5, 25000
     # create some polygons
     # polygons = [polygon1, polygon2, ... polygonN]
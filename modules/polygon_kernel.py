@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+"""
+Point in polygon test of many points against many polygons.
+
+All polygons are flattened to one array of vertices with the offsets of
+every ring, the polygon of every ring and whether the ring is a hole.
+A uniform grid over the rings lists the rings whose bounding box overlaps
+every grid cell, so a point is only tested against the rings of its cell.
+
+Every ring is prepared with its bounding box (points outside are rejected)
+and, for convex rings, a rectangle inscribed in the ring (points inside
+are accepted). Only points between the two are tested against the edges.
+
+With numba installed a compiled kernel tests the points in parallel
+threads (without the GIL), otherwise the candidate rings of all points
+are found with numpy and the edge tests are done with matplotlib. Both
+return the index of the first polygon every point is inside of, with the
+same rules as mask_from_polygons.
+"""
+from typing import NamedTuple, Sequence, Tuple, Union
+import numpy as np                                                              # type: ignore
+import matplotlib.path as mplPath                                               # type: ignore
+try:
+    import numba                                    # type: ignore
+except ImportError:
+    numba = None
+
+class FlatPolygons(NamedTuple):
+    """Polygons as flat arrays of prepared rings."""
+    vertices : np.ndarray       # (x, y) of all rings after each other
+    ring_offsets : np.ndarray   # first vertex of every ring and the number of vertices
+    ring_polygon : np.ndarray   # polygon of every ring (ascending)
+    ring_hole : np.ndarray      # True for the rings which are holes
+    ring_bbox : np.ndarray      # x_min, y_min, x_max, y_max of every ring
+    ring_inner : np.ndarray     # x_min, y_min, x_max, y_max of a rectangle inside every ring (nan if none)
+    polygon_amount : int
+    grid_origin : np.ndarray    # x, y of the corner of the grid
+    grid_step : np.ndarray      # width and height of the grid cells
+    grid_shape : np.ndarray     # number of cells along x and y
+    cell_offsets : np.ndarray   # first entry in cell_rings of every cell
+    cell_rings : np.ndarray     # rings of every cell (ascending)
+
+# Largest number of grid cells along an axis
+MAX_GRID = 512
+# Share of the largest inscribed rectangle used, so it stays clear of the edges
+INNER_MARGIN = 0.99
+
+def _grid_cells(
+    ring_bbox : np.ndarray,
+    origin : np.ndarray,
+    step : np.ndarray,
+    shape : np.ndarray
+) -> np.ndarray:
+    """First and last grid cell along x and y of every ring."""
+    first = np.floor((ring_bbox[:, :2] - origin) / step).astype(np.int64)
+    last = np.floor((ring_bbox[:, 2:] - origin) / step).astype(np.int64)
+    return np.column_stack((
+        np.clip(first, 0, shape - 1),
+        np.clip(last, 0, shape - 1)
+    ))
+
+def _inner_rectangles(
+    vertices : np.ndarray,
+    ring_offsets : np.ndarray,
+    ring_bbox : np.ndarray
+) -> np.ndarray:
+    """
+    Rectangle inside every convex ring, centred on the mean of its vertices
+    with the proportions of its bounding box (nan for other rings).
+    """
+    ring_amount = len(ring_offsets) - 1
+    sizes = np.diff(ring_offsets)
+    ring_of_vertex = np.repeat(np.arange(ring_amount), sizes)
+    following = np.arange(len(vertices)) + 1
+    following[ring_offsets[1:][sizes > 0] - 1] = ring_offsets[:-1][sizes > 0]
+
+    # Without repeated vertices (e.g. the first vertex at the end)
+    distinct = (vertices[following] != vertices).any(axis=1)
+    points = vertices[distinct]
+    ring = ring_of_vertex[distinct]
+    counts = np.bincount(ring, minlength=ring_amount)
+    offsets = np.r_[0, np.cumsum(counts)]
+    following = np.arange(len(points)) + 1
+    following[offsets[1:][counts > 0] - 1] = offsets[:-1][counts > 0]
+    edge = points[following] - points
+    next_edge = edge[following]
+
+    # A ring is convex if it turns the same way at every vertex and once around
+    cross = edge[:, 0] * next_edge[:, 1] - edge[:, 1] * next_edge[:, 0]
+    turning = np.bincount(
+        ring,
+        np.arctan2(cross, (edge * next_edge).sum(axis=1)),
+        minlength=ring_amount
+    )
+    sign = np.sign(turning)
+    wrong_turns = np.bincount(ring, cross * sign[ring] < 0, minlength=ring_amount)
+    convex = (counts >= 3) & (np.abs(np.abs(turning) - 2 * np.pi) < 1e-6) & (wrong_turns == 0)
+
+    # Largest scale of the half bounding box at the centre with all corners
+    # on the inner side of every edge
+    centre = np.column_stack((
+        np.bincount(ring, points[:, 0], minlength=ring_amount),
+        np.bincount(ring, points[:, 1], minlength=ring_amount)
+    )) / np.maximum(counts, 1)[:, None]
+    half = (ring_bbox[:, 2:] - ring_bbox[:, :2]) / 2
+    to_centre = centre[ring] - points
+    inside = (edge[:, 0] * to_centre[:, 1] - edge[:, 1] * to_centre[:, 0]) * sign[ring]
+    scale = np.ones(ring_amount)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for corner in ((1, 1), (1, -1), (-1, 1), (-1, -1)):
+            direction = half[ring] * corner
+            towards = (edge[:, 0] * direction[:, 1] - edge[:, 1] * direction[:, 0]) * sign[ring]
+            np.minimum.at(scale, ring, np.where(towards < 0, inside / -towards, np.inf))
+    scale *= INNER_MARGIN
+    convex &= scale > 0
+
+    inner = np.column_stack((centre - half * scale[:, None], centre + half * scale[:, None]))
+    inner[~convex] = np.nan
+    return inner
+
+def flatten_polygons(
+    polygons : Sequence[Sequence[np.ndarray]],
+    polygons_in : Union[Sequence[Sequence[bool]], None] = None
+) -> FlatPolygons:
+    """
+    Flattens and prepares polygons in the format of mask_from_polygons, a
+    list of polygons with a list of rings of (x, y) vertices each.
+    polygons_in marks the rings which are holes.
+    """
+    rings = []
+    ring_polygon = []
+    ring_hole = []
+    for k, polygon in enumerate(polygons):
+        for j, ring in enumerate(polygon):
+            rings.append(np.asarray(ring, dtype=float).reshape(-1, 2))
+            ring_polygon.append(k)
+            ring_hole.append(bool(polygons_in[k][j]) if polygons_in is not None else False)
+    sizes = [len(ring) for ring in rings]
+    return prepare_polygons(
+        np.concatenate(rings) if rings else np.zeros((0, 2)),
+        np.r_[0, np.cumsum(sizes)].astype(np.int64),
+        np.array(ring_polygon, dtype=np.int64),
+        np.array(ring_hole, dtype=bool),
+        len(polygons)
+    )
+
+def prepare_polygons(
+    vertices : np.ndarray,
+    ring_offsets : np.ndarray,
+    ring_polygon : np.ndarray,
+    ring_hole : np.ndarray,
+    polygon_amount : int
+) -> FlatPolygons:
+    """
+    Prepares polygons which are already flat arrays of rings (e.g. from a
+    port catalog): vertices of all rings, the offsets of the rings, the
+    polygon of every ring (ascending) and whether every ring is a hole.
+    """
+    vertices = np.ascontiguousarray(vertices, dtype=float)
+    ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+    ring_amount = len(ring_offsets) - 1
+    if ring_amount:
+        ring_bbox = np.column_stack((
+            np.minimum.reduceat(vertices, ring_offsets[:-1], axis=0),
+            np.maximum.reduceat(vertices, ring_offsets[:-1], axis=0)
+        ))
+        ring_inner = _inner_rectangles(vertices, ring_offsets, ring_bbox)
+        origin = ring_bbox[:, :2].min(axis=0)
+        extent = ring_bbox[:, 2:].max(axis=0) - origin
+    else:
+        ring_bbox = ring_inner = np.zeros((0, 4))
+        origin = extent = np.zeros(2)
+
+    # Grid with about one cell per ring over all rings
+    side = int(np.clip(np.sqrt(ring_amount), 1, MAX_GRID))
+    shape = np.array([side, side], dtype=np.int64)
+    step = np.where(extent > 0, extent / side, 1.0)
+    cells = _grid_cells(ring_bbox, origin, step, shape)
+    # Every cell from the first to the last cell of every ring
+    rows = cells[:, 2] - cells[:, 0] + 1
+    columns = cells[:, 3] - cells[:, 1] + 1
+    entries = rows * columns
+    ring_of_entry = np.repeat(np.arange(ring_amount, dtype=np.int64), entries)
+    local = np.arange(entries.sum()) - np.repeat(np.cumsum(entries) - entries, entries)
+    cell_of_entry = (
+        (cells[ring_of_entry, 0] + local // columns[ring_of_entry]) * side
+        + cells[ring_of_entry, 1] + local % columns[ring_of_entry]
+    )
+    # Rings of a cell keep their order, so the first polygon is found first
+    order = np.lexsort((ring_of_entry, cell_of_entry))
+    cell_offsets = np.r_[0, np.cumsum(np.bincount(cell_of_entry, minlength=side * side))]
+
+    return FlatPolygons(
+        vertices,
+        ring_offsets,
+        np.asarray(ring_polygon, dtype=np.int64),
+        np.asarray(ring_hole, dtype=bool),
+        ring_bbox,
+        ring_inner,
+        polygon_amount,
+        origin,
+        step,
+        shape,
+        cell_offsets.astype(np.int64),
+        ring_of_entry[order]
+    )
+
+if numba is not None:
+    @numba.njit(cache=True, nogil=True)
+    def _crosses(x, y, vertices, start, end):
+        """Even-odd test of a point against a ring."""
+        inside = False
+        j = end - 1
+        for i in range(start, end):
+            xi, yi = vertices[i, 0], vertices[i, 1]
+            xj, yj = vertices[j, 0], vertices[j, 1]
+            if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+                inside = not inside
+            j = i
+        return inside
+
+    @numba.njit(cache=True, nogil=True, parallel=True)
+    def _kernel(
+        x, y, vertices, ring_offsets, ring_polygon, ring_hole, ring_bbox, ring_inner,
+        grid_origin, grid_step, grid_shape, cell_offsets, cell_rings,
+        include_holes, result, tested, exact
+    ):
+        """Index of the first polygon every point is inside of."""
+        for p in numba.prange(len(x)):
+            result[p] = -1
+            tested[p] = False
+            exact[p] = False
+            if not (x[p] == x[p] and y[p] == y[p]):
+                continue
+            i = int(np.floor((x[p] - grid_origin[0]) / grid_step[0]))
+            j = int(np.floor((y[p] - grid_origin[1]) / grid_step[1]))
+            if i < 0 or j < 0 or i >= grid_shape[0] or j >= grid_shape[1]:
+                continue
+            cell = i * grid_shape[1] + j
+            e = cell_offsets[cell]
+            end = cell_offsets[cell + 1]
+            while e < end:
+                k = ring_polygon[cell_rings[e]]
+                inside = False
+                while e < end and ring_polygon[cell_rings[e]] == k:
+                    r = cell_rings[e]
+                    e += 1
+                    # Same bounding box test as mask_from_polygons
+                    if not (ring_bbox[r, 0] < x[p] < ring_bbox[r, 2] and ring_bbox[r, 1] < y[p] < ring_bbox[r, 3]):
+                        continue
+                    tested[p] = True
+                    if ring_inner[r, 0] < x[p] < ring_inner[r, 2] and ring_inner[r, 1] < y[p] < ring_inner[r, 3]:
+                        in_ring = True
+                    else:
+                        exact[p] = True
+                        in_ring = _crosses(x[p], y[p], vertices, ring_offsets[r], ring_offsets[r + 1])
+                    if in_ring:
+                        if ring_hole[r] and not include_holes:
+                            inside = False
+                        else:
+                            inside = True
+                if inside:
+                    result[p] = k
+                    break
+
+def _polygon_index_numpy(
+    x : np.ndarray,
+    y : np.ndarray,
+    flat : FlatPolygons,
+    include_holes : bool
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Candidate rings of all points from the grid with numpy and the edge
+    tests per ring with matplotlib.
+    """
+    size = len(x)
+    result = np.full(size, -1, dtype=np.int64)
+    tested = np.zeros(size, dtype=bool)
+    exact = np.zeros(size, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        i = np.floor((x - flat.grid_origin[0]) / flat.grid_step[0])
+        j = np.floor((y - flat.grid_origin[1]) / flat.grid_step[1])
+    points = np.flatnonzero((i >= 0) & (j >= 0) & (i < flat.grid_shape[0]) & (j < flat.grid_shape[1]))
+    cell = i[points].astype(np.int64) * flat.grid_shape[1] + j[points].astype(np.int64)
+
+    # Every (point, ring) pair of the rings of the cell of every point,
+    # sorted by point and ring
+    amount = flat.cell_offsets[cell + 1] - flat.cell_offsets[cell]
+    pair_point = np.repeat(points, amount)
+    pair_ring = flat.cell_rings[
+        np.repeat(flat.cell_offsets[cell], amount)
+        + np.arange(amount.sum()) - np.repeat(np.cumsum(amount) - amount, amount)
+    ]
+    px = x[pair_point]
+    py = y[pair_point]
+    bbox = flat.ring_bbox[pair_ring]
+    candidate = (bbox[:, 0] < px) & (px < bbox[:, 2]) & (bbox[:, 1] < py) & (py < bbox[:, 3])
+    pair_point, pair_ring, px, py = pair_point[candidate], pair_ring[candidate], px[candidate], py[candidate]
+    tested[pair_point] = True
+
+    inner = flat.ring_inner[pair_ring]
+    in_ring = (inner[:, 0] < px) & (px < inner[:, 2]) & (inner[:, 1] < py) & (py < inner[:, 3])
+    edge = np.flatnonzero(~in_ring)
+    exact[pair_point[edge]] = True
+    order = edge[np.argsort(pair_ring[edge], kind='stable')]
+    ring_start = np.flatnonzero(np.r_[True, pair_ring[order][1:] != pair_ring[order][:-1]])
+    for start, end in zip(ring_start, np.r_[ring_start[1:], len(order)]):
+        pairs = order[start:end]
+        r = pair_ring[pairs[0]]
+        path = mplPath.Path(flat.vertices[flat.ring_offsets[r]:flat.ring_offsets[r + 1]])
+        in_ring[pairs] = path.contains_points(np.column_stack((px[pairs], py[pairs])))
+
+    # A point is inside a polygon if the last ring of the polygon it is
+    # inside of is not a hole (every ring counts with include_holes)
+    pair_point, pair_ring = pair_point[in_ring], pair_ring[in_ring]
+    pair_polygon = flat.ring_polygon[pair_ring]
+    if include_holes:
+        inside = np.ones(len(pair_point), dtype=bool)
+    else:
+        last = np.r_[(pair_point[1:] != pair_point[:-1]) | (pair_polygon[1:] != pair_polygon[:-1]), True]
+        inside = last & ~flat.ring_hole[pair_ring]
+    inside_point, first = np.unique(pair_point[inside], return_index=True)
+    result[inside_point] = pair_polygon[inside][first]
+    return result, tested, exact
+
+def polygon_index(
+    x : np.ndarray,
+    y : np.ndarray,
+    flat : FlatPolygons,
+    include_holes : bool = True,
+    compiled : Union[bool, None] = None,
+    return_tests : bool = False
+) -> Union[np.ndarray, Tuple[np.ndarray, int, int]]:
+    """
+    Returns the index of the first polygon every point (x[i], y[i]) is
+    inside of (-1 for points outside every polygon). With include_holes
+    False points inside a hole ring are not inside its polygon.
+    compiled selects the numba kernel (None uses it if numba is installed).
+    With return_tests the number of points inside a bounding box and the
+    number of points tested against the edges of a ring are returned too.
+    """
+    x = np.ascontiguousarray(x, dtype=float)
+    y = np.ascontiguousarray(y, dtype=float)
+    if compiled is None:
+        compiled = numba is not None
+    if not compiled:
+        result, tested, exact = _polygon_index_numpy(x, y, flat, include_holes)
+    elif numba is None:
+        raise ImportError("numba is needed for the compiled point in polygon kernel")
+    else:
+        result = np.empty(len(x), dtype=np.int64)
+        tested = np.empty(len(x), dtype=bool)
+        exact = np.empty(len(x), dtype=bool)
+        _kernel(
+            x, y,
+            np.ascontiguousarray(flat.vertices),
+            flat.ring_offsets,
+            flat.ring_polygon,
+            flat.ring_hole,
+            np.ascontiguousarray(flat.ring_bbox),
+            np.ascontiguousarray(flat.ring_inner),
+            flat.grid_origin,
+            flat.grid_step,
+            flat.grid_shape,
+            flat.cell_offsets,
+            flat.cell_rings,
+            include_holes,
+            result,
+            tested,
+            exact
+        )
+    if return_tests:
+        return result, int(tested.sum()), int(exact.sum())
+    return result
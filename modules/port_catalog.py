@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Compiled catalog of port polygons.
+
+The catalog is a folder with the names and locodes of the ports in
+ports.csv and the prepared polygons (see polygon_kernel.FlatPolygons) as
+one .npy file per array, so it is loaded with memory mapping and no
+parsing. Vertices are (lat, long) like the ports of clean_ais.
+
+A catalog is made from WKB polygons from the database (see
+get_ports_polygon.refresh_port_catalog) or from a text file of port
+polygons like Gatehouse_locode.csv.
+"""
+import csv
+import os
+from typing import List, Sequence, Tuple
+import numpy as np                                                              # type: ignore
+import pandas as pd                                                             # type: ignore
+from modules.errors import PathError
+from modules.manifest import atomic_replace
+from modules.polygon_kernel import FlatPolygons, prepare_polygons
+
+PORTS_FILE = 'ports.csv'
+# Arrays of FlatPolygons saved as .npy files
+ARRAYS = tuple(field for field in FlatPolygons._fields if field != 'polygon_amount')
+
+def save_catalog(
+    folder_name : str,
+    names : Sequence[str],
+    locodes : Sequence[str],
+    vertices : np.ndarray,
+    ring_offsets : np.ndarray,
+    ring_polygon : np.ndarray,
+    ring_hole : np.ndarray
+) -> FlatPolygons:
+    """
+    Prepares the polygons of the ports (flat rings with (lat, long)
+    vertices) and saves them as a catalog. Every file is written to a
+    temporary file first, so a catalog being read is never half written.
+    """
+    flat = prepare_polygons(vertices, ring_offsets, ring_polygon, ring_hole, len(names))
+    if not os.path.exists(folder_name):
+        os.makedirs(folder_name)
+    for array in ARRAYS:
+        file_path = os.path.join(folder_name, array + '.npy')
+        with open(file_path + '.tmp', 'wb') as array_file:
+            np.save(array_file, getattr(flat, array))
+        atomic_replace(file_path + '.tmp', file_path)
+    file_path = os.path.join(folder_name, PORTS_FILE)
+    with open(file_path + '.tmp', 'w', newline='') as ports_file:
+        csv.writer(ports_file, delimiter=';').writerows(zip(names, locodes))
+    atomic_replace(file_path + '.tmp', file_path)
+    return flat
+
+def load_catalog(folder_name : str, mmap : bool = True) -> Tuple[pd.DataFrame, FlatPolygons]:
+    """
+    Loads a catalog as the ports (name, locode and the first ring of the
+    polygon) and the prepared polygons. With mmap the arrays are memory
+    mapped instead of read.
+    """
+    file_path = os.path.join(folder_name, PORTS_FILE)
+    if not os.path.exists(file_path):
+        raise PathError(file_path)
+    ports = pd.read_csv(file_path, sep=';', header=None, names=['name', 'locode'], dtype=str, keep_default_na=False)
+    arrays = {
+        array : np.load(os.path.join(folder_name, array + '.npy'), mmap_mode='r' if mmap else None)
+        for array in ARRAYS
+    }
+    flat = FlatPolygons(polygon_amount=len(ports), **arrays)
+
+    # First ring of every polygon for the centroid of the port
+    first_ring = np.searchsorted(flat.ring_polygon, np.arange(len(ports)))
+    polygons : List[np.ndarray] = []
+    for k, ring in enumerate(first_ring):
+        if ring < len(flat.ring_polygon) and flat.ring_polygon[ring] == k:
+            polygons.append(np.asarray(flat.vertices[flat.ring_offsets[ring]:flat.ring_offsets[ring + 1]]))
+        else:
+            polygons.append(np.zeros((0, 2)))
+    ports['polygon'] = polygons
+    return ports, flat
+
+def catalog_from_text(file_path : str, folder_name : str) -> FlatPolygons:
+    """
+    Makes a catalog from a text file of port polygons with name;locode;polygon
+    rows, where polygon is "long lat,long lat,..." (Gatehouse_locode.csv).
+    """
+    if not os.path.exists(file_path):
+        raise PathError(file_path)
+    with open(file_path, newline='') as text_file:
+        rows = list(csv.reader(text_file, delimiter=';'))
+    # All coordinates are parsed at once
+    sizes = np.array([row[2].count(',') + 1 for row in rows], dtype=np.int64)
+    coordinates = np.array(','.join(row[2] for row in rows).replace(',', ' ').split(), dtype=float)
+    return save_catalog(
+        folder_name,
+        [row[0] for row in rows],
+        [row[1] for row in rows],
+        coordinates.reshape(-1, 2)[:, ::-1],
+        np.r_[0, np.cumsum(sizes)],
+        np.arange(len(rows)),
+        np.zeros(len(rows), dtype=bool)
+    )
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+Finds the port polygon positions are inside of.
+
+Positions are put in square cells of resolution_deg degrees. A cell which
+is entirely inside a polygon or outside every polygon has the same answer
+for all its positions, so the answer is kept in a bounded LRU cache of
+cells and only positions in cells crossed by a polygon edge are tested
+against the polygons. Ships at anchor or in port send many positions in
+the same cells, which are then answered from the cache.
+"""
+from collections import OrderedDict
+from typing import Dict, Sequence, Union
+import numpy as np                                                              # type: ignore
+import matplotlib.path as mplPath                                               # type: ignore
+from matplotlib.transforms import Bbox                                          # type: ignore
+from modules.polygon_kernel import FlatPolygons, flatten_polygons, polygon_index
+
+# Answer of a cell crossed by a polygon edge
+BOUNDARY = -2
+# Size in degrees of the grid of cells near a polygon
+COARSE_DEG = 0.1
+
+class PortLookup():
+    """
+    Port lookup over a list of port polygons with (lat, long) vertices, or
+    prepared polygons with holes and several parts given as flat (e.g. from
+    a port catalog).
+    If a position is inside more than one polygon the first polygon is used.
+    resolution_deg is the size of the cached cells (None disables the cache)
+    and cache_size the number of cells kept.
+    """
+    def __init__(
+        self,
+        polygons : Sequence[np.ndarray] = (),
+        resolution_deg : Union[float, None] = 1e-3,
+        cache_size : int = 2**16,
+        flat : Union[FlatPolygons, None] = None
+    ) -> None:
+        # Prepared polygons for the exact test, made once per port catalog
+        if flat is None:
+            flat = flatten_polygons([[np.asarray(polygon, dtype=float)] for polygon in polygons])
+        self._flat : FlatPolygons = flat
+        # Rings of every polygon
+        self._ring_start = np.searchsorted(flat.ring_polygon, np.arange(flat.polygon_amount + 1))
+        self._paths : Dict[int, mplPath.Path] = {}
+        self._closed_paths : Dict[int, mplPath.Path] = {}
+        self.resolution_deg = resolution_deg
+        self.cache_size = cache_size
+        self._cells : 'OrderedDict[int, int]' = OrderedDict()
+        self._coarse_cells : Union[np.ndarray, None] = None
+        # Positions looked up and positions answered from the cache
+        self.lookups = 0
+        self.hits = 0
+        # Positions in the exact test, inside a bounding box and tested against edges
+        self.exact_lookups = 0
+        self.bbox_candidates = 0
+        self.edge_tests = 0
+
+        # Bounding boxes of all polygons (empty polygons match nothing)
+        amount = flat.polygon_amount
+        self.lat_min = np.full(amount, np.inf)
+        self.long_min = np.full(amount, np.inf)
+        self.lat_max = np.full(amount, -np.inf)
+        self.long_max = np.full(amount, -np.inf)
+        np.minimum.at(self.lat_min, flat.ring_polygon, flat.ring_bbox[:, 0])
+        np.minimum.at(self.long_min, flat.ring_polygon, flat.ring_bbox[:, 1])
+        np.maximum.at(self.lat_max, flat.ring_polygon, flat.ring_bbox[:, 2])
+        np.maximum.at(self.long_max, flat.ring_polygon, flat.ring_bbox[:, 3])
+
+    def __len__(self) -> int:
+        return self._flat.polygon_amount
+
+    @property
+    def polygons(self) -> FlatPolygons:
+        """The prepared polygons of the lookup."""
+        return self._flat
+
+    @property
+    def hit_rate(self) -> float:
+        """Share of the looked up positions answered from the cache."""
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    @property
+    def edge_test_rate(self) -> float:
+        """
+        Share of the positions in the exact test which were tested against
+        polygon edges (the others were rejected by a bounding box or accepted
+        by the rectangle inside a polygon).
+        """
+        return self.edge_tests / self.exact_lookups if self.exact_lookups else 0.0
+
+    def _exact(self, lat : np.ndarray, long : np.ndarray) -> np.ndarray:
+        """Tests the positions against the prepared polygons."""
+        port_index, candidates, edge_tests = polygon_index(
+            lat, long, self._flat, include_holes=False, return_tests=True
+        )
+        self.exact_lookups += len(lat)
+        self.bbox_candidates += candidates
+        self.edge_tests += edge_tests
+        return port_index
+
+    @staticmethod
+    def _keys(lat : np.ndarray, long : np.ndarray, size : float) -> np.ndarray:
+        """Key of the cell of size degrees of every position."""
+        row = np.floor(lat / size).astype(np.int64)
+        column = np.floor(long / size).astype(np.int64)
+        # Columns cover -180..180 degrees with any size above 1e-6
+        return row * 2**29 + column + 2**28
+
+    def _cell_keys(self, lat : np.ndarray, long : np.ndarray) -> np.ndarray:
+        """Key of the cached cell of every position."""
+        return self._keys(lat, long, self.resolution_deg)
+
+    def _cell_bbox(self, key : int) -> Bbox:
+        """Bounding box of a cached cell."""
+        row, column = divmod(key, 2**29)
+        column -= 2**28
+        size = self.resolution_deg
+        # Padded so rounding of the cell keys can not put a position outside its cell
+        pad = size * 1e-6
+        return Bbox.from_extents(
+            row * size - pad, column * size - pad,
+            (row + 1) * size + pad, (column + 1) * size + pad
+        )
+
+    def _candidates(self, cell : Bbox) -> np.ndarray:
+        """Indexes of the polygons with a bounding box overlapping cell."""
+        return np.flatnonzero(
+            (self.lat_min < cell.x1) & (self.lat_max > cell.x0)
+            & (self.long_min < cell.y1) & (self.long_max > cell.y0)
+        )
+
+    def _classify(self, key : int) -> int:
+        """
+        Answer of a cell: the polygon it is inside of, -1 if it is outside
+        every polygon or BOUNDARY if a polygon edge crosses it.
+        """
+        cell = self._cell_bbox(key)
+        flat = self._flat
+        for k in self._candidates(cell):
+            for r in range(self._ring_start[k], self._ring_start[k + 1]):
+                if r not in self._closed_paths:
+                    ring = flat.vertices[flat.ring_offsets[r]:flat.ring_offsets[r + 1]]
+                    self._closed_paths[r] = mplPath.Path(np.vstack([ring, ring[:1]]))
+                if self._closed_paths[r].intersects_bbox(cell, filled=False):
+                    return BOUNDARY
+            if self._polygon_contains(k, (cell.x0 + cell.x1) / 2, (cell.y0 + cell.y1) / 2):
+                return int(k)
+        return -1
+
+    def _polygon_contains(self, k : int, lat : float, long : float) -> bool:
+        """
+        Checks if polygon k contains a position, which is inside it if the
+        last ring of the polygon the position is inside of is not a hole.
+        """
+        flat = self._flat
+        inside = False
+        for r in range(self._ring_start[k], self._ring_start[k + 1]):
+            x_min, y_min, x_max, y_max = flat.ring_bbox[r]
+            if not (x_min < lat < x_max and y_min < long < y_max):
+                continue
+            inner = flat.ring_inner[r]
+            if not (inner[0] < lat < inner[2] and inner[1] < long < inner[3]):
+                if r not in self._paths:
+                    self._paths[r] = mplPath.Path(flat.vertices[flat.ring_offsets[r]:flat.ring_offsets[r + 1]])
+                if not self._paths[r].contains_point((lat, long)):
+                    continue
+            inside = not flat.ring_hole[r]
+        return inside
+
+    def _cell_answers(self, keys : np.ndarray) -> np.ndarray:
+        """Answer of every cell, from the cache or classified and cached."""
+        answers = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys.tolist()):
+            answer = self._cells.get(key)
+            if answer is None:
+                answer = self._classify(key)
+                self._cells[key] = answer
+                if len(self._cells) > self.cache_size:
+                    self._cells.popitem(last=False)
+            else:
+                self._cells.move_to_end(key)
+            answers[i] = answer
+        return answers
+
+    def _near(self, keys : np.ndarray) -> np.ndarray:
+        """
+        Mask of the cells which can overlap the bounding box of a polygon,
+        from a coarse grid of the cells around the bounding boxes.
+        """
+        size = self.resolution_deg
+        coarse = max(COARSE_DEG, size)
+        if self._coarse_cells is None:
+            coarse_cells = [np.array([], dtype=np.int64)]
+            for lat_min, long_min, lat_max, long_max in self._flat.ring_bbox:
+                rows = np.arange(
+                    np.floor((lat_min - 2 * size) / coarse),
+                    np.floor((lat_max + 2 * size) / coarse) + 1
+                )
+                columns = np.arange(
+                    np.floor((long_min - 2 * size) / coarse),
+                    np.floor((long_max + 2 * size) / coarse) + 1
+                )
+                coarse_cells.append((np.add.outer(rows * 2**29, columns + 2**28)).astype(np.int64).ravel())
+            self._coarse_cells = np.unique(np.concatenate(coarse_cells))
+        lat = (keys // 2**29) * size
+        long = (keys % 2**29 - 2**28) * size
+        return np.isin(self._keys(lat, long, coarse), self._coarse_cells)
+
+    def lookup(self, lat : np.ndarray, long : np.ndarray) -> np.ndarray:
+        """
+        Returns the index of the polygon every position is inside of
+        (-1 for positions outside every polygon).
+        """
+        lat = np.asarray(lat, dtype=float)
+        long = np.asarray(long, dtype=float)
+        if self.resolution_deg is None:
+            self.lookups += len(lat)
+            return self._exact(lat, long)
+
+        # Positions without coordinates are outside every polygon
+        port_index = np.full(len(lat), -1, dtype=np.int64)
+        valid = np.flatnonzero(np.isfinite(lat) & np.isfinite(long))
+        keys, inverse = np.unique(self._cell_keys(lat[valid], long[valid]), return_inverse=True)
+
+        # Only cells near a polygon are classified and cached
+        answers = np.full(len(keys), -1, dtype=np.int64)
+        near = self._near(keys)
+        answers[near] = self._cell_answers(keys[near])
+        port_index[valid] = answers[inverse]
+
+        boundary = valid[answers[inverse] == BOUNDARY]
+        if len(boundary):
+            port_index[boundary] = self._exact(lat[boundary], long[boundary])
+        self.lookups += len(lat)
+        self.hits += len(lat) - len(boundary)
+        return port_index
+
+    def lookup_point(self, lat : float, long : float) -> int:
+        """
+        Returns the index of the polygon a single position is inside of
+        (-1 if it is outside every polygon).
+        """
+        self.lookups += 1
+        if self.resolution_deg is not None and np.isfinite(lat) and np.isfinite(long):
+            answer = self._cell_answers(self._cell_keys(np.array([lat]), np.array([long])))[0]
+            if answer != BOUNDARY:
+                self.hits += 1
+                return int(answer)
+
+        # Same bounding box test as mask_from_polygons
+        candidates = np.flatnonzero(
+            (self.lat_min < lat) & (self.lat_max > lat)
+            & (self.long_min < long) & (self.long_max > long)
+        )
+        for k in candidates:
+            if self._polygon_contains(k, lat, long):
+                return int(k)
+        return -1
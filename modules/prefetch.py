@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Read-ahead of day files.
+
+The day files are read by a pool of threads while the files before them
+are parsed, so reading from (network) storage and parsing overlap and the
+import takes about the time of the slower of the two instead of their
+sum. At most depth files are read ahead, which bounds the memory of the
+buffers waiting to be parsed.
+"""
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, Iterable, Iterator, TypeVar
+from modules.errors import WrongArguments
+
+Item = TypeVar('Item')
+Result = TypeVar('Result')
+
+def read_ahead(
+    items : Iterable[Item],
+    function : Callable[[Item], Result],
+    depth : int = 8,
+    workers : int = 2
+) -> Iterator[Result]:
+    """
+    Yields function(item) for every item in order. The next depth items are
+    run by workers threads while the results before them are used.
+    """
+    if depth < 1 or workers < 1:
+        raise WrongArguments("The read-ahead depth and workers must be at least 1")
+    items = iter(items)
+    pending : Deque[Future] = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) >= depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Files not used (error or stopped early) are not read
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""
+Deterministic sampling of ships.
+
+A ship is in a sample if the CRC32 of the seed and its mmsi is below
+fraction of all CRC32 values. The choice only depends on the mmsi, so a
+ship is in the sample on every day (complete trips are kept), the sample
+is the same on every run and machine, and a smaller fraction with the
+same seed is a subset of a larger one.
+"""
+import zlib
+from typing import Iterable, Union
+import numpy as np                                                              # type: ignore
+from modules.errors import WrongArguments
+
+def check_fraction(fraction : Union[float, None]) -> Union[float, None]:
+    """Raises WrongArguments if fraction is not in (0, 1]."""
+    if fraction is not None and not 0 < fraction <= 1:
+        raise WrongArguments("The sample fraction must be above 0 and at most 1, not {0}".format(fraction))
+    return fraction
+
+def in_sample(mmsi : Iterable[Union[str, bytes]], fraction : float, seed : int = 0) -> np.ndarray:
+    """Mask of the mmsi in the sample of fraction of all ships."""
+    prefix = zlib.crc32(str(seed).encode() + b':')
+    limit = fraction * 2**32
+    return np.array([
+        zlib.crc32(ship if isinstance(ship, bytes) else str(ship).encode(), prefix) < limit
+        for ship in mmsi
+    ], dtype=bool)
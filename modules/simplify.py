@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Trajectory simplification with Douglas-Peucker.
+
+All trips are simplified at the same time: every iteration handles the
+current segments of every trip with numpy, so the number of python
+iterations is the depth of the Douglas-Peucker recursion and not the
+number of trips or points.
+"""
+import numpy as np                                                              # type: ignore
+from modules.errors import WrongArguments
+
+EARTH_RADIUS_M = 6371008.8
+METHODS = ('dp', 'sed')
+
+def _segment_rows(starts : np.ndarray, ends : np.ndarray) -> np.ndarray:
+    """Rows strictly between start and end of every segment."""
+    lengths = np.maximum(ends - starts - 1, 0)
+    offsets = np.repeat(starts + 1 - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+def _distances(
+    x : np.ndarray,
+    y : np.ndarray,
+    seconds : np.ndarray,
+    rows : np.ndarray,
+    start : np.ndarray,
+    end : np.ndarray,
+    method : str
+) -> np.ndarray:
+    """
+    Distance in metres from the rows to the segments from start to end.
+    'dp' is the distance to the line segment and 'sed' is the distance to
+    the position on the segment at the time of the row.
+    """
+    dx = x[end] - x[start]
+    dy = y[end] - y[start]
+    if method == 'dp':
+        length = dx**2 + dy**2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = ((x[rows] - x[start]) * dx + (y[rows] - y[start]) * dy) / length
+        fraction = np.clip(np.nan_to_num(fraction), 0, 1)
+    else:
+        duration = seconds[end] - seconds[start]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = (seconds[rows] - seconds[start]) / duration
+        fraction = np.nan_to_num(fraction)
+    return np.hypot(x[start] + fraction * dx - x[rows], y[start] + fraction * dy - y[rows])
+
+def simplify_mask(
+    lat : np.ndarray,
+    long : np.ndarray,
+    seconds : np.ndarray,
+    trip_starts : np.ndarray,
+    tolerance_m : float,
+    method : str = 'sed'
+) -> np.ndarray:
+    """
+    Returns a mask of the points to keep.
+    The points should be sorted by trip and time, and trip_starts holds the
+    first row of every trip. The first and last point of every trip are
+    always kept and no removed point is further than tolerance_m metres
+    from the simplified trip (measured at the same time for 'sed').
+    """
+    if method not in METHODS:
+        raise WrongArguments(
+            "method was {0}, but should be one of the following {1}".format(method, list(METHODS))
+        )
+    size = len(lat)
+    keep = np.zeros(size, dtype=bool)
+    if size == 0:
+        return keep
+
+    # Project every trip to metres around its mean latitude
+    trip_ends = np.append(trip_starts[1:], size)
+    trip_lengths = trip_ends - trip_starts
+    mean_lat = np.add.reduceat(lat, trip_starts) / trip_lengths
+    cos_lat = np.repeat(np.cos(np.radians(mean_lat)), trip_lengths)
+    x = EARTH_RADIUS_M * np.radians(long) * cos_lat
+    y = EARTH_RADIUS_M * np.radians(lat)
+
+    keep[trip_starts] = True
+    keep[trip_ends - 1] = True
+    start = trip_starts
+    end = trip_ends - 1
+    while len(start):
+        # Only segments with points between the ends have to be checked
+        open_segment = end - start > 1
+        start, end = start[open_segment], end[open_segment]
+        if len(start) == 0:
+            break
+        rows = _segment_rows(start, end)
+        lengths = end - start - 1
+        segment = np.repeat(np.arange(len(start)), lengths)
+        distance = _distances(x, y, seconds, rows, start[segment], end[segment], method)
+        # Points without a position are always kept
+        distance[np.isnan(distance)] = np.inf
+
+        # The furthest point of every segment
+        offsets = np.cumsum(lengths) - lengths
+        furthest = np.maximum.reduceat(distance, offsets)
+        first_max = np.flatnonzero(distance == furthest[segment])
+        _, first = np.unique(segment[first_max], return_index=True)
+        split = rows[first_max[first]]
+
+        # Split the segments where the furthest point is outside tolerance
+        outside = furthest > tolerance_m
+        split = split[outside]
+        keep[split] = True
+        start, end = (
+            np.concatenate([start[outside], split]),
+            np.concatenate([split, end[outside]])
+        )
+    return keep
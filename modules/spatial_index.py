@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+Grid index over interpolated positions.
+
+The positions are put into square lat/long cells. For every cell the
+index holds postings (trip id, first row, last row) of the runs of rows a
+trip has inside the cell, so area and nearest trip queries only look at
+the rows in the cells close to the query.
+"""
+import math
+from typing import Tuple, Union
+import numpy as np                                                              # type: ignore
+import pandas as pd                                                             # type: ignore
+from haversine import haversine_vector                                          # type: ignore
+from modules.points_in_polygons.points_in_polygons import mask_from_polygons
+from modules.errors import WrongArguments
+
+EARTH_RADIUS_KM = 6371.0088
+
+class SpatialIndex():
+    """
+    Grid index with postings from cells to (trip id, row range).
+    """
+    def __init__(
+        self,
+        interpolated_routes : pd.DataFrame,
+        cell_size : float = 0.1
+    ) -> None:
+        if cell_size <= 0:
+            raise WrongArguments("cell_size should be positive but was {0}".format(cell_size))
+        self.cell_size = cell_size
+        self._columns = int(math.ceil(360 / cell_size)) + 1
+
+        # Rows sorted by trip and time so a trip is a contiguous block
+        self.frame = interpolated_routes.sort_values(['id', 'time'], kind='stable').reset_index(drop=True)
+        self.lat = self.frame['lat'].values.astype(float)
+        self.long = self.frame['long'].values.astype(float)
+        ids = self.frame['id'].values
+        valid = ~(np.isnan(self.lat) | np.isnan(self.long))
+        cells = np.where(valid, self.__cells(self.lat, self.long), -1)
+
+        # Runs of rows with the same trip and cell are one posting
+        change = np.ones(len(ids), dtype=bool)
+        change[1:] = (ids[1:] != ids[:-1]) | (cells[1:] != cells[:-1])
+        starts = np.flatnonzero(change)
+        ends = np.append(starts[1:], len(ids))
+        keep = cells[starts] >= 0
+        starts, ends = starts[keep], ends[keep]
+
+        # Postings sorted by cell
+        order = np.argsort(cells[starts], kind='stable')
+        self.posting_cell = cells[starts][order]
+        self.posting_id = ids[starts][order]
+        self.posting_start = starts[order]
+        self.posting_end = ends[order]
+        self.cells, self._cell_offset = np.unique(self.posting_cell, return_index=True)
+        self._cell_offset = np.append(self._cell_offset, len(self.posting_cell))
+        self._cell_row = self.cells // self._columns
+        self._cell_column = self.cells % self._columns
+
+    def __cells(self, lat : np.ndarray, long : np.ndarray) -> np.ndarray:
+        """Cell number of every position."""
+        row = np.floor((np.asarray(lat) + 90) / self.cell_size).astype(np.int64)
+        column = np.floor((np.asarray(long) + 180) / self.cell_size).astype(np.int64)
+        return row * self._columns + column
+
+    def __postings(
+        self,
+        row_range : Tuple[int, int],
+        column_range : Tuple[int, int]
+    ) -> np.ndarray:
+        """Positions of the postings in the cells inside the row and column range."""
+        inside = np.flatnonzero(
+            (self._cell_row >= row_range[0]) & (self._cell_row <= row_range[1])
+            & (self._cell_column >= column_range[0]) & (self._cell_column <= column_range[1])
+        )
+        lengths = self._cell_offset[inside + 1] - self._cell_offset[inside]
+        offsets = np.repeat(self._cell_offset[inside] - np.cumsum(lengths) + lengths, lengths)
+        return offsets + np.arange(lengths.sum())
+
+    def __rows(self, postings : np.ndarray) -> np.ndarray:
+        """Row numbers of the given postings."""
+        lengths = self.posting_end[postings] - self.posting_start[postings]
+        offsets = np.repeat(self.posting_start[postings] - np.cumsum(lengths) + lengths, lengths)
+        return offsets + np.arange(lengths.sum())
+
+    def __box_postings(
+        self,
+        lat_min : float,
+        long_min : float,
+        lat_max : float,
+        long_max : float
+    ) -> np.ndarray:
+        """Postings of the cells touching the box."""
+        low = self.__cells(lat_min, long_min)
+        high = self.__cells(lat_max, long_max)
+        return self.__postings(
+            (low // self._columns, high // self._columns),
+            (low % self._columns, high % self._columns)
+        )
+
+    def bbox(
+        self,
+        lat_min : float,
+        long_min : float,
+        lat_max : float,
+        long_max : float
+    ) -> np.ndarray:
+        """Sorted ids of the trips with a position inside the box."""
+        rows = self.__rows(self.__box_postings(lat_min, long_min, lat_max, long_max))
+        inside = (
+            (self.lat[rows] >= lat_min) & (self.lat[rows] <= lat_max)
+            & (self.long[rows] >= long_min) & (self.long[rows] <= long_max)
+        )
+        return np.unique(self.frame['id'].values[rows[inside]])
+
+    def polygon(self, polygon : Union[pd.DataFrame, np.ndarray]) -> np.ndarray:
+        """
+        Sorted ids of the trips with a position inside the polygon.
+        The polygon is a dataframe with the columns lat and long
+        (as clean_ais.polygon) or an array of (lat, long) vertices.
+        """
+        vertices = polygon[['lat', 'long']].values if isinstance(polygon, pd.DataFrame) else np.asarray(polygon)
+        lat_min, long_min = np.min(vertices, axis=0)
+        lat_max, long_max = np.max(vertices, axis=0)
+        rows = self.__rows(self.__box_postings(lat_min, long_min, lat_max, long_max))
+        if len(rows) == 0:
+            return np.array([], dtype=self.frame['id'].dtype)
+
+        # Exact test only on the rows in the candidate cells
+        polygon_tuple = [[list(zip(vertices[:, 0], vertices[:, 1]))]]
+        polygon_in = [[False]]
+        masks = mask_from_polygons(self.lat[rows], self.long[rows], polygon_tuple, polygon_in, include_holes=False)
+        inside = masks[0][0] if masks else np.array([], dtype=int)
+        return np.unique(self.frame['id'].values[rows[inside]])
+
+    def nearest(self, lat : float, long : float, k : int = 5) -> pd.DataFrame:
+        """
+        The k trips passing closest to a position.
+        Returns a dataframe with the trip id and the distance in km,
+        sorted by distance.
+        """
+        cell = self.__cells(lat, long)
+        row, column = cell // self._columns, cell % self._columns
+        if len(self.cells):
+            max_radius = int(max(
+                np.abs(self._cell_row - row).max(),
+                np.abs(self._cell_column - column).max()
+            ))
+        else:
+            max_radius = 0
+        radius = 1
+        while True:
+            rows = self.__rows(
+                self.__postings(
+                    (row - radius, row + radius),
+                    (column - radius, column + radius)
+                )
+            )
+            distance = haversine_vector(
+                np.tile([lat, long], (len(rows), 1)),
+                np.column_stack([self.lat[rows], self.long[rows]])
+            ) if len(rows) else np.array([])
+            closest = pd.DataFrame(
+                {'id' : self.frame['id'].values[rows], 'distance' : distance}
+            ).groupby('id')['distance'].min().nsmallest(k)
+
+            # Anything outside the searched cells is at least this far away
+            bound = EARTH_RADIUS_KM * math.radians(radius * self.cell_size) * max(
+                0.0,
+                math.cos(math.radians(min(90.0, abs(lat) + (radius + 1) * self.cell_size)))
+            )
+            if radius >= max_radius or (len(closest) == k and closest.iloc[-1] <= bound):
+                return closest.reset_index()
+            radius *= 2
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+Port call and trip detection on a live stream of AIS positions.
+
+The stream processor keeps a small state per mmsi (current port visit,
+open trip and last fix) and emits events with the same rules as
+clean_ais.create_routes:
+    - A port visit is the positions inside the same port polygon until the
+      ship is seen inside another port polygon (positions outside every
+      port in between are trips from the port back to itself).
+    - The ship has docked if the speed between the first and last position
+      of the visit inside the port is at most speed_limit knots, otherwise
+      it was passing by and all the positions are part of the trip.
+    - A trip is the positions between two docked port visits and is only
+      emitted if it has at least min_points positions.
+
+Both positions of the speed test are inside the port, so their distance
+is at most the longest way through the bounding box of the port. Once a
+visit is longer than it takes to go this way at speed_limit knots the
+ship has docked whatever its last position will be. The positions of a
+visit are kept until then, afterwards the trip and the arrival are
+emitted when the ship enters the port and the departure at the first
+position outside it, and only the last position inside the port is kept.
+Visits which end sooner are decided when the ship is seen in the next port.
+
+create_routes also removes the first and last trip of every ship because
+they are cut by the data range; here trips are emitted when their start
+port is known and their end port is reached.
+"""
+import asyncio
+import csv
+import math
+from datetime import datetime
+from typing import AsyncIterator, Iterable, Iterator, List, Mapping, NamedTuple, Sequence, Tuple, Union
+from haversine import haversine                                                 # type: ignore
+from modules.operating_system import OperatingSystem
+from modules.port_lookup import PortLookup
+from modules.compression import DAY_FILE_EXTENSIONS, open_text
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# (time, lat, long, sog, cog)
+Fix = Tuple[datetime, float, float, float, float]
+Message = Union[Sequence, Mapping]
+
+class PortArrival(NamedTuple):
+    """A ship arrived at a port."""
+    mmsi : str
+    locode : str
+    time : datetime
+    lat : float
+    long : float
+
+class PortDeparture(NamedTuple):
+    """A ship departed from a port."""
+    mmsi : str
+    locode : str
+    time : datetime
+    lat : float
+    long : float
+
+class Trip(NamedTuple):
+    """A completed trip between two ports."""
+    mmsi : str
+    from_locode : str
+    to_locode : str
+    to_time : datetime
+    points : List[Fix]
+
+Event = Union[PortArrival, PortDeparture, Trip]
+
+# Mean earth radius in km, as haversine
+EARTH_RADIUS_KM = 6371.0088
+
+class _Vessel():
+    """State of a single ship."""
+    __slots__ = ('port', 'first', 'last', 'inside', 'runs', 'from_port', 'trip', 'last_time')
+    def __init__(self) -> None:
+        # Port of the current visit (-1 if there is none), its first position,
+        # the last position inside the port and if the ship is inside it
+        self.port : int = -1
+        self.first : Union[Fix, None] = None
+        self.last : Union[Fix, None] = None
+        self.inside : bool = False
+        # Runs of positions of the visit, alternating inside and outside the
+        # port, until it is known that the ship has docked (then None)
+        self.runs : Union[List[List[Fix]], None] = []
+        # Port the open trip started from (-1 if it is unknown)
+        self.from_port : int = -1
+        self.trip : List[Fix] = []
+        self.last_time : Union[datetime, None] = None
+
+class StreamProcessor():
+    """
+    Detects port calls and trips from positions of many ships.
+    ports should be a dataframe as clean_ais.ports (name, locode, polygon)
+    or the lookup can be given directly with port_lookup and locodes.
+    """
+    def __init__(
+        self,
+        ports = None,
+        speed_limit : float = 3,
+        min_points : int = 10,
+        port_lookup : Union[PortLookup, None] = None,
+        locodes : Union[Sequence[str], None] = None
+    ) -> None:
+        self.port_lookup = port_lookup if port_lookup is not None else PortLookup(ports['polygon'].values)
+        self.locodes = list(locodes if locodes is not None else ports['locode'].values)
+        self.speed_limit = speed_limit
+        self.min_points = min_points
+        self.vessels : dict = {}
+        self.docked_hours = self.__docked_hours(self.port_lookup, speed_limit)
+
+    @staticmethod
+    def __docked_hours(port_lookup : PortLookup, speed_limit : float) -> List[float]:
+        """
+        Hours in every port after which a ship has docked: the time to go the
+        longest way between two positions in the bounding box of the port (up
+        and down the box and along its widest parallel) at speed_limit knots.
+        """
+        if speed_limit <= 0:
+            return [math.inf] * len(port_lookup.lat_min)
+        hours = []
+        for lat_min, lat_max, long_min, long_max in zip(
+            port_lookup.lat_min, port_lookup.lat_max, port_lookup.long_min, port_lookup.long_max
+        ):
+            widest = min(max(0, lat_min), lat_max)
+            height_km = EARTH_RADIUS_KM * math.radians(lat_max - lat_min)
+            width_km = EARTH_RADIUS_KM * math.cos(math.radians(widest)) * math.radians(long_max - long_min)
+            # Speed in knots (1 km/h = 0.53996 knots)
+            hours.append((2 * height_km + width_km) * 0.53996 / speed_limit)
+        return hours
+
+    @staticmethod
+    def __parse(message : Message) -> Tuple[str, Fix]:
+        """
+        Converts a message to (mmsi, fix).
+        A message is a mapping with the keys mmsi, time, lat, long, sog and cog
+        or a sequence in the order of the day files (mmsi, time, long, lat, sog, cog).
+        """
+        if isinstance(message, Mapping):
+            mmsi, timestamp = message['mmsi'], message['time']
+            lat, long = message['lat'], message['long']
+            sog, cog = message.get('sog', float('nan')), message.get('cog', float('nan'))
+        else:
+            mmsi, timestamp, long, lat, sog, cog = message
+        if isinstance(timestamp, str):
+            timestamp = datetime.strptime(timestamp, TIME_FORMAT)
+        return str(mmsi), (timestamp, float(lat), float(long), float(sog), float(cog))
+
+    def process(self, message : Message) -> List[Event]:
+        """
+        Processes a single position and returns the events it completes.
+        Positions older than the last position of the ship are ignored.
+        """
+        mmsi, fix = self.__parse(message)
+        vessel = self.vessels.get(mmsi)
+        if vessel is None:
+            vessel = self.vessels[mmsi] = _Vessel()
+        if vessel.last_time is not None and fix[0] < vessel.last_time:
+            return []
+        vessel.last_time = fix[0]
+
+        port = self.port_lookup.lookup_point(fix[1], fix[2])
+        events : List[Event] = []
+        if port != -1 and vessel.port not in (-1, port):
+            events = self.__close_visit(mmsi, vessel)
+        if vessel.port == -1:
+            if port == -1:
+                vessel.trip.append(fix)
+                return events
+            vessel.port = port
+            vessel.first = fix
+            vessel.runs = []
+        inside = port != -1
+        if vessel.runs is None:
+            # Docked, the events are emitted when the ship enters and leaves the port
+            if inside and not vessel.inside:
+                events += self.__arrive(mmsi, vessel, fix)
+            elif not inside and vessel.inside:
+                events.append(PortDeparture(mmsi, self.locodes[vessel.port], *vessel.last[:3]))
+                vessel.trip = []
+        elif vessel.runs and inside == (len(vessel.runs) % 2 == 1):
+            # Same side of the port polygon as the last position
+            vessel.runs[-1].append(fix)
+        else:
+            vessel.runs.append([fix])
+        if inside:
+            vessel.last = fix
+            hours = (fix[0] - vessel.first[0]).total_seconds() / 3600
+            if vessel.runs is not None and hours > self.docked_hours[port]:
+                events += self.__dock(mmsi, vessel)
+        elif vessel.runs is None:
+            vessel.trip.append(fix)
+        vessel.inside = inside
+        return events
+
+    def __arrive(self, mmsi : str, vessel : _Vessel, fix : Fix) -> List[Event]:
+        """Emits the trip to the port of the visit and the arrival at fix."""
+        locode = self.locodes[vessel.port]
+        events : List[Event] = []
+        if vessel.from_port != -1 and len(vessel.trip) >= self.min_points:
+            events.append(Trip(mmsi, self.locodes[vessel.from_port], locode, fix[0], vessel.trip))
+        events.append(PortArrival(mmsi, locode, fix[0], fix[1], fix[2]))
+        vessel.from_port = vessel.port
+        vessel.trip = []
+        return events
+
+    def __dock(self, mmsi : str, vessel : _Vessel) -> List[Event]:
+        """
+        Emits the events of the runs of a visit where the ship docked and
+        only keeps the positions of the trip after the last run inside the port.
+        """
+        runs = vessel.runs
+        # Positions after the last one inside the port belong to the next trip
+        trailing = runs.pop() if len(runs) % 2 == 0 else None
+        locode = self.locodes[vessel.port]
+        events : List[Event] = []
+        stays = runs[::2]
+        for number, stay in enumerate(stays):
+            if number > 0:
+                vessel.trip = runs[2 * number - 1]
+            events += self.__arrive(mmsi, vessel, stay[0])
+            if number < len(stays) - 1 or trailing is not None:
+                events.append(PortDeparture(mmsi, locode, *stay[-1][:3]))
+        vessel.trip = trailing if trailing is not None else []
+        vessel.runs = None
+        return events
+
+    def __close_visit(self, mmsi : str, vessel : _Vessel) -> List[Event]:
+        """Checks if the ship docked during the visit and emits the events."""
+        events : List[Event] = []
+        if vessel.runs is not None:
+            first, last = vessel.first, vessel.last
+            hours = (last[0] - first[0]).total_seconds() / 3600
+            # Speed in knots (1 km/h = 0.53996 knots)
+            if hours > 0 and haversine(first[1:3], last[1:3]) / hours * 0.53996 <= self.speed_limit:
+                events = self.__dock(mmsi, vessel)
+            else:
+                # Passing by, the positions are part of the trip
+                for run in vessel.runs:
+                    vessel.trip.extend(run)
+        if vessel.runs is None and vessel.inside:
+            events.append(PortDeparture(mmsi, self.locodes[vessel.port], *vessel.last[:3]))
+            vessel.trip = []
+        vessel.port = -1
+        vessel.first = vessel.last = None
+        vessel.inside = False
+        vessel.runs = []
+        return events
+
+    def flush(self) -> List[Event]:
+        """
+        Closes the open port visits, e.g. at the end of a replay.
+        Open trips are not completed and are kept.
+        """
+        events : List[Event] = []
+        for mmsi, vessel in self.vessels.items():
+            if vessel.port != -1:
+                events += self.__close_visit(mmsi, vessel)
+        return events
+
+    def run(self, messages : Iterable[Message]) -> Iterator[Event]:
+        """Processes an iterable of positions and yields the events."""
+        for message in messages:
+            yield from self.process(message)
+
+    async def run_async(self, queue : asyncio.Queue) -> AsyncIterator[Event]:
+        """
+        Processes positions from an asyncio queue and yields the events.
+        Stops when None is taken from the queue.
+        """
+        while True:
+            message = await queue.get()
+            if message is None:
+                break
+            for event in self.process(message):
+                yield event
+
+def replay_files(folder_path : str, file_amount : int = -1) -> Iterator[Tuple]:
+    """
+    Replays the day files of a folder as a stream of positions
+    in the order of the day files (mmsi, time, long, lat, sog, cog).
+    """
+    operating_system = OperatingSystem()
+    files = sorted(operating_system.get_files(folder_path, extensions=DAY_FILE_EXTENSIONS))
+    files = files if file_amount == -1 else files[:file_amount]
+    for file in files:
+        with open_text(operating_system.check_path(folder_path, file)) as csvfile:
+            rows = list(csv.reader(csvfile, delimiter=';'))
+        # Sort by time (the time format sorts as text)
+        rows.sort(key=lambda row: row[1])
+        for mmsi, timestamp, long, lat, sog, cog in rows:
+            yield (
+                mmsi,
+                datetime.strptime(timestamp, TIME_FORMAT),
+                float(long or 'nan'),
+                float(lat or 'nan'),
+                float(sog or 'nan'),
+                float(cog or 'nan')
+            )
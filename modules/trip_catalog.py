@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Indexed catalog over the trips made by clean_ais.
+
+The catalog keeps routes, interpolated routes and waypoints sorted by
+trip id together with the row span of every trip, so trips can be
+looked up by port pair, mmsi and time window without scanning the frames.
+"""
+from typing import Dict, Iterable, Tuple, Union
+import numpy as np                                                              # type: ignore
+import pandas as pd                                                             # type: ignore
+from modules.errors import NotdefinedError, WrongArguments
+
+MmsiLike = Union[str, int, Iterable[Union[str, int]], None]
+TimeLike = Union[str, pd.Timestamp, None]
+
+class TripCatalog():
+    """
+    Catalog of trips with an inverted index on port pairs, an index on mmsi
+    and an interval index on the time of the trips.
+    """
+    def __init__(
+        self,
+        routes : Union[pd.DataFrame, None] = None,
+        interpolated_routes : Union[pd.DataFrame, None] = None,
+        waypoints : Union[pd.DataFrame, None] = None
+    ) -> None:
+        # Frames sorted by id and the row span of every id in them
+        self.frames : Dict[str, pd.DataFrame] = {}
+        self.spans : Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        for name, frame in (
+            ('routes', routes),
+            ('interpolated_routes', interpolated_routes),
+            ('waypoints', waypoints)
+        ):
+            if frame is not None:
+                self.__add_frame(name, frame)
+        if not self.frames:
+            raise NotdefinedError("routes")
+
+        # One row per trip, taken from the most detailed frame
+        name = next(iter(self.frames))
+        frame = self.frames[name]
+        ids, starts, ends = self.spans[name]
+        self.trips = pd.DataFrame(
+            {
+                'mmsi' : frame['mmsi'].values[starts],
+                'from_locode' : frame['from_locode'].values[starts],
+                'to_locode' : frame['to_locode'].values[starts],
+                'start_time' : frame['time'].values[starts],
+                'end_time' : frame['time'].values[ends - 1],
+            },
+            index = pd.Index(ids, name='id')
+        )
+
+        # Inverted indexes from keys to sorted arrays of trip ids
+        self.port_pairs = self.__inverted_index(['from_locode', 'to_locode'])
+        self.from_ports = self.__inverted_index('from_locode')
+        self.to_ports = self.__inverted_index('to_locode')
+        self.ships = self.__inverted_index('mmsi')
+
+        # Interval index: trips sorted by start time and the running
+        # maximum of their end times
+        order = np.argsort(self.trips['start_time'].values, kind='stable')
+        self._time_ids = ids[order]
+        self._time_starts = self.trips['start_time'].values[order]
+        self._time_ends = self.trips['end_time'].values[order]
+        self._time_max_ends = np.maximum.accumulate(self._time_ends)
+
+    def __add_frame(self, name : str, frame : pd.DataFrame) -> None:
+        """Sorts a frame by id and saves the row span of every id."""
+        if not frame['id'].is_monotonic_increasing:
+            frame = frame.iloc[np.argsort(frame['id'].values, kind='stable')]
+        frame = frame.reset_index(drop=True)
+        id_values = frame['id'].values
+        boundaries = np.flatnonzero(id_values[1:] != id_values[:-1]) + 1
+        starts = np.concatenate([[0], boundaries]) if len(id_values) else np.array([], dtype=int)
+        ends = np.concatenate([boundaries, [len(id_values)]]) if len(id_values) else np.array([], dtype=int)
+        self.frames[name] = frame
+        self.spans[name] = (id_values[starts], starts, ends)
+
+    def __inverted_index(self, columns : Union[str, list]) -> Dict:
+        """Maps every value of columns to the sorted ids of its trips."""
+        return {
+            key : np.sort(ids.values)
+            for key, ids in self.trips.reset_index().groupby(columns)['id']
+        }
+
+    def __time_ids(self, start_time : TimeLike, end_time : TimeLike) -> np.ndarray:
+        """Ids of trips overlapping the time window."""
+        low = 0
+        high = len(self._time_ids)
+        if end_time is not None:
+            high = np.searchsorted(self._time_starts, np.datetime64(pd.Timestamp(end_time)), side='right')
+        if start_time is not None:
+            start = np.datetime64(pd.Timestamp(start_time))
+            low = np.searchsorted(self._time_max_ends, start, side='left')
+            if low < high:
+                inside = self._time_ends[low:high] >= start
+                return np.sort(self._time_ids[low:high][inside])
+        return np.sort(self._time_ids[low:high])
+
+    def trip_ids(
+        self,
+        from_locode : Union[str, None] = None,
+        to_locode : Union[str, None] = None,
+        mmsi : MmsiLike = None,
+        start_time : TimeLike = None,
+        end_time : TimeLike = None
+    ) -> np.ndarray:
+        """
+        Returns the sorted ids of the trips matching every given argument.
+        A trip matches the time window if it overlaps it.
+        """
+        candidates = []
+        if from_locode is not None and to_locode is not None:
+            candidates.append(self.port_pairs.get((from_locode, to_locode), np.array([], dtype=int)))
+        elif from_locode is not None:
+            candidates.append(self.from_ports.get(from_locode, np.array([], dtype=int)))
+        elif to_locode is not None:
+            candidates.append(self.to_ports.get(to_locode, np.array([], dtype=int)))
+        if mmsi is not None:
+            ships = [mmsi] if isinstance(mmsi, (str, int)) else mmsi
+            ship_ids = [self.ships[str(ship)] for ship in ships if str(ship) in self.ships]
+            candidates.append(
+                np.unique(np.concatenate(ship_ids)) if ship_ids else np.array([], dtype=int)
+            )
+        if start_time is not None or end_time is not None:
+            candidates.append(self.__time_ids(start_time, end_time))
+
+        if not candidates:
+            return self.trips.index.values
+        ids = candidates[0]
+        for other in candidates[1:]:
+            ids = np.intersect1d(ids, other, assume_unique=True)
+        return ids
+
+    def rows(self, name : str, ids : np.ndarray) -> pd.DataFrame:
+        """Returns the rows of the trips ids from the frame name."""
+        if name not in self.frames:
+            raise WrongArguments(
+                "name was {0}, but should be one of the following {1}".format(
+                    name,
+                    list(self.frames)
+                )
+            )
+        span_ids, starts, ends = self.spans[name]
+        ids = np.asarray(ids)
+        position = np.searchsorted(span_ids, ids)
+        found = position < len(span_ids)
+        found[found] = span_ids[position[found]] == ids[found]
+        position = position[found]
+        lengths = ends[position] - starts[position]
+        # Row numbers of all the spans without a python loop
+        offsets = np.repeat(starts[position] - np.cumsum(lengths) + lengths, lengths)
+        return self.frames[name].iloc[offsets + np.arange(lengths.sum())]
+
+    def routes(self, **query) -> pd.DataFrame:
+        """Routes of the trips matching the query (see trip_ids)."""
+        return self.rows('routes', self.trip_ids(**query))
+
+    def interpolated_routes(self, **query) -> pd.DataFrame:
+        """Interpolated routes of the trips matching the query (see trip_ids)."""
+        return self.rows('interpolated_routes', self.trip_ids(**query))
+
+    def waypoints(self, **query) -> pd.DataFrame:
+        """Waypoints of the trips matching the query (see trip_ids)."""
+        return self.rows('waypoints', self.trip_ids(**query))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Trip filter with per trip predicates.
+
+Every predicate gives a value per trip, a trip is dropped by the first
+predicate it fails and every frame is compacted once with the keep mask
+of its trips. The reason every trip was dropped is kept for a report.
+"""
+from typing import Dict, Tuple, Union
+import numpy as np                                                              # type: ignore
+import pandas as pd                                                             # type: ignore
+from modules.displacement import min_bucket_displacement
+
+class TripFilter():
+    """
+    Keep mask of the trips with the ids.
+    The rows of a frame are mapped to their trip number once (codes) and the
+    predicates are evaluated with bincount style reductions over them.
+    """
+    def __init__(self, ids : np.ndarray) -> None:
+        self.ids = np.unique(ids)
+        self.reasons = np.full(len(self.ids), '', dtype=object)
+        # Frame and trip numbers of its rows by id of the frame
+        self._codes : Dict[int, Tuple[pd.DataFrame, np.ndarray]] = {}
+
+    @property
+    def keep(self) -> np.ndarray:
+        """Mask of the trips which are kept."""
+        return self.reasons == ''
+
+    def codes(self, frame : pd.DataFrame) -> np.ndarray:
+        """Trip number of every row of frame (cached per frame)."""
+        key = id(frame)
+        if key not in self._codes:
+            self._codes[key] = (frame, np.searchsorted(self.ids, frame['id'].values))
+        return self._codes[key][1]
+
+    def drop(self, reason : str, mask : np.ndarray) -> None:
+        """Drops the trips where mask is True, unless they are already dropped."""
+        self.reasons[mask & self.keep] = reason
+
+    def count(self, frame : pd.DataFrame) -> np.ndarray:
+        """
+        Number of positions of every trip, the rows of compacted positions
+        count the positions they stand for (column 'count').
+        """
+        if 'count' in frame.columns:
+            return np.bincount(self.codes(frame), weights=frame['count'].values, minlength=len(self.ids))
+        return np.bincount(self.codes(frame), minlength=len(self.ids))
+
+    def any(self, frame : pd.DataFrame, mask : np.ndarray) -> np.ndarray:
+        """True for the trips which have a row where mask is True."""
+        return np.bincount(self.codes(frame)[mask], minlength=len(self.ids)) > 0
+
+    def duration_s(self, frame : pd.DataFrame) -> np.ndarray:
+        """Seconds from the first to the last row of every trip."""
+        time_ns = frame['time'].values.astype('datetime64[ns]').astype(np.int64)
+        first = np.full(len(self.ids), np.iinfo(np.int64).max)
+        last = np.full(len(self.ids), np.iinfo(np.int64).min)
+        np.minimum.at(first, self.codes(frame), time_ns)
+        np.maximum.at(last, self.codes(frame), time_ns)
+        return np.where(last >= first, (last - first) / 1e9, 0)
+
+    def min_displacement(self, frame : pd.DataFrame, interval_s : int) -> np.ndarray:
+        """
+        Smallest distance in km between the mean positions of two consecutive
+        intervals of every trip (inf for trips within a single interval).
+        """
+        codes = self.codes(frame)
+        time_ns = frame['time'].values.astype('datetime64[ns]').astype(np.int64)
+        order = np.lexsort((time_ns, codes))
+        sorted_codes = codes[order]
+        # Renumber the trips of the frame to 0..n-1 for the displacement
+        present, trips = np.unique(sorted_codes, return_inverse=True)
+        minimum = np.full(len(self.ids), np.inf)
+        minimum[present] = min_bucket_displacement(
+            trips,
+            time_ns[order],
+            frame['lat'].values.astype(float)[order],
+            frame['long'].values.astype(float)[order],
+            interval_s,
+            frame['count'].values[order] if 'count' in frame.columns else None
+        )
+        return minimum
+
+    def apply(self, frame : Union[pd.DataFrame, None]) -> Union[pd.DataFrame, None]:
+        """Returns the rows of frame which belong to kept trips."""
+        if frame is None:
+            return None
+        return frame[self.keep[self.codes(frame)]]
+
+    def report(self) -> pd.DataFrame:
+        """The dropped trips with the reason they were dropped."""
+        dropped = ~self.keep
+        return pd.DataFrame({'id' : self.ids[dropped], 'reason' : self.reasons[dropped]})
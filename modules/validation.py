@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Sanity checks of raw AIS positions.
+
+Every position gets a reason it is invalid ('' if it is valid):
+    invalid_position: missing latitude/longitude or outside +-90/+-180
+        (e.g. the 91/181 "not available" values).
+    invalid_time: missing time.
+    duplicate: a second position of a ship with the same time.
+    teleport: a single position the ship can not have reached, where the
+        speed from the position before and to the position after is
+        above max_speed_knots.
+"""
+import numpy as np                                                              # type: ignore
+from haversine import haversine_vector                                          # type: ignore
+
+REASONS = ('invalid_position', 'invalid_time', 'duplicate', 'teleport')
+NAT = np.iinfo(np.int64).min
+
+def _teleports(
+    ships : np.ndarray,
+    time_ns : np.ndarray,
+    lat : np.ndarray,
+    long : np.ndarray,
+    max_speed_knots : float
+) -> np.ndarray:
+    """
+    Mask of the positions which are single outliers of their track.
+    The positions should be sorted by ship and time without duplicates.
+    """
+    size = len(ships)
+    if size < 3:
+        return np.zeros(size, dtype=bool)
+    same = ships[1:] == ships[:-1]
+    hours = (time_ns[1:] - time_ns[:-1]) / 3.6e12
+    distance = haversine_vector(
+        np.column_stack((lat[:-1], long[:-1])),
+        np.column_stack((lat[1:], long[1:]))
+    )
+    # Speed in knots (1 km/h = 0.53996 knots) from every position to the next
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fast = same & (distance / hours * 0.53996 > max_speed_knots)
+    calm = same & ~fast
+
+    fast_in = np.r_[False, fast]
+    fast_out = np.r_[fast, False]
+    # Inside a track both speeds are too high
+    outlier = fast_in & fast_out
+    # At the ends of a track the speed to the neighbour is too high while
+    # the neighbour continues the track at a possible speed
+    first = ~np.r_[False, same]
+    last = ~np.r_[same, False]
+    outlier |= first & fast_out & np.r_[calm[1:], False, False]
+    outlier |= last & fast_in & np.r_[False, False, calm[:-1]]
+    return outlier
+
+def quality_reasons(
+    ships : np.ndarray,
+    time_ns : np.ndarray,
+    lat : np.ndarray,
+    long : np.ndarray,
+    max_speed_knots : float = 50,
+    passes : int = 3
+) -> np.ndarray:
+    """
+    Returns the reason every position is invalid ('' if it is valid).
+    ships are numbers of the ships and time_ns the times in nanoseconds
+    (NAT for missing times). Teleports are searched for passes times, so
+    outliers next to each other are found after the first is removed.
+    """
+    reasons = np.full(len(ships), '', dtype=object)
+    reasons[~(np.isfinite(lat) & np.isfinite(long) & (np.abs(lat) <= 90) & (np.abs(long) <= 180))] = 'invalid_position'
+    reasons[(time_ns == NAT) & (reasons == '')] = 'invalid_time'
+
+    # Valid positions sorted by ship and time
+    order = np.lexsort((time_ns, ships))
+    order = order[reasons[order] == '']
+
+    # Keep the first position of a ship at a time
+    duplicate = np.r_[False, (ships[order][1:] == ships[order][:-1]) & (time_ns[order][1:] == time_ns[order][:-1])]
+    reasons[order[duplicate]] = 'duplicate'
+    order = order[~duplicate]
+
+    for _ in range(passes):
+        outlier = _teleports(ships[order], time_ns[order], lat[order], long[order], max_speed_knots)
+        if not outlier.any():
+            break
+        reasons[order[outlier]] = 'teleport'
+        order = order[~outlier]
+    return reasons
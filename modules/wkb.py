@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Decoding of polygons and multipolygons from well-known binary (WKB).
+
+The headers of the geometries (types, number of parts, rings and points)
+are read one geometry at a time, which is a few reads per ring. The
+coordinates of all rings are then gathered from one buffer and converted
+with a single numpy view, so the cost per point is vectorized. ISO and
+PostGIS extended WKB (with SRID, Z and M) are accepted, only x and y are
+kept.
+"""
+import struct
+from typing import List, Sequence, Tuple
+import numpy as np                                                              # type: ignore
+from modules.errors import WrongArguments
+
+WKB_POLYGON = 3
+WKB_MULTIPOLYGON = 6
+# Flags of PostGIS extended WKB
+EWKB_Z = 0x80000000
+EWKB_M = 0x40000000
+EWKB_SRID = 0x20000000
+
+def _header(buffer : bytes, position : int) -> Tuple[bool, int, int, int]:
+    """
+    Reads the byte order and type of a geometry at position.
+    Returns (little endian, type, dimensions, position after the header).
+    """
+    little = buffer[position] == 1
+    code = struct.unpack_from('<I' if little else '>I', buffer, position + 1)[0]
+    position += 5
+    z = bool(code & EWKB_Z)
+    m = bool(code & EWKB_M)
+    if code & EWKB_SRID:
+        position += 4
+    code &= 0x0FFFFFFF
+    # ISO types 1000 (Z), 2000 (M) and 3000 (ZM)
+    z |= code // 1000 in (1, 3)
+    m |= code // 1000 in (2, 3)
+    return little, code % 1000, 2 + z + m, position
+
+def decode_polygons(
+    blobs : Sequence[bytes]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Decodes a polygon or multipolygon from every WKB blob.
+    Returns the (x, y) vertices of all rings, the offsets of the rings,
+    the blob of every ring and whether every ring is a hole (every ring of
+    a polygon after the first).
+    """
+    buffer = b''.join(bytes(blob) for blob in blobs)
+    # Byte offset, points, dimensions, byte order, blob and hole of every ring
+    rings : List[Tuple[int, int, int, bool, int, bool]] = []
+    position = 0
+    for shape, blob in enumerate(blobs):
+        start = position
+        end = position + len(blob)
+        little, code, dimensions, position = _header(buffer, position)
+        if code == WKB_POLYGON:
+            parts = 1
+            part_header = False
+        elif code == WKB_MULTIPOLYGON:
+            parts = struct.unpack_from('<I' if little else '>I', buffer, position)[0]
+            position += 4
+            part_header = True
+        else:
+            raise WrongArguments("Geometry {0} is type {1}, not a polygon or multipolygon".format(shape, code))
+        for _ in range(parts):
+            if part_header:
+                little, code, dimensions, position = _header(buffer, position)
+                if code != WKB_POLYGON:
+                    raise WrongArguments("Geometry {0} has a part of type {1}".format(shape, code))
+            order = '<I' if little else '>I'
+            ring_amount = struct.unpack_from(order, buffer, position)[0]
+            position += 4
+            for ring in range(ring_amount):
+                points = struct.unpack_from(order, buffer, position)[0]
+                position += 4
+                if points:
+                    rings.append((position, points, dimensions, little, shape, ring > 0))
+                position += points * dimensions * 8
+        if position != end:
+            raise WrongArguments("Geometry {0} has {1} bytes but {2} were read".format(
+                shape, len(blob), position - start
+            ))
+        position = end
+
+    if not rings:
+        return np.zeros((0, 2)), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    offset, points, dimensions, little, ring_shape, ring_hole = (np.array(column) for column in zip(*rings))
+
+    # Byte of the x of every point, then the 16 bytes of x and y
+    ring_offsets = np.r_[0, np.cumsum(points)].astype(np.int64)
+    point_of_ring = np.arange(ring_offsets[-1]) - np.repeat(ring_offsets[:-1], points)
+    first_byte = np.repeat(offset, points) + point_of_ring * np.repeat(dimensions * 8, points)
+    raw = np.frombuffer(buffer, dtype=np.uint8)[first_byte[:, None] + np.arange(16)]
+    point_little = np.repeat(little, points)
+    vertices = np.empty((len(raw), 2))
+    vertices[point_little] = raw[point_little].view('<f8')
+    vertices[~point_little] = raw[~point_little].view('>f8')
+    return vertices, ring_offsets, ring_shape.astype(np.int64), ring_hole.astype(bool)